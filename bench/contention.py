@@ -0,0 +1,123 @@
+"""
+Lock contention benchmark for the Marketplace.
+
+Every consumer thread repeatedly adds its own product to its cart and removes
+it again, so consumers never compete for stock, only for locks. Every critical
+section of an inventory lock also spends --hold seconds blocked, the way a
+section doing I/O would, so the lock is really held while the other threads
+run. The run is repeated for a growing number of consumers, once with a single
+inventory lock and once with the default lock striping, and the aggregate
+throughput is printed.
+
+Run it from the repository root:
+
+    python bench/contention.py --consumers 1 4 16 32 --ops 2000
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+if not __package__:  # run as a script rather than with python -m
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+
+class HeldLock:
+    """
+    An inventory lock whose critical sections last at least hold seconds.
+    The wait releases the GIL, so the threads that do not need the lock keep
+    running while it is held.
+    """
+    def __init__(self, hold):
+        self.lock = threading.Lock()
+        self.hold = hold
+
+    def acquire(self):
+        """
+        Takes the lock and does the critical section's work.
+        """
+        self.lock.acquire()  # pylint: disable=consider-using-with
+        time.sleep(self.hold)
+        return True
+
+    def release(self):
+        """
+        Releases the lock.
+        """
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def run_once(consumers, ops, stripes, hold):
+    """
+    Runs one measurement.
+
+    :returns the number of add_to_cart + remove_from_cart calls per second
+    """
+    marketplace = Marketplace(consumers, lock_stripes=stripes)
+    for stripe in marketplace.stripes:
+        stripe.lock = HeldLock(hold)
+    producer_id = marketplace.register_producer()
+    products = [Tea("tea%d" % i, i, "Black") for i in range(consumers)]
+    for product in products:
+        marketplace.publish(producer_id, product)
+
+    start_barrier = threading.Barrier(consumers + 1)
+
+    def shop(product):
+        cart_id = marketplace.new_cart()
+        start_barrier.wait()
+        for _ in range(ops):
+            marketplace.add_to_cart(cart_id, product)
+            marketplace.remove_from_cart(cart_id, product)
+
+    threads = [threading.Thread(target=shop, args=(product,)) for product in products]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return 2 * ops * consumers / elapsed
+
+
+def main():
+    """
+    Parses the command line and prints one line per consumer count.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--consumers", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--ops", type=int, default=2000,
+                        help="add/remove pairs per consumer")
+    parser.add_argument("--hold", type=float, default=0.00005,
+                        help="seconds every critical section of an inventory lock lasts")
+    parser.add_argument("--stripes", type=int, default=16,
+                        help="lock stripes of the striped configuration")
+    args = parser.parse_args()
+
+    # measure the locking, not the log file
+    logging.getLogger('marketplace.log').setLevel(logging.WARNING)
+
+    print("%9s %14s %14s" % ("consumers", "1 lock ops/s", "%d locks ops/s" % args.stripes))
+    for consumers in args.consumers:
+        single = run_once(consumers, args.ops, 1, args.hold)
+        striped = run_once(consumers, args.ops, args.stripes, args.hold)
+        print("%9d %14.0f %14.0f" % (consumers, single, striped))
+
+
+if __name__ == "__main__":
+    main()
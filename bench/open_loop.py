@@ -0,0 +1,181 @@
+"""
+Open-loop load generator for the Marketplace.
+
+Cart operations arrive at a fixed or Poisson rate whatever the marketplace is
+doing: a scheduler thread hands each request to a pool of worker threads at
+its arrival time, and its latency is measured from that arrival time, so the
+time a request spends queued behind slow ones is counted instead of hidden
+like in the closed loop of Consumer.run. Producer threads keep the catalog in
+stock with blocking publish calls. The run is repeated for a growing offered
+load and the p50/p99/p99.9 latency of add_to_cart is printed, along with the
+first load at which its p99 exceeds --knee times the p99 of the lowest load.
+
+Run it from the repository root:
+
+    python -m bench.open_loop --rates 1000 2000 4000 8000 --arrivals poisson --queue-size 8
+"""
+
+import argparse
+import queue
+import random
+import threading
+import time
+
+from tema.histogram import Histogram
+from tema.logger import set_level
+from tema.marketplace import Marketplace
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+OPERATIONS = ("add_to_cart", "remove_from_cart", "place_order")
+
+
+def arrivals(rate, kind, rng):
+    """
+    Yields the gaps between requests, in seconds.
+    """
+    while True:
+        yield rng.expovariate(rate) if kind == "poisson" else 1 / rate
+
+
+def run_once(rate, args):
+    """
+    Offers rate requests per second for args.duration seconds.
+
+    :returns ({operation: Histogram of latencies in nanoseconds}, the number
+    of requests issued, the number of add_to_cart calls that found no stock)
+    """
+    marketplace = Marketplace(args.queue_size, sink=MemorySink())
+    catalog = [Tea("tea%d" % i, i % 10 + 1, "Black") for i in range(args.catalog_size)]
+    requests = queue.SimpleQueue()
+    rng = random.Random(args.seed)
+    add_share = 1 - args.remove_share - 1 / args.cart_size
+
+    def produce(index):
+        producer_id = marketplace.register_producer()
+        while not marketplace.is_closed():
+            for product in catalog[index::args.producers] or catalog:
+                if not marketplace.publish(producer_id, product, block=True):
+                    break
+
+    def serve(histograms, misses):
+        cart_id = marketplace.new_cart()
+        added = []
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            arrival, draw, product = request
+            if draw < add_share:
+                operation = "add_to_cart"
+                if marketplace.add_to_cart(cart_id, product):
+                    added.append(product)
+                else:
+                    misses.append(1)
+            elif draw < add_share + args.remove_share and added:
+                operation = "remove_from_cart"
+                marketplace.remove_from_cart(cart_id, added.pop())
+            else:
+                operation = "place_order"
+                marketplace.place_order(cart_id)
+                cart_id = marketplace.new_cart()
+                added = []
+            histograms[operation].record(time.perf_counter_ns() - arrival)
+
+    producers = [threading.Thread(target=produce, args=(i,), daemon=True)
+                 for i in range(args.producers)]
+    workers = []
+    for _ in range(args.workers):
+        histograms = {operation: Histogram(args.significant_figures)
+                      for operation in OPERATIONS}
+        misses = []
+        workers.append((threading.Thread(target=serve, args=(histograms, misses)), histograms,
+                        misses))
+    for thread in producers:
+        thread.start()
+    for thread, _, _ in workers:
+        thread.start()
+
+    # the schedule is fixed in advance and never waits for completions
+    issued = 0
+    start = time.perf_counter_ns()
+    deadline = start + int(args.duration * 1e9)
+    arrival = start
+    for gap in arrivals(rate, args.arrivals, rng):
+        arrival += int(gap * 1e9)
+        if arrival >= deadline:
+            break
+        delay = (arrival - time.perf_counter_ns()) / 1e9
+        if delay > 0:
+            time.sleep(delay)
+        requests.put((arrival, rng.random(), rng.choice(catalog)))
+        issued += 1
+    for _ in workers:
+        requests.put(None)
+    for thread, _, _ in workers:
+        thread.join()
+    marketplace.shutdown()
+    for thread in producers:
+        thread.join()
+    marketplace.fulfillment.join()
+
+    totals = {operation: Histogram(args.significant_figures) for operation in OPERATIONS}
+    for _, histograms, _ in workers:
+        for operation, histogram in histograms.items():
+            totals[operation].merge(histogram)
+    return totals, issued, sum(len(misses) for _, _, misses in workers)
+
+
+def main():
+    """
+    Parses the command line and prints one line per offered load.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rates", type=float, nargs="+", default=[500, 1000, 2000, 4000, 8000],
+                        help="offered loads, in requests per second")
+    parser.add_argument("--arrivals", choices=["fixed", "poisson"], default="poisson")
+    parser.add_argument("--duration", type=float, default=2, help="seconds per offered load")
+    parser.add_argument("--queue-size", type=int, default=8, help="queue_size_per_producer")
+    parser.add_argument("--catalog-size", type=int, default=100)
+    parser.add_argument("--producers", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=8,
+                        help="threads serving the requests, each with its own cart")
+    parser.add_argument("--cart-size", type=int, default=8,
+                        help="one request in cart-size places the order")
+    parser.add_argument("--remove-share", type=float, default=0.1,
+                        help="the fraction of requests that remove a product")
+    parser.add_argument("--knee", type=float, default=10,
+                        help="p99 growth over the lowest load that counts as blowing up")
+    parser.add_argument("--significant-figures", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the arrivals and products")
+    args = parser.parse_args()
+
+    # measure the marketplace, not the log file
+    set_level("WARNING")
+
+    print("%10s %10s %7s %10s %10s %10s %10s" % ("offered/s", "served/s", "misses", "p50 us",
+                                                 "p99 us", "p99.9 us", "max us"))
+    baseline = knee = None
+    for rate in sorted(args.rates):
+        start = time.perf_counter()
+        histograms, issued, misses = run_once(rate, args)
+        elapsed = time.perf_counter() - start
+        adds = histograms["add_to_cart"]
+        p99 = adds.value_at_percentile(99)
+        print("%10.0f %10.0f %7d %10.1f %10.1f %10.1f %10.1f" % (
+            rate, issued / elapsed, misses, adds.value_at_percentile(50) / 1000, p99 / 1000,
+            adds.value_at_percentile(99.9) / 1000, (adds.max or 0) / 1000))
+        if baseline is None:
+            baseline = p99
+        elif knee is None and p99 > args.knee * baseline:
+            knee = rate
+
+    if knee is None:
+        print("p99 add_to_cart stayed within %gx of the lowest load" % args.knee)
+    else:
+        print("p99 add_to_cart blows up at %.0f requests/s (queue size %d, catalog %d)"
+              % (knee, args.queue_size, args.catalog_size))
+
+
+if __name__ == "__main__":
+    main()
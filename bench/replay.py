@@ -0,0 +1,78 @@
+"""
+Replays a recorded marketplace trace as a benchmark.
+
+The trace, recorded with test.py --record, is replayed against a fresh
+marketplace of the recorded queue size, either as fast as possible, at the
+recorded pacing scaled by --speed, or serially from one thread, which gives
+the same results on every run. The wall time, the calls per second and the
+number of calls whose result differs from the recorded one are printed for
+every repetition.
+
+Run it from the repository root:
+
+    python test.py tests/10.in --record 10.trace > /dev/null
+    python -m bench.replay 10.trace --repeat 3
+    python -m bench.replay 10.trace --serial --implementation shm
+"""
+
+import argparse
+import contextlib
+import os
+import time
+
+from tema.logger import set_level
+from tema.marketplace import Marketplace
+from tema.shm_marketplace import SharedMemoryMarketplace
+from tema.sinks import MemorySink
+from tema.trace import TraceReplayer
+
+
+def build(implementation, replayer):
+    """
+    Returns a fresh marketplace of the recorded configuration.
+    """
+    queue_size = replayer.config.get("queue_size_per_producer", 1)
+    if implementation == "shm":
+        return SharedMemoryMarketplace(queue_size, products=list(replayer.products.values()))
+    return Marketplace(queue_size, sink=MemorySink())
+
+
+def main():
+    """
+    Parses the command line and prints one line per repetition.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("trace", help="a trace written by test.py --record")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="replay at the recorded pacing times speed, as fast as possible "
+                             "by default")
+    parser.add_argument("--serial", action="store_true",
+                        help="replay every call from one thread, in the recorded order")
+    parser.add_argument("--implementation", choices=["marketplace", "shm"],
+                        default="marketplace")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    # measure the marketplace, not the log file
+    set_level("WARNING")
+
+    replayer = TraceReplayer(args.trace)
+    print("%d calls, %d products" % (len(replayer.calls), len(replayer.products)))
+    print("%6s %9s %10s %10s" % ("run", "seconds", "calls/s", "mismatches"))
+    for run in range(args.repeat):
+        marketplace = build(args.implementation, replayer)
+        # the shared memory marketplace prints its orders
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            mismatches = replayer.replay(marketplace, args.speed, args.serial)
+            elapsed = time.perf_counter() - start
+        if args.implementation == "shm":
+            marketplace.close()
+        else:
+            marketplace.fulfillment.join()
+        print("%6d %9.3f %10.0f %10d" % (run + 1, elapsed, len(replayer.calls) / elapsed,
+                                         mismatches))
+
+
+if __name__ == "__main__":
+    main()
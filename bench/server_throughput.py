@@ -0,0 +1,91 @@
+"""
+Throughput of a marketplace server driven by several client processes.
+
+Each client process repeatedly adds its own product to a cart and removes it
+again through a MarketplaceClient, either one call per round trip or in
+pipelined groups, and the aggregate calls per second are printed for a growing
+number of client processes.
+
+Run it from the repository root:
+
+    python -m bench.server_throughput --clients 1 2 4 8 --ops 5000 --pipeline 32
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from tema.server import MarketplaceClient, serve
+from tema.product import Tea
+
+
+def shop(path, index, ops, pipeline, start):
+    """
+    Runs the add/remove loop of one client process.
+    """
+    client = MarketplaceClient(path)
+    product = Tea("tea%d" % index, index, "Black")
+    producer_id = client.register_producer()
+    client.publish(producer_id, product)
+    cart_id = client.new_cart()
+    start.wait()
+
+    for _ in range(0, ops, pipeline):
+        with client.pipeline() as pipe:
+            for _ in range(pipeline):
+                pipe.add_to_cart(cart_id, product)
+                pipe.remove_from_cart(cart_id, product)
+
+
+def run_once(clients, ops, pipeline):
+    """
+    Runs one measurement against a fresh server.
+
+    :returns the number of calls per second over all the clients
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "marketplace.sock")
+    server = multiprocessing.Process(target=serve,
+                                     args=(path, {"queue_size_per_producer": 1}))
+    server.start()
+
+    start = multiprocessing.Barrier(clients + 1)
+    processes = [multiprocessing.Process(target=shop, args=(path, i, ops, pipeline, start))
+                 for i in range(clients)]
+    for process in processes:
+        process.start()
+    start.wait()
+    begin = time.perf_counter()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - begin
+
+    MarketplaceClient(path).stop_server()
+    server.join()
+    shutil.rmtree(directory)
+    return 2 * ops * clients / elapsed
+
+
+def main():
+    """
+    Parses the command line and prints one line per client count.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--ops", type=int, default=5000, help="add/remove pairs per client")
+    parser.add_argument("--pipeline", type=int, default=32,
+                        help="add/remove pairs sent per pipelined group")
+    args = parser.parse_args()
+
+    print("%7s %15s %15s" % ("clients", "unpipelined/s", "pipelined/s"))
+    for clients in args.clients:
+        single = run_once(clients, args.ops, 1)
+        pipelined = run_once(clients, args.ops, args.pipeline)
+        print("%7d %15.0f %15.0f" % (clients, single, pipelined))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Closed-loop throughput benchmark for the Marketplace.
+
+Producer threads publish the catalog round-robin and consumer threads fill
+carts with random products, remove one of them and place the order, all
+without sleeping: a full queue or a product out of stock is skipped rather
+than waited for. Every call is timed, and the suite runs once for each
+combination of producer count, consumer count, queue size and catalog size,
+reporting the calls per second and the p50/p99 latency of publish,
+add_to_cart, remove_from_cart and place_order.
+
+Run it from the repository root:
+
+    python -m bench.throughput --consumers 1 4 --catalog-sizes 10 1000 --output new.json
+    python -m bench.throughput --compare base.json new.json
+
+The second form runs nothing and prints the regressions of new.json against
+the baseline base.json, exiting with 1 if there are any.
+"""
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+
+from tema.logger import set_level
+from tema.marketplace import Marketplace
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+OPERATIONS = ("publish", "add_to_cart", "remove_from_cart", "place_order")
+CONFIG_KEYS = ("producers", "consumers", "queue_size", "catalog_size")
+
+
+def percentile(ordered, fraction):
+    """
+    Returns the value below which the given fraction of the sorted values lie.
+    """
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """
+    Turns the latencies of one operation, in nanoseconds, into its results.
+
+    :returns a dict with the number of calls, the calls per second and the
+    p50/p99 latency in microseconds
+    """
+    if not latencies:
+        return {"calls": 0, "ops_per_sec": 0.0, "p50_us": 0.0, "p99_us": 0.0}
+    latencies.sort()
+    return {"calls": len(latencies),
+            "ops_per_sec": len(latencies) / elapsed,
+            "p50_us": percentile(latencies, 0.50) / 1000,
+            "p99_us": percentile(latencies, 0.99) / 1000}
+
+
+def run_once(producers, consumers, queue_size, catalog_size, carts, cart_size, seed):
+    """
+    Runs one measurement.
+
+    :returns a dict with the configuration, the wall time and the results of
+    every operation
+    """
+    marketplace = Marketplace(queue_size, sink=MemorySink())
+    catalog = [Tea("tea%d" % i, i % 10 + 1, "Black") for i in range(catalog_size)]
+    latencies = {operation: [] for operation in OPERATIONS}
+    done = threading.Event()
+    start_barrier = threading.Barrier(producers + consumers + 1)
+    clock = time.perf_counter_ns
+
+    def produce(index):
+        producer_id = marketplace.register_producer()
+        timed = []
+        start_barrier.wait()
+        for product in itertools.islice(itertools.cycle(catalog), index, None):
+            if done.is_set():
+                break
+            begin = clock()
+            marketplace.publish(producer_id, product)
+            timed.append(clock() - begin)
+        latencies["publish"].extend(timed)
+
+    def shop(index):
+        rng = random.Random(seed * 1000 + index)
+        timed = {operation: [] for operation in OPERATIONS[1:]}
+        start_barrier.wait()
+        for _ in range(carts):
+            cart_id = marketplace.new_cart()
+            added = []
+            for product in rng.choices(catalog, k=cart_size):
+                begin = clock()
+                got = marketplace.add_to_cart(cart_id, product)
+                timed["add_to_cart"].append(clock() - begin)
+                if got:
+                    added.append(product)
+            if added:
+                begin = clock()
+                marketplace.remove_from_cart(cart_id, rng.choice(added))
+                timed["remove_from_cart"].append(clock() - begin)
+            begin = clock()
+            marketplace.place_order(cart_id)
+            timed["place_order"].append(clock() - begin)
+        for operation, values in timed.items():
+            latencies[operation].extend(values)
+
+    producer_threads = [threading.Thread(target=produce, args=(i,)) for i in range(producers)]
+    consumer_threads = [threading.Thread(target=shop, args=(i,)) for i in range(consumers)]
+    for thread in producer_threads + consumer_threads:
+        thread.start()
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in consumer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in producer_threads:
+        thread.join()
+    marketplace.fulfillment.join()
+
+    return {"producers": producers, "consumers": consumers, "queue_size": queue_size,
+            "catalog_size": catalog_size, "seconds": elapsed,
+            "operations": {operation: summarize(values, elapsed)
+                           for operation, values in latencies.items()}}
+
+
+def compare(baseline, current, threshold):
+    """
+    Compares two result files, matching the runs by configuration.
+
+    :returns a line for every operation whose throughput dropped, or whose p99
+    latency grew, by more than the threshold fraction
+    """
+    previous = {tuple(run[key] for key in CONFIG_KEYS): run for run in baseline["runs"]}
+    regressions = []
+    for run in current["runs"]:
+        config = tuple(run[key] for key in CONFIG_KEYS)
+        if config not in previous:
+            continue
+        label = " ".join("%s=%d" % pair for pair in zip(CONFIG_KEYS, config))
+        for operation, now in run["operations"].items():
+            before = previous[config]["operations"].get(operation)
+            if not before or not before["calls"] or not now["calls"]:
+                continue
+            if now["ops_per_sec"] < before["ops_per_sec"] * (1 - threshold):
+                regressions.append("%s %s: %.0f -> %.0f ops/s" % (
+                    label, operation, before["ops_per_sec"], now["ops_per_sec"]))
+            if now["p99_us"] > before["p99_us"] * (1 + threshold):
+                regressions.append("%s %s: p99 %.1f -> %.1f us" % (
+                    label, operation, before["p99_us"], now["p99_us"]))
+    return regressions
+
+
+def main():
+    """
+    Parses the command line, runs the grid and prints one line per run and
+    operation, or compares two result files.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--producers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--consumers", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--queue-sizes", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--catalog-sizes", type=int, nargs="+", default=[10, 1000])
+    parser.add_argument("--carts", type=int, default=2000, help="orders placed per consumer")
+    parser.add_argument("--cart-size", type=int, default=4, help="add_to_cart calls per cart")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the consumers' choices")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as baseline_file, open(args.compare[1]) as current_file:
+            regressions = compare(json.load(baseline_file), json.load(current_file),
+                                  args.threshold)
+        for line in regressions:
+            print("REGRESSION " + line)
+        print("%d regressions" % len(regressions))
+        return 1 if regressions else 0
+
+    # measure the marketplace, not the log file
+    set_level("WARNING")
+
+    runs = []
+    print("%9s %9s %5s %7s %-16s %10s %9s %9s" % ("producers", "consumers", "queue", "catalog",
+                                                  "operation", "ops/s", "p50 us", "p99 us"))
+    for producers, consumers, queue_size, catalog_size in itertools.product(
+            args.producers, args.consumers, args.queue_sizes, args.catalog_sizes):
+        run = run_once(producers, consumers, queue_size, catalog_size, args.carts,
+                       args.cart_size, args.seed)
+        runs.append(run)
+        for operation, result in run["operations"].items():
+            print("%9d %9d %5d %7d %-16s %10.0f %9.1f %9.1f" % (
+                producers, consumers, queue_size, catalog_size, operation,
+                result["ops_per_sec"], result["p50_us"], result["p99_us"]))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"python": sys.version.split()[0], "carts": args.carts,
+                       "cart_size": args.cart_size, "seed": args.seed, "runs": runs},
+                      output_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
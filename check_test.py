@@ -5,8 +5,65 @@ Computer Systems Architecture Course
 Assignment 1
 March 2021
 """
-import subprocess
 import sys
+from collections import Counter
+
+CHUNK_SIZE = 1 << 16
+
+
+def count_purchases(stream):
+    """
+    Counts the "<consumer> bought <product>" records of a text stream, reading
+    it in chunks so the memory used only depends on the number of distinct
+    (consumer, product) pairs, not on the size of the output.
+
+    :returns a Counter of (consumer, product) pairs
+    """
+    counts = Counter()
+    rest = ""
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), ""):
+        # sometimes there is no new line between consumer outputs, so a record
+        # ends with the ")" closing the product
+        records = (rest + chunk).split(")")
+        rest = records.pop()
+        for record in records:
+            record = record.strip()
+            if record:
+                consumer, _, product = record.partition(" bought ")
+                counts[consumer, product + ")"] += 1
+    if rest.strip():
+        consumer, _, product = rest.strip().partition(" bought ")
+        counts[consumer, product] += 1
+    return counts
+
+
+def differences(output_counts, ref_counts):
+    """
+    Compares the purchases of a run with the reference ones.
+
+    :returns {consumer: {product: units bought minus units expected}}, for the
+    consumers and products whose counts differ
+    """
+    diff = {}
+    for key in output_counts.keys() | ref_counts.keys():
+        delta = output_counts[key] - ref_counts[key]
+        if delta:
+            consumer, product = key
+            diff.setdefault(consumer, {})[product] = delta
+    return diff
+
+
+def report(diff):
+    """
+    Returns the lines that describe the differences, per consumer.
+    """
+    lines = []
+    for consumer in sorted(diff):
+        lines.append(f"{consumer}:")
+        for product, delta in sorted(diff[consumer].items()):
+            kind = "extra" if delta > 0 else "missing"
+            lines.append(f"\t{kind} {abs(delta)} x {product}")
+    return lines
 
 
 def main():
@@ -17,29 +74,19 @@ def main():
     testname = sys.argv[1]
     output_filename = sys.argv[2]
     ref_filename = sys.argv[3]
-    # load the lines from the output file and sort them
-    with open(output_filename) as output_file:
-        output_lines = output_file.read()
-
-    output_lines = output_lines.split(")")  # sometimes there is no new line between consumer outputs
-    output_lines = [line.strip() + ")" for line in output_lines if len(line.strip()) > 0]
-
-    output_lines.sort()
 
-    sorted_output_filename = output_filename + ".sorted"
-
-    # write to input file (tests/{test_name}.in)
-    with open(sorted_output_filename, 'w') as sorted_output_file:
-        for line in output_lines:
-            print(line, file=sorted_output_file)
-
-    command = subprocess.Popen(["diff", sorted_output_filename, ref_filename], stdout=subprocess.PIPE)
-    out, err = command.communicate()
+    with open(output_filename) as output_file:
+        output_counts = count_purchases(output_file)
+    with open(ref_filename) as ref_file:
+        ref_counts = count_purchases(ref_file)
 
-    if len(out) == 0:
+    diff = differences(output_counts, ref_counts)
+    if not diff:
         print(f"Test {testname}" + ":\t\t" + "PASSED")
     else:
         print(f"Test {testname}" + ":\t\t" + "FAILED")
+        for line in report(diff):
+            print(line)
 
 
 if __name__ == "__main__":
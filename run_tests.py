@@ -0,0 +1,173 @@
+"""
+This module runs the homework's tests in parallel and checks their output
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import argparse
+import glob
+import io
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+from contextlib import redirect_stdout
+
+import test as runner
+from check_test import count_purchases, differences, report
+from tema.logger import set_level
+from tema.scenario import load_scenario
+
+TESTS_DIR = "tests"
+
+
+def run_test(name, mode, log_level):
+    """
+        Runs one test in the current process and compares its output with
+        the reference output
+
+        :returns (name, status, seconds, differences) where status is PASSED
+        or FAILED and differences are check_test.report lines
+    """
+    set_level(log_level)
+    market_config = load_scenario(os.path.join(TESTS_DIR, name + ".in"))
+    with open(os.path.join(TESTS_DIR, name + ".ref.out"), encoding="utf-8") as ref_file:
+        expected = count_purchases(ref_file)
+
+    output = io.StringIO()
+    start = time.monotonic()
+    with redirect_stdout(output):
+        runner.run(market_config, mode)
+    elapsed = time.monotonic() - start
+
+    output.seek(0)
+    diff = report(differences(count_purchases(output), expected))
+    return name, "FAILED" if diff else "PASSED", elapsed, diff
+
+
+def _run_test_process(connection, name, mode, log_level):
+    """
+        Body of a test's process, which sends the result of run_test back
+    """
+    with connection:
+        connection.send(run_test(name, mode, log_level))
+
+
+class _TestProcess:
+    """
+        A test running in a process of its own, which is killed if it
+        exceeds its time limit, whatever threads it left running
+    """
+    def __init__(self, name, mode, log_level):
+        self.name = name
+        self.connection, child_connection = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_run_test_process,
+                                               args=(child_connection, name, mode, log_level))
+        self.process.start()
+        child_connection.close()
+        self.start = time.monotonic()
+
+    def result(self):
+        """
+            Returns the result the test sent, once it is ready
+        """
+        try:
+            result = self.connection.recv()
+        except EOFError:
+            result = (self.name, "FAILED", time.monotonic() - self.start,
+                      ["the test process exited with code %s" % self.process.exitcode])
+        self.process.join()
+        return result
+
+    def kill(self):
+        """
+            Stops a test that exceeded its time limit
+        """
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+        return self.name, "TIMEOUT", time.monotonic() - self.start, []
+
+
+def run_tests(names, jobs, timeout, mode, log_level):
+    """
+        Runs at most jobs tests at the same time, each in a fresh process
+
+        :returns an iterator over the results of run_test, in the order of names
+    """
+    waiting = list(reversed(names))
+    running = []
+    results = {}
+    for name in names:
+        while name not in results:
+            while waiting and len(running) < jobs:
+                running.append(_TestProcess(waiting.pop(), mode, log_level))
+            deadline = min(test.start for test in running) + timeout
+            ready = multiprocessing.connection.wait([test.connection for test in running],
+                                                    max(0, deadline - time.monotonic()))
+            for test in list(running):
+                if test.connection in ready:
+                    results[test.name] = test.result()
+                elif time.monotonic() - test.start >= timeout:
+                    results[test.name] = test.kill()
+                else:
+                    continue
+                running.remove(test)
+        yield results.pop(name)
+
+
+def discover(names):
+    """
+        Returns the names of the tests to run: the given ones, or every
+        tests/<name>.in that has a tests/<name>.ref.out
+    """
+    if names:
+        return names
+    return sorted(os.path.basename(path)[:-len(".in")]
+                  for path in glob.glob(os.path.join(TESTS_DIR, "*.in"))
+                  if os.path.exists(path[:-len(".in")] + ".ref.out"))
+
+
+def main():
+    """
+        Runs the tests on a pool of processes and prints one line per test,
+        in the format parse.awk reads
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="the tests to run, e.g. 02, all by default")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="the number of tests run at the same time, all of them by "
+                             "default since the tests mostly sleep")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="the maximum number of seconds a test may take")
+    parser.add_argument("--mode", choices=["threads", "asyncio", "pool", "shm", "simulate"],
+                        default="threads", help="see test.py --mode")
+    parser.add_argument("--log-level", default="WARNING", help="marketplace log level")
+    args = parser.parse_args()
+
+    names = discover(args.names)
+    start = time.monotonic()
+    failed = 0
+    # every test gets a fresh process, so a test that timed out can be killed
+    # with the threads it left behind
+    jobs = min(args.jobs or len(names), len(names)) or 1
+    for name, status, elapsed, diff in run_tests(names, jobs, args.timeout, args.mode,
+                                                 args.log_level):
+        label = str(int(name)) if name.isdigit() else name  # run_tests.sh numbering
+        if status == "TIMEOUT":
+            print(f"TIMEOUT. Test {label} exceeded maximum allowed time of {args.timeout:g}")
+        print(f"Test {label}:\t\t{'PASSED' if status == 'PASSED' else 'FAILED'}"
+              f"\t{elapsed:.2f}s", flush=True)
+        for line in diff:
+            print(line)
+        failed += status != "PASSED"
+
+    print(f"{len(names) - failed}/{len(names)} tests passed in "
+          f"{time.monotonic() - start:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,97 @@
+"""
+This module represents the asyncio versions of the Producer and the Consumer.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+
+class AsyncProducer:
+    """
+    Coroutine-based producer, the asyncio counterpart of tema.producer.Producer.
+    """
+
+    def __init__(self, products, marketplace, republish_wait_time, name=None):
+        """
+        Constructor.
+
+        :type products: List()
+        :param products: a list of products that the producer will produce
+
+        :type marketplace: AsyncMarketplace
+        :param marketplace: a reference to the marketplace
+
+        :type republish_wait_time: Time
+        :param republish_wait_time: kept for configuration compatibility,
+        publish blocks until a slot frees up
+
+        :type name: String
+        :param name: the producer's name
+        """
+        self.products = products
+        self.marketplace = marketplace
+        self.republish_wait_time = republish_wait_time
+        self.name = name
+
+    async def run(self):
+        """
+        Publishes the products in a loop until the marketplace shuts down.
+        """
+        id_producer = await self.marketplace.register_producer()
+        while not self.marketplace.closed.is_set():
+            for product, size, publish_wait_time in self.products:
+                if await self.marketplace.publish_many(id_producer, product, size,
+                                                       block=True) < size:
+                    return
+                if await self.marketplace.wait_closed(size * publish_wait_time):
+                    return
+
+
+class AsyncConsumer:
+    """
+    Coroutine-based consumer, the asyncio counterpart of tema.consumer.Consumer.
+    Its orders are placed in its name, or in the name of its task if it has none.
+    """
+
+    def __init__(self, carts, marketplace, retry_wait_time, name=None):
+        """
+        Constructor.
+
+        :type carts: List
+        :param carts: a list of add and remove operations
+
+        :type marketplace: AsyncMarketplace
+        :param marketplace: a reference to the marketplace
+
+        :type retry_wait_time: Time
+        :param retry_wait_time: the number of seconds between two checks
+        while waiting for a product to be restocked
+
+        :type name: String
+        :param name: the consumer's name
+        """
+        self.carts = carts
+        self.marketplace = marketplace
+        self.retry_wait_time = retry_wait_time
+        self.name = name
+
+    async def run(self):
+        """
+        Fills and orders every cart.
+        """
+        for cart in self.carts:
+            id_cart = await self.marketplace.new_cart()
+            for command in cart:
+                quantity = command["quantity"]
+                if command["type"] == "add":
+                    iteration = 0
+                    while iteration < quantity:
+                        iteration += await self.marketplace.add_to_cart(
+                            id_cart, command["product"], quantity - iteration,
+                            block=True, timeout=self.retry_wait_time)
+
+                elif command["type"] == "remove":
+                    await self.marketplace.remove_from_cart(id_cart, command["product"], quantity)
+
+            await self.marketplace.place_order(id_cart, self.name)
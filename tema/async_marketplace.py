@@ -0,0 +1,386 @@
+"""
+This module represents the asyncio version of the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import asyncio
+import unittest
+from collections import deque
+
+from tema.catalog import ProductCatalog
+from tema.fulfillment import Fulfillment
+from tema.logger import get_logger
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+
+class _AsyncWaiter:
+    """
+    A consumer task blocked in add_to_cart, waiting for units to be handed to its cart.
+    """
+    def __init__(self, cart_id, wanted):
+        self.cart_id = cart_id
+        self.wanted = wanted
+        self.received = 0
+        self.event = asyncio.Event()
+
+
+class AsyncMarketplace:
+    """
+    Marketplace shared by producer and consumer coroutines running on a single
+    event loop. It behaves like tema.marketplace.Marketplace, but since all the
+    callers run on one thread the state needs no locks, and blocked producers
+    and consumers wait on asyncio events instead of sleeping.
+    """
+    def __init__(self, queue_size_per_producer, sink=None, fulfillment_workers=0):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type sink: PrintSink
+        :param sink: where the placed orders are written, see tema.sinks
+
+        :type fulfillment_workers: Int
+        :param fulfillment_workers: the number of threads that write, log and record
+        the placed orders, see tema.fulfillment; 0 to do it in place_order
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.id_producer = 0
+        self.size = {}
+        # producer_id -> Event set when one of its slots frees up or it may hand off a product
+        self.slot_freed = {}
+
+        self.catalog = ProductCatalog()
+        # product id -> {producer_id: units of that product on the producer's shelf}
+        self.inventory = {}
+        # product id -> FIFO of _AsyncWaiter, consumers blocked until the product is restocked
+        self.waiters = {}
+        # product id -> ids of the producers blocked in publish with that product
+        self.blocked_publishers = {}
+
+        # cart_id -> {product id: {producer_id: units of the product taken from the producer}}
+        self.cart_list = {}
+        self.id_carts = 0
+
+        self.fulfillment = Fulfillment(sink, fulfillment_workers)
+        self.closed = asyncio.Event()
+        self.log = get_logger()
+
+    async def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        producer_id = self.id_producer
+        self.id_producer = self.id_producer + 1
+        self.size[producer_id] = 0
+        self.slot_freed[producer_id] = asyncio.Event()
+        self.log.info("Registered new producer with id %d", producer_id)
+        return producer_id
+
+    async def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace.
+
+        :returns True or False, see Marketplace.publish
+        """
+        return await self.publish_many(producer_id, product, 1, block, timeout) == 1
+
+    async def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace,
+        see Marketplace.publish_many.
+
+        :returns the number of units published
+        """
+        producer_id = int(producer_id)
+        product_id = self.catalog.intern(product)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        slot_freed = self.slot_freed[producer_id]
+        published = 0
+
+        while True:
+            slot_freed.clear()
+            published += self._hand_off(product_id, producer_id, quantity - published)
+            room = min(quantity - published,
+                       self.queue_size_per_producer - self.size[producer_id])
+            if room > 0:
+                self.size[producer_id] += room
+                self._put_unit(product_id, producer_id, room)
+                published += room
+            if published == quantity:
+                break
+            remaining = None if deadline is None else deadline - loop.time()
+            if not block or self.closed.is_set() or (remaining is not None and remaining <= 0):
+                break
+
+            blocked = self.blocked_publishers.setdefault(product_id, set())
+            blocked.add(producer_id)
+            try:
+                await asyncio.wait_for(slot_freed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                blocked.discard(producer_id)
+                if not blocked:
+                    del self.blocked_publishers[product_id]
+
+        self.log.debug("Published %d of %d units of product %s from producer %d.",
+                       published, quantity, product, producer_id)
+        return published
+
+    def shutdown(self):
+        """
+        Marks the marketplace as closed and wakes up every blocked producer.
+        """
+        self.log.info("Shutting down the marketplace.")
+        self.closed.set()
+        for slot_freed in self.slot_freed.values():
+            slot_freed.set()
+
+    async def wait_closed(self, timeout):
+        """
+        Sleeps for at most timeout seconds, waking up early if the marketplace shuts down.
+
+        :returns True if the marketplace is closed
+        """
+        try:
+            await asyncio.wait_for(self.closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.closed.is_set()
+
+    async def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        self.id_carts = self.id_carts + 1
+        self.cart_list[self.id_carts] = {}
+        self.log.info("Added new cart with id %s.", self.id_carts)
+        return self.id_carts
+
+    async def add_to_cart(self, cart_id, product, quantity=1, block=False, timeout=None):
+        """
+        Adds a product to the given cart, see Marketplace.add_to_cart.
+
+        :returns the number of units added
+        """
+        product_id = self.catalog.intern(product)
+        added = 0
+        stock = self.inventory.get(product_id)
+        while stock and added < quantity:
+            producer, units = self._take_unit(product_id, stock, quantity - added)
+            self._fill_cart(cart_id, product_id, producer, units)
+            added += units
+            stock = self.inventory.get(product_id)
+
+        if block and added < quantity:
+            waiter = _AsyncWaiter(cart_id, quantity - added)
+            self.waiters.setdefault(product_id, deque()).append(waiter)
+            # a producer stuck on a full queue can now hand this product off
+            for producer in self.blocked_publishers.get(product_id, ()):
+                self.slot_freed[producer].set()
+            try:
+                await asyncio.wait_for(waiter.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if waiter.received < waiter.wanted:  # timed out, maybe after a partial hand-off
+                queue = self.waiters[product_id]
+                queue.remove(waiter)
+                if not queue:
+                    del self.waiters[product_id]
+            added += waiter.received
+
+        self.log.debug("Added %d of %d units of product %s to cart with id %d.",
+                       added, quantity, product, cart_id)
+        return added
+
+    async def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes a product from cart, see Marketplace.remove_from_cart.
+
+        :returns the number of units removed
+        """
+        product_id = self.catalog.intern(product)
+        cart = self.cart_list[cart_id]
+        origin = cart.get(product_id)
+        removed = 0
+        while origin and removed < quantity:
+            producer = next(reversed(origin))
+            units = min(quantity - removed, origin[producer])
+            if origin[producer] == units:
+                del origin[producer]
+                if not origin:
+                    del cart[product_id]
+            else:
+                origin[producer] -= units
+            removed += units
+            units -= self._hand_off(product_id, producer, units)
+            if units:
+                self.size[producer] += units
+                self._put_unit(product_id, producer, units)
+
+        self.log.debug("Removed %d of %d units of product %s from cart with id %d.",
+                       removed, quantity, product, cart_id)
+        return removed
+
+    async def place_order(self, cart_id, name=None):
+        """
+        Return a list with all the products in the cart, release the cart and
+        pass the order on to the fulfillment stage, see Marketplace.place_order.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :type name: String
+        :param name: the buyer written to the sink for each product, by default
+        the name of the current task
+        """
+        self.log.info("Place order from cart with id %s.", cart_id)
+        if name is None:
+            name = asyncio.current_task().get_name()
+
+        products = self.cart_products(cart_id)
+        del self.cart_list[cart_id]
+        self.fulfillment.submit(name, products)
+
+        return products
+
+    def cart_products(self, cart_id):
+        """
+        Returns the list of products in the cart, see Marketplace.cart_products.
+        """
+        products = self.catalog.products
+        return [products[product_id] for product_id, origin in self.cart_list[cart_id].items()
+                for _ in range(sum(origin.values()))]
+
+    def _take_unit(self, product_id, stock, quantity):
+        """
+        Takes at most quantity units of product off the shelf of one of its producers.
+
+        :returns the id of the producer the units came from and the number of units
+        """
+        producer = next(iter(stock))
+        units = min(quantity, stock[producer])
+        if stock[producer] == units:
+            del stock[producer]
+            if not stock:
+                del self.inventory[product_id]
+        else:
+            stock[producer] -= units
+        self.size[producer] -= units
+        self.slot_freed[producer].set()
+        return producer, units
+
+    def _put_unit(self, product_id, producer, units):
+        """
+        Puts units of product on the shelf of the given producer, whose size
+        the caller has already accounted for.
+        """
+        stock = self.inventory.setdefault(product_id, {})
+        stock[producer] = stock.get(producer, 0) + units
+
+    def _fill_cart(self, cart_id, product_id, producer, units):
+        """
+        Puts units of product, coming from producer, in the cart.
+        """
+        origin = self.cart_list[cart_id].setdefault(product_id, {})
+        origin[producer] = origin.get(producer, 0) + units
+
+    def _hand_off(self, product_id, producer, units):
+        """
+        Gives restocked units straight to the longest waiting consumers, if any.
+
+        :returns the number of units handed off
+        """
+        queue = self.waiters.get(product_id)
+        handed = 0
+        while queue and handed < units:
+            waiter = queue[0]
+            given = min(units - handed, waiter.wanted - waiter.received)
+            self._fill_cart(waiter.cart_id, product_id, producer, given)
+            waiter.received += given
+            handed += given
+            if waiter.received == waiter.wanted:
+                queue.popleft()
+                waiter.event.set()
+        if queue is not None and not queue:
+            del self.waiters[product_id]
+        return handed
+
+
+class TestAsyncMarketplace(unittest.IsolatedAsyncioTestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        self.marketplace = AsyncMarketplace(3, sink=MemorySink())
+        self.first_product = Tea("tea", 5, "hot")
+        self.list = [self.first_product]
+
+    async def test_add_and_remove(self):
+        """
+        testing publishing, adding to and removing from a cart
+        """
+        producer_id = await self.marketplace.register_producer()
+        self.assertEqual(await self.marketplace.publish_many(producer_id, self.first_product, 5), 3)
+        cart_id = await self.marketplace.new_cart()
+        self.assertEqual(await self.marketplace.add_to_cart(cart_id, self.first_product, 2), 2)
+        self.assertEqual(await self.marketplace.remove_from_cart(cart_id, self.first_product), 1)
+        self.assertEqual(self.marketplace.size[producer_id], 2)
+        self.assertEqual(self.marketplace.cart_products(cart_id), self.list)
+
+    async def test_blocking_add_and_publish(self):
+        """
+        testing that blocked consumers and producers wake each other up
+        """
+        producer_id = await self.marketplace.register_producer()
+        await self.marketplace.publish_many(producer_id, Tea("green", 3, "cold"), 3)
+        cart_id = await self.marketplace.new_cart()
+        consumer = asyncio.create_task(
+            self.marketplace.add_to_cart(cart_id, self.first_product, 2, block=True))
+        await asyncio.sleep(0)
+        self.assertTrue(await self.marketplace.publish_many(producer_id, self.first_product,
+                                                             2, block=True, timeout=1))
+        self.assertEqual(await consumer, 2)
+        self.assertEqual(self.marketplace.size[producer_id], 3)
+
+    async def test_place_order_goes_through_the_sink(self):
+        """
+        testing that the order is written to the sink in the buyer's name
+        """
+        producer_id = await self.marketplace.register_producer()
+        await self.marketplace.publish_many(producer_id, self.first_product, 2)
+        cart_id = await self.marketplace.new_cart()
+        await self.marketplace.add_to_cart(cart_id, self.first_product, 2)
+        self.assertEqual(await self.marketplace.place_order(cart_id, "cons1"), self.list * 2)
+        self.marketplace.fulfillment.join()
+        self.assertEqual(self.marketplace.fulfillment.sink.lines(),
+                         ["cons1 bought %s" % self.first_product] * 2)
+        self.assertEqual(self.marketplace.fulfillment.ledger()["orders"], 1)
+
+    async def test_shutdown_wakes_blocked_producers(self):
+        """
+        testing that shutdown makes a blocked publish return False
+        """
+        producer_id = await self.marketplace.register_producer()
+        await self.marketplace.publish_many(producer_id, self.first_product, 3)
+        producer = asyncio.create_task(
+            self.marketplace.publish(producer_id, self.first_product, block=True))
+        await asyncio.sleep(0)
+        self.marketplace.shutdown()
+        self.assertFalse(await producer)
+
+
+if __name__ == '__main__':
+    unittest.main()
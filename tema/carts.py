@@ -0,0 +1,278 @@
+"""
+This module manages the life of the Marketplace's carts.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import io
+import threading
+import time
+import unittest
+from contextlib import contextmanager, nullcontext, redirect_stdout
+
+from tema.product import Tea
+
+
+class CartLifecycleMixin:
+    """
+    The carts of the Marketplace: their ids, their release once their order
+    is placed or they are abandoned, and the reaper thread that abandons the
+    carts nobody used for cart_idle_timeout seconds. Mixed into Marketplace,
+    whose stripes and _remove_units give an abandoned cart's units back.
+
+    cart_list only holds the live carts. mutex_cart guards the cart ids, the
+    live carts and cart_touched; it is taken after the stripe locks and
+    nothing else is locked while holding it. A cart is released by exactly
+    one of place_order, abandon_cart and the reaper: each of them first
+    claims it, removing it from cart_touched under mutex_cart.
+    """
+    def _init_carts(self, recycle_cart_ids, cart_idle_timeout):
+        """
+        Sets up the carts, see Marketplace.__init__.
+        """
+        # cart_id -> {product id: {producer_id: units of the product taken from the producer}}
+        self.cart_list = {}
+        self.id_carts = 0
+        self.recycle_cart_ids = recycle_cart_ids
+        self.free_cart_ids = []
+        self.cart_counts = {"opened": 0, "placed": 0, "abandoned": 0}
+        self.cart_idle_timeout = cart_idle_timeout
+        # cart_id -> time it was last used, None while in use; only kept for the reaper
+        self.cart_touched = {}
+        self.mutex_cart = threading.Lock()
+
+    def _start_reaper(self):
+        """
+        Starts the reaper thread if the carts have an idle timeout.
+        """
+        if self.cart_idle_timeout is not None:
+            threading.Thread(target=self._reap_idle_carts, name="cart-reaper",
+                             daemon=True).start()
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        self.log.info("Add new cart loading.")
+
+        with self.mutex_cart:
+            if self.free_cart_ids:
+                cart_id = self.free_cart_ids.pop()
+            else:
+                self.id_carts = self.id_carts + 1
+                cart_id = self.id_carts
+            self.cart_list[cart_id] = {}  # units of every product in the cart
+            self.cart_counts["opened"] += 1
+            if self.cart_idle_timeout is not None:
+                self.cart_touched[cart_id] = time.monotonic()
+        self.log.info("Added new cart with id %s.", cart_id)
+
+        return cart_id
+
+    def _in_use(self, cart_id):
+        """
+        Returns a context manager that keeps the reaper away from the cart while
+        it is being used; a no-op when there is no reaper.
+        """
+        if self.cart_idle_timeout is None:
+            return nullcontext()
+        return self._touching(cart_id)
+
+    @contextmanager
+    def _touching(self, cart_id):
+        """
+        Marks the cart as in use, then as last used when the block ends.
+        Raises KeyError if the cart was released.
+        """
+        with self.mutex_cart:
+            if cart_id not in self.cart_touched:
+                raise KeyError(cart_id)
+            self.cart_touched[cart_id] = None
+        try:
+            yield
+        finally:
+            with self.mutex_cart:
+                if cart_id in self.cart_touched:
+                    self.cart_touched[cart_id] = time.monotonic()
+
+    def _claim(self, cart_id):
+        """
+        Takes the cart away from the reaper before it is released, so the
+        reaper cannot abandon it halfway. Raises KeyError if the reaper
+        already did.
+        """
+        if self.cart_idle_timeout is not None:
+            with self.mutex_cart:
+                del self.cart_touched[cart_id]
+
+    def _release_cart(self, cart_id, outcome):
+        """
+        Forgets a cart whose order was placed or that was abandoned.
+
+        :type outcome: String
+        :param outcome: "placed" or "abandoned", the counter to increase
+        """
+        with self.mutex_cart:
+            del self.cart_list[cart_id]
+            self.cart_touched.pop(cart_id, None)
+            if self.recycle_cart_ids:
+                self.free_cart_ids.append(cart_id)
+            self.cart_counts[outcome] += 1
+
+    def abandon_cart(self, cart_id):
+        """
+        Puts every unit in the cart back on the shelf, or hands it to a waiting
+        consumer, and releases the cart.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+
+        :returns the number of units returned
+        """
+        self._claim(cart_id)
+        return self._abandon(cart_id)
+
+    def _abandon(self, cart_id):
+        """
+        Empties and releases a cart the reaper can no longer see, see abandon_cart.
+        """
+        returned = 0
+        for product_id, origin in list(self.cart_list[cart_id].items()):
+            stripe = self.stripes[product_id % len(self.stripes)]
+            with stripe.lock:
+                returned += self._remove_units(stripe, cart_id, product_id, sum(origin.values()))
+        self._release_cart(cart_id, "abandoned")
+        self.log.info("Abandoned cart with id %s and returned %d units.", cart_id, returned)
+        return returned
+
+    def reap_idle_carts(self):
+        """
+        Abandons the carts that were not used for cart_idle_timeout seconds.
+
+        :returns the number of carts abandoned
+        """
+        deadline = time.monotonic() - self.cart_idle_timeout
+        with self.mutex_cart:
+            idle = [cart_id for cart_id, touched in self.cart_touched.items()
+                    if touched is not None and touched < deadline]
+            for cart_id in idle:
+                del self.cart_touched[cart_id]
+        for cart_id in idle:
+            self._abandon(cart_id)
+        return len(idle)
+
+    def _reap_idle_carts(self):
+        """
+        Body of the reaper thread, which runs until the marketplace shuts down.
+        """
+        while not self.closed.wait(self.cart_idle_timeout / 2):
+            self.reap_idle_carts()
+
+    def cart_stats(self):
+        """
+        Returns the number of live carts and how many carts were opened,
+        placed and abandoned so far.
+        """
+        with self.mutex_cart:
+            return dict(self.cart_counts, live=len(self.cart_list))
+
+    def cart_products(self, cart_id):
+        """
+        Returns the list of products in the cart, one entry per unit.
+
+        :type cart_id: Int
+        :param cart_id: id cart
+        """
+        products = self.catalog.products
+        return [products[product_id] for product_id, origin in self.cart_list[cart_id].items()
+                for _ in range(sum(origin.values()))]
+
+
+class TestCartLifecycle(unittest.TestCase):
+    """
+    unittest class for releasing, abandoning and reaping carts
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        # imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.make_marketplace = Marketplace
+        self.first_product = Tea("tea", 5, "hot")
+
+    def test_placed_cart_is_released_and_its_id_recycled(self):
+        """
+        testing that place_order frees the cart and its id
+        """
+        marketplace = self.make_marketplace(3, recycle_cart_ids=True)
+        marketplace.register_producer()
+        marketplace.publish("0", self.first_product)
+        cart_id = marketplace.new_cart()
+        marketplace.add_to_cart(cart_id, self.first_product)
+        with redirect_stdout(io.StringIO()):
+            marketplace.place_order(cart_id)
+        self.assertEqual(marketplace.cart_stats(),
+                         {"opened": 1, "placed": 1, "abandoned": 0, "live": 0})
+        self.assertEqual(marketplace.new_cart(), cart_id)
+        self.assertRaises(KeyError, marketplace.add_to_cart, 7, self.first_product, block=True)
+
+    def test_abandoned_cart_returns_its_units(self):
+        """
+        testing that abandon_cart puts the units back on the shelves
+        """
+        marketplace = self.make_marketplace(3)
+        marketplace.register_producer()
+        marketplace.publish_many("0", self.first_product, 2)
+        cart_id = marketplace.new_cart()
+        marketplace.add_to_cart(cart_id, self.first_product, 2)
+        self.assertEqual(marketplace.abandon_cart(cart_id), 2)
+        self.assertEqual(marketplace.stock(self.first_product), {0: 2})
+        self.assertEqual(marketplace.size[0], 2)
+        self.assertEqual(marketplace.cart_list, {})
+
+    def test_reaper_abandons_idle_carts(self):
+        """
+        testing that the reaper abandons an idle cart but not a waiting one
+        """
+        marketplace = self.make_marketplace(3, cart_idle_timeout=0.01)
+        marketplace.register_producer()
+        marketplace.publish("0", self.first_product)
+        idle, waiting = marketplace.new_cart(), marketplace.new_cart()
+        marketplace.add_to_cart(idle, self.first_product)
+        self.assertFalse(marketplace.add_to_cart(waiting, Tea("green", 3, "cold"),
+                                                 block=True, timeout=0.1))
+        self.assertEqual(marketplace.stock(self.first_product), {0: 1})
+        self.assertRaises(KeyError, marketplace.add_to_cart, idle, self.first_product)
+        self.assertEqual(marketplace.cart_stats()["abandoned"], 1)
+        marketplace.shutdown()
+
+    def test_placed_cart_is_not_reaped(self):
+        """
+        testing that an order placed while the reaper runs releases the cart once
+        """
+        marketplace = self.make_marketplace(200, cart_idle_timeout=0.001)
+        marketplace.register_producer()
+        for _ in range(200):
+            marketplace.publish("0", self.first_product)
+            cart_id = marketplace.new_cart()
+            try:
+                marketplace.add_to_cart(cart_id, self.first_product)
+                time.sleep(0.001)
+                with redirect_stdout(io.StringIO()):
+                    marketplace.place_order(cart_id)
+            except KeyError:
+                pass  # reaped first, its unit is back on the shelf
+        marketplace.shutdown()
+        stats = marketplace.cart_stats()
+        self.assertEqual(stats["placed"] + stats["abandoned"], 200)
+        sold = sum(marketplace.fulfillment.ledger()["sold"].values())
+        self.assertEqual(sold, stats["placed"])
+        self.assertEqual(sold + marketplace.size[0], 200)
+
+if __name__ == '__main__':
+    unittest.main()
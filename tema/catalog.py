@@ -0,0 +1,88 @@
+"""
+This module interns the Products to small integer ids.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import threading
+import unittest
+
+from tema.product import Coffee, Tea
+
+
+class ProductCatalog:
+    """
+    Gives every distinct product a small integer id, so the marketplace can
+    index its stock and carts by id instead of hashing and comparing products
+    field by field. Looking up an object that was interned before costs a
+    single dict lookup by identity.
+    """
+
+    # bound of the identity cache, for callers that keep building equal products
+    MAX_IDENTITIES = 4096
+
+    def __init__(self):
+        self.products = []
+        self.ids = {}
+        # id(product object) -> (product object, product id); keeping the object
+        # referenced guarantees its id() is not reused by another object
+        self.identities = {}
+        self.lock = threading.Lock()
+
+    def intern(self, product):
+        """
+        Returns the id of product, giving it the next free id the first time
+        an equal product is seen.
+
+        :type product: Product
+        :param product: the product to intern
+        """
+        entry = self.identities.get(id(product))
+        if entry is not None and entry[0] is product:
+            return entry[1]
+
+        product_id = self.ids.get(product)
+        if product_id is None:
+            with self.lock:
+                product_id = self.ids.get(product)
+                if product_id is None:
+                    product_id = len(self.products)
+                    self.products.append(product)
+                    self.ids[product] = product_id
+        if len(self.identities) < self.MAX_IDENTITIES:
+            self.identities[id(product)] = (product, product_id)
+        return product_id
+
+    def product(self, product_id):
+        """
+        Returns the product with the given id.
+        """
+        return self.products[product_id]
+
+    def __len__(self):
+        return len(self.products)
+
+
+class TestProductCatalog(unittest.TestCase):
+    """
+    unittest class
+    """
+    def test_equal_products_share_an_id(self):
+        """
+        testing that equal products get the same id and different ones do not
+        """
+        catalog = ProductCatalog()
+        tea = Tea("Linden", 9, "Herbal")
+        coffee = Coffee("Arabica", 10, 5.1, "MEDIUM")
+        self.assertEqual(catalog.intern(tea), 0)
+        self.assertEqual(catalog.intern(coffee), 1)
+        self.assertEqual(catalog.intern(Tea("Linden", 9, "Herbal")), 0)
+        self.assertEqual(catalog.intern(tea), 0)
+        self.assertIs(catalog.product(1), coffee)
+        self.assertEqual(len(catalog), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
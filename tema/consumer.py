@@ -7,19 +7,21 @@ March 2021
 """
 
 from threading import Thread
-import time
+
+from tema.hooks import agent_hooks
 
 class Consumer(Thread):
     """
     Class that represents a consumer.
     """
 
-    def __init__(self, carts, marketplace, retry_wait_time, **kwargs):
+    def __init__(self, carts, marketplace, retry_wait_time, sleep=None, **kwargs):
         """
         Constructor.
 
         :type carts: List
-        :param carts: a list of add and remove operations
+        :param carts: a list of add and remove operations, or an iterable of
+        them that is read once, like the carts of tema.scenario
 
         :type marketplace: Marketplace
         :param marketplace: a reference to the marketplace
@@ -28,45 +30,60 @@ class Consumer(Thread):
         :param retry_wait_time: the number of seconds that a producer must wait
         until the Marketplace becomes available
 
+        :type sleep: Function
+        :param sleep: waits the given number of seconds, like time.sleep; with it
+        a product out of stock is retried after sleeping instead of blocking in
+        the marketplace, so a simulation can run the consumer on a virtual
+        clock, see tema.simulation
+
         :type kwargs:
         :param kwargs: other arguments that are passed to the Thread's __init__()
         """
         self.carts = carts
         self.marketplace = marketplace
         self.retry_wait_time = retry_wait_time
+        self.sleep = sleep
 
         Thread.__init__(self, **kwargs)
 
-    def check_code(self, code, iteration):
+    def run(self):
         """
-        check if there is need for delay
+        generate carts for that size
         """
-        if code is True:
-            iteration = iteration + 1
-        else:
-            time.sleep(self.retry_wait_time)
-        return iteration
+        buy = self.buy
+        hooks = agent_hooks(self.marketplace)
+        if hooks is not None:
+            buy = hooks.wrap(buy, "consumer.cart")
+        for cart in self.carts:
+            buy(cart)
 
-    def run(self):
+    def buy(self, cart):
         """
-        generate carts for that size
+        Buys one cart, waiting for the products that are out of stock.
         """
-        for i in range(len(self.carts)):
-            id_cart = self.marketplace.new_cart()
-            for command in self.carts[i]:
-                my_type = command["type"]
-                quantity = command["quantity"]
-                my_product = command["product"]
+        # fast path: the whole cart is in stock and is bought in one transaction
+        if self.marketplace.checkout(cart, name=self.name) is not None:
+            return
+
+        id_cart = self.marketplace.new_cart()
+        for command in cart:
+            my_type = command["type"]
+            quantity = command["quantity"]
+            my_product = command["product"]
+            # checks what type of command we have and then we do that
+            if my_type == "add":
+                # block until restocks hand us the missing units, re-checking
+                # every retry_wait_time seconds instead of sleeping blindly
                 iteration = 0
-				# checks what type of command we have and then we do that
-                if my_type == "add":
-                    while iteration < quantity:
-                        code = self.marketplace.add_to_cart(id_cart, my_product)
-                        iteration = Consumer.check_code(self, code, iteration)
-
-                elif my_type == "remove":
-                    while iteration < quantity:
-                        code = self.marketplace.remove_from_cart(id_cart, my_product)
-                        iteration = Consumer.check_code(self, code, iteration)
-
-            self.marketplace.place_order(id_cart)
+                while iteration < quantity:
+                    iteration += self.marketplace.add_to_cart(id_cart, my_product,
+                                                              quantity - iteration,
+                                                              block=self.sleep is None,
+                                                              timeout=self.retry_wait_time)
+                    if iteration < quantity and self.sleep is not None:
+                        self.sleep(self.retry_wait_time)
+
+            elif my_type == "remove":
+                self.marketplace.remove_from_cart(id_cart, my_product, quantity)
+
+        self.marketplace.place_order(id_cart, self.name)
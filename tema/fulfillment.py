@@ -0,0 +1,200 @@
+"""
+This module fulfills the orders placed in the Marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import queue
+import threading
+import unittest
+from collections import Counter
+
+from tema.logger import get_logger
+from tema.product import Tea
+from tema.sinks import MemorySink, PrintSink
+
+
+class Fulfillment:
+    """
+    The stage after place_order: writes the receipt of every order to the
+    sink, logs it and records it in the ledger. With workers, place_order only
+    queues the sealed order and the worker threads do the rest, so consumers
+    go back to shopping right away; without workers every order is fulfilled
+    by the thread that placed it.
+    """
+    def __init__(self, sink=None, workers=0):
+        """
+        Constructor
+
+        :type sink: PrintSink
+        :param sink: where the receipts are written, see tema.sinks
+
+        :type workers: Int
+        :param workers: the number of worker threads, 0 to fulfill in place_order
+        """
+        self.sink = PrintSink() if sink is None else sink
+        self.log = get_logger()
+        self.lock = threading.Lock()
+        # product -> units sold
+        self.sold = Counter()
+        self.orders = 0
+        self.revenue = 0
+        # orders a worker could not fulfill, logged with their error
+        self.failed = 0
+        self.joined = False
+
+        self.queue = queue.Queue()
+        self.workers = [threading.Thread(target=self._work, name="fulfillment-%d" % index,
+                                         daemon=True)
+                        for index in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, name, products):
+        """
+        Fulfills the order, or queues it for the workers.
+
+        :type name: String
+        :param name: the buyer
+
+        :type products: List
+        :param products: the products bought
+        """
+        if self.workers:
+            self.queue.put((name, products))
+        else:
+            self._fulfill(name, products)
+
+    def _fulfill(self, name, products):
+        """
+        Writes, logs and records one order.
+        """
+        self.sink.write(name, products)
+        self.log.info("Placed order from cart and got the list-> %s.", tuple(products))
+        with self.lock:
+            self.sold.update(products)
+            self.orders += 1
+            self.revenue += sum(product.price for product in products)
+
+    def _work(self):
+        """
+        Body of a worker thread, which runs until it takes None off the queue.
+        """
+        while True:
+            order = self.queue.get()
+            try:
+                if order is None:
+                    return
+                self._fulfill(*order)
+            except Exception:  # pylint: disable=broad-except
+                # the worker must survive a bad order, or the next ones are lost
+                self.log.exception("Failed to fulfill the order of %s.", order[0])
+                with self.lock:
+                    self.failed += 1
+            finally:
+                self.queue.task_done()
+
+    def ledger(self):
+        """
+        Returns the number of orders, the revenue and the units sold of every
+        product, for the orders fulfilled so far, and the number of orders the
+        workers failed to fulfill.
+        """
+        with self.lock:
+            return {"orders": self.orders, "revenue": self.revenue, "sold": dict(self.sold),
+                    "failed": self.failed}
+
+    def flush(self):
+        """
+        Waits until every order queued so far is fulfilled and its receipt written.
+        """
+        self.queue.join()
+        self.sink.flush()
+
+    def join(self):
+        """
+        Fulfills the queued orders, stops the workers and closes the sink; the
+        calls after the first one do nothing.
+        """
+        with self.lock:
+            if self.joined:
+                return
+            self.joined = True
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.sink.close()
+
+
+class TestFulfillment(unittest.TestCase):
+    """
+    unittest class
+    """
+    def test_workers_fulfill_the_queued_orders(self):
+        """
+        testing that every queued order is written and recorded
+        """
+        sink = MemorySink()
+        fulfillment = Fulfillment(sink, workers=2)
+        tea = Tea("Linden", 9, "Herbal")
+        for index in range(10):
+            fulfillment.submit("cons%d" % index, [tea, tea])
+        fulfillment.flush()
+        self.assertEqual(len(sink.lines()), 20)
+        self.assertEqual(fulfillment.ledger(), {"orders": 10, "revenue": 180, "sold": {tea: 20},
+                                                "failed": 0})
+        fulfillment.join()
+
+    def test_worker_survives_a_failing_order(self):
+        """
+        testing that an order that raises is counted and the next one fulfilled
+        """
+        class FailingSink(MemorySink):
+            """
+            fails the orders of cons0
+            """
+            def write(self, name, products):
+                if name == "cons0":
+                    raise OSError("disk full")
+                super().write(name, products)
+
+        sink = FailingSink()
+        fulfillment = Fulfillment(sink, workers=1)
+        tea = Tea("Linden", 9, "Herbal")
+        fulfillment.submit("cons0", [tea])
+        fulfillment.submit("cons1", [tea])
+        fulfillment.flush()
+        self.assertEqual(sink.lines(), ["cons1 bought " + str(tea)])
+        self.assertEqual(fulfillment.ledger()["failed"], 1)
+        fulfillment.join()
+
+    def test_join_twice(self):
+        """
+        testing that a second join returns at once and closes the sink only once
+        """
+        class CountingSink(MemorySink):
+            """
+            counts the calls to close
+            """
+            closes = 0
+
+            def close(self):
+                """
+                counts the call instead of closing
+                """
+                self.closes += 1
+
+        sink = CountingSink()
+        fulfillment = Fulfillment(sink, workers=2)
+        fulfillment.submit("cons1", [Tea("Linden", 9, "Herbal")])
+        fulfillment.join()
+        fulfillment.join()
+        self.assertEqual(len(sink.lines()), 1)
+        self.assertEqual(sink.closes, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
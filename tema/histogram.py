@@ -0,0 +1,170 @@
+"""
+This module records latencies in a histogram with bounded relative error.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+The buckets follow the layout of an HDR histogram: values below
+2 * sub_bucket_half are counted exactly, and every further power of two is
+split into sub_bucket_half buckets of equal width, so a recorded value is
+off by less than 1 / sub_bucket_half of itself whatever its magnitude. The
+memory used grows with the logarithm of the largest value, not with the
+number of values recorded.
+"""
+
+import math
+import random
+import unittest
+
+
+class Histogram:
+    """
+    Counts non-negative integer values, e.g. latencies in nanoseconds, keeping
+    significant_figures decimal digits of precision.
+    """
+    def __init__(self, significant_figures=2):
+        """
+        Constructor
+
+        :type significant_figures: Int
+        :param significant_figures: the number of decimal digits kept, from 1 to 5
+        """
+        if not 1 <= significant_figures <= 5:
+            raise ValueError("significant_figures must be between 1 and 5")
+        self.significant_figures = significant_figures
+        self.sub_bucket_bits = math.ceil(math.log2(10 ** significant_figures)) + 1
+        self.sub_bucket_half = 1 << (self.sub_bucket_bits - 1)
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        """
+        Returns the index of the bucket that counts value.
+        """
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return shift * self.sub_bucket_half + (value >> shift)
+
+    def _highest_value(self, index):
+        """
+        Returns the largest value counted by the bucket at index.
+        """
+        if index < 2 * self.sub_bucket_half:
+            return index
+        shift = index // self.sub_bucket_half - 1
+        top = index - shift * self.sub_bucket_half
+        return ((top + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        """
+        Records count occurrences of value.
+
+        :type value: Int
+        :param value: a non-negative integer
+        """
+        if value < 0:
+            raise ValueError("cannot record a negative value")
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Adds the counts of another histogram with the same precision to this one.
+        """
+        if other.sub_bucket_bits != self.sub_bucket_bits:
+            raise ValueError("cannot merge histograms of different precision")
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        """
+        Returns the exact mean of the recorded values, 0 if there are none.
+        """
+        return self.total / self.count if self.count else 0
+
+    def value_at_percentile(self, percentile):
+        """
+        Returns the value that percentile percent of the recorded values do
+        not exceed, rounded up to the end of its bucket but never above the
+        largest recorded value. Returns 0 if nothing was recorded.
+
+        :type percentile: Float
+        :param percentile: from 0 to 100
+        """
+        if not self.count:
+            return 0
+        wanted = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+
+class TestHistogram(unittest.TestCase):
+    """
+    unittest class
+    """
+    def test_small_values_are_exact(self):
+        """
+        testing that values below the first power of two split are counted exactly
+        """
+        histogram = Histogram(2)
+        for value in range(100):
+            histogram.record(value)
+        self.assertEqual(histogram.value_at_percentile(50), 49)
+        self.assertEqual(histogram.value_at_percentile(100), 99)
+        self.assertEqual(histogram.mean(), 49.5)
+
+    def test_relative_error_is_bounded(self):
+        """
+        testing that percentiles of large values stay within the precision
+        """
+        rng = random.Random(0)
+        values = sorted(int(rng.lognormvariate(12, 2)) for _ in range(10000))
+        histogram = Histogram(2)
+        for value in values:
+            histogram.record(value)
+        for percentile in (50, 90, 99, 99.9):
+            exact = values[math.ceil(percentile / 100 * len(values)) - 1]
+            self.assertLessEqual(abs(histogram.value_at_percentile(percentile) - exact),
+                                 exact / 100)
+        self.assertEqual(histogram.value_at_percentile(100), values[-1])
+
+    def test_merge(self):
+        """
+        testing that merging two histograms equals recording into one
+        """
+        first, second, both = Histogram(), Histogram(), Histogram()
+        for value in range(0, 100000, 7):
+            (first if value % 2 else second).record(value)
+            both.record(value)
+        first.merge(second)
+        self.assertEqual(first.counts, both.counts)
+        self.assertEqual((first.count, first.min, first.max), (both.count, both.min, both.max))
+
+
+if __name__ == '__main__':
+    unittest.main()
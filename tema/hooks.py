@@ -0,0 +1,184 @@
+"""
+This module lets tracing code run before and after the operations of the
+Marketplace, the Producers and the Consumers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+A marketplace starts without hooks and its methods are the plain ones; the
+first Marketplace.add_hook replaces the hooked methods of that instance by
+wrappers, and Producer.run and Consumer.run only wrap their batches and carts
+if the marketplace has hooks when they start, so nothing is paid until a
+hook is installed.
+"""
+
+import functools
+import threading
+import unittest
+
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+# the Marketplace methods that run the hooks, wait_closed being the producers' sleep
+MARKETPLACE_OPERATIONS = ("register_producer", "publish", "publish_many", "new_cart",
+                          "add_to_cart", "remove_from_cart", "checkout", "place_order",
+                          "abandon_cart", "shutdown", "wait_closed")
+
+
+class Hook:
+    """
+    Base class of the hooks, whose methods do nothing. They are called in the
+    thread that runs the operation, with the arguments it was called with.
+    """
+    def before(self, operation, args, kwargs):
+        """
+        Called before the operation starts.
+
+        :type operation: String
+        :param operation: a Marketplace method, "producer.batch" or "consumer.cart"
+        """
+
+    def after(self, operation, args, kwargs, result):
+        """
+        Called after the operation returned result.
+        """
+
+    def raised(self, operation, args, kwargs, error):
+        """
+        Called instead of after if the operation raised error.
+        """
+
+
+class Hooks:
+    """
+    The hooks installed on one marketplace. It is false while empty.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.installed = ()
+        self.wrapped = False
+
+    def __bool__(self):
+        return bool(self.installed)
+
+    def install(self, hook):
+        """
+        Adds a hook; the operations that already started do not call it.
+        """
+        with self.lock:
+            self.installed = self.installed + (hook,)
+
+    def remove(self, hook):
+        """
+        Removes a hook installed before.
+        """
+        with self.lock:
+            installed = list(self.installed)
+            installed.remove(hook)
+            self.installed = tuple(installed)
+
+    def wrap_methods(self, instance, names):
+        """
+        Replaces the named methods of the instance by wrappers, the first time
+        it is called.
+        """
+        with self.lock:
+            if self.wrapped:
+                return
+            for name in names:
+                setattr(instance, name, self.wrap(getattr(instance, name), name))
+            self.wrapped = True
+
+    def wrap(self, function, operation):
+        """
+        Returns a wrapper of function that runs the installed hooks around it.
+        """
+        @functools.wraps(function)
+        def hooked(*args, **kwargs):
+            # the tuple is replaced, never changed, so this is a consistent snapshot
+            installed = self.installed
+            for hook in installed:
+                hook.before(operation, args, kwargs)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                for hook in installed:
+                    hook.raised(operation, args, kwargs, error)
+                raise
+            for hook in installed:
+                hook.after(operation, args, kwargs, result)
+            return result
+        return hooked
+
+
+def agent_hooks(marketplace):
+    """
+    Returns the hooks of the marketplace of a producer or consumer, or None if
+    there are none, e.g. for a MarketplaceClient.
+    """
+    hooks = getattr(marketplace, "hooks", None)
+    return hooks if hooks else None
+
+
+class TestHooks(unittest.TestCase):
+    """
+    unittest class
+    """
+    class Recorder(Hook):
+        """
+        records every call
+        """
+        def __init__(self):
+            self.events = []
+
+        def before(self, operation, args, kwargs):
+            self.events.append(("before", operation))
+
+        def after(self, operation, args, kwargs, result):
+            self.events.append(("after", operation, result))
+
+    def setUp(self):
+        """
+        initialization
+        """
+        # imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.marketplace = Marketplace(2, sink=MemorySink())
+        self.product = Tea("Linden", 9, "Herbal")
+
+    def test_no_hook_leaves_the_methods_alone(self):
+        """
+        testing that the methods are only wrapped once a hook is installed
+        """
+        self.assertNotIn("add_to_cart", vars(self.marketplace))
+        self.marketplace.add_hook(Hook())
+        self.assertIn("add_to_cart", vars(self.marketplace))
+
+    def test_marketplace_and_agent_operations_are_hooked(self):
+        """
+        testing the events of a consumer buying one cart
+        """
+        # imported here, like Marketplace
+        from tema.consumer import Consumer  # pylint: disable=import-outside-toplevel
+        recorder = self.Recorder()
+        self.marketplace.add_hook(recorder)
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, self.product)
+        cart = [{"type": "add", "product": self.product, "quantity": 1}]
+        Consumer([cart], self.marketplace, 0.1, name="cons1").run()
+
+        self.assertEqual(recorder.events[:4], [("before", "register_producer"),
+                                               ("after", "register_producer", producer_id),
+                                               ("before", "publish"),
+                                               ("before", "publish_many")])
+        self.assertIn(("before", "consumer.cart"), recorder.events)
+        self.assertEqual(recorder.events[-1], ("after", "consumer.cart", None))
+
+        self.marketplace.hooks.remove(recorder)
+        self.marketplace.new_cart()
+        self.assertEqual(recorder.events[-1], ("after", "consumer.cart", None))
+
+
+if __name__ == '__main__':
+    unittest.main()
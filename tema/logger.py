@@ -0,0 +1,85 @@
+"""
+This module configures the Marketplace's logging.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOGGER_NAME = 'marketplace.log'
+LOG_FILE = 'marketplace.log'
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the formatting to the background writer, so the
+    logging thread only pays for building the record. The arguments of the log
+    calls must therefore be immutable, e.g. products and ids, not carts.
+    """
+    def prepare(self, record):
+        return record
+
+
+class _Writer:
+    """
+    The background writer shared by every Marketplace.
+    """
+    lock = threading.Lock()
+    listener = None
+
+    @classmethod
+    def start(cls, log):
+        """
+        Attaches a queue to the logger and starts the thread that writes the
+        queued records to the rotating log file, the first time it is called.
+        """
+        with cls.lock:
+            if cls.listener is not None:
+                return
+            formatter = logging.Formatter('%(asctime)s %(levelname)8s: %(message)s')
+            formatter.converter = time.gmtime
+            file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=50000,
+                                                                backupCount=10)
+            file_handler.setFormatter(formatter)
+
+            records = queue.SimpleQueue()
+            cls.listener = logging.handlers.QueueListener(records, file_handler)
+            cls.listener.start()
+            atexit.register(cls.listener.stop)
+
+            log.addHandler(_DeferredQueueHandler(records))
+            log.propagate = False
+            if log.level == logging.NOTSET:
+                log.setLevel(logging.INFO)
+
+
+def get_logger():
+    """
+    Returns the marketplace logger. The first call attaches a queue to it and
+    starts the background thread that writes the queued records to the rotating
+    log file, so every Marketplace shares a single handler.
+    """
+    log = logging.getLogger(LOGGER_NAME)
+    _Writer.start(log)
+    return log
+
+
+def set_level(level):
+    """
+    Changes the level of the marketplace logger at runtime. The per-operation
+    traces are logged at DEBUG, so below INFO they are skipped before any
+    formatting happens.
+
+    :type level: Int or String
+    :param level: a logging level, like logging.DEBUG or "DEBUG"
+    """
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    logging.getLogger(LOGGER_NAME).setLevel(level)
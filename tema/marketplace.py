@@ -6,49 +6,134 @@ Assignment 1
 March 2021
 """
 
-import logging
 import time
-import logging.handlers
 import unittest
-from threading import currentThread
 import threading
+from collections import deque
+from tema.carts import CartLifecycleMixin
+from tema.catalog import ProductCatalog
+from tema.fulfillment import Fulfillment
+from tema.hooks import MARKETPLACE_OPERATIONS, Hooks
+from tema.logger import get_logger
+from tema.metrics import Metrics
 from tema.product import Tea
 
-class Marketplace:
+
+class _Waiter:
+    """
+    A consumer blocked in add_to_cart, waiting for units to be handed to its cart.
+    """
+    def __init__(self, cart_id, wanted):
+        self.cart_id = cart_id
+        self.wanted = wanted
+        self.received = 0
+        self.event = threading.Event()
+
+
+class _Stripe:
+    """
+    One shard of the inventory: every product whose id maps to this stripe
+    keeps its stock, its waiting consumers and its blocked producers here,
+    all guarded by the stripe's lock. Products are keyed by their catalog id.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # product id -> {producer_id: units of that product on the producer's shelf}
+        self.inventory = {}
+        # product id -> FIFO of _Waiter, consumers blocked until the product is restocked
+        self.waiters = {}
+        # product id -> ids of the producers blocked in publish with that product
+        self.blocked_publishers = {}
+
+
+class Marketplace(CartLifecycleMixin):
     """
     Class that represents the Marketplace. It's the central part of the implementation.
     The producers and consumers use its methods concurrently.
+
+    Products are interned by a ProductCatalog: the stock and the carts are
+    keyed by product id, and a cart only counts the units it holds of every
+    product, by producer.
+
+    Locking: the inventory is split in lock_stripes stripes by product id, so
+    operations on different products rarely contend. Each producer's size
+    counter is guarded by the lock of its slot_freed condition. The lock
+    ordering is stripe locks -> producer lock / restocked lock: a stripe lock
+    is never taken while holding a producer lock or the restocked lock, and
+    several stripe locks are only held together by checkout, which takes them
+    in ascending stripe index. mutex_qsize guards producer registration and
+    mutex_cart the cart ids and the set of live carts; it is taken after the
+    stripe locks and nothing else is locked while holding it. A cart is only
+    changed by its consumer, or by a hand-off while that consumer is blocked
+    waiting for it.
+
+    Carts are released when their order is placed or they are abandoned, so
+    cart_list only holds the live carts. With cart_idle_timeout, a reaper
+    thread abandons the carts nobody used for that long, putting their units
+    back on the shelves; see tema.carts.
     """
-    def __init__(self, queue_size_per_producer):
+    def __init__(self, queue_size_per_producer, lock_stripes=16, recycle_cart_ids=False,
+                 cart_idle_timeout=None, sink=None, fulfillment_workers=0, metrics=False):
         """
         Constructor
 
         :type queue_size_per_producer: Int
         :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type lock_stripes: Int
+        :param lock_stripes: the number of locks the inventory is sharded over
+
+        :type recycle_cart_ids: Bool
+        :param recycle_cart_ids: give the ids of released carts to new carts, so the
+        ids stay small; a consumer must then not use a cart id after releasing it
+
+        :type cart_idle_timeout: Float
+        :param cart_idle_timeout: the number of seconds after which an unused cart
+        is abandoned by the reaper thread, None to keep carts until they are released
+
+        :type sink: PrintSink
+        :param sink: where the placed orders are written, see tema.sinks; by
+        default they are printed right away
+
+        :type fulfillment_workers: Int
+        :param fulfillment_workers: the number of threads that write, log and record
+        the placed orders, see tema.fulfillment; 0 to do it in place_order
+
+        :type metrics: Bool
+        :param metrics: time the public methods and the locks, see stats and
+        tema.metrics; without it the marketplace pays nothing for them
         """
         self.queue_size_per_producer = queue_size_per_producer
         self.id_producer = 0
         self.size = {}
+        # producer_id -> Condition guarding size[producer_id], notified when a slot frees up
+        self.slot_freed = {}
+
+        self.catalog = ProductCatalog()
+        self.stripes = [_Stripe() for _ in range(lock_stripes)]
 
-        self.product_list = list()
-        self.producer_list = {}
+        self._init_carts(recycle_cart_ids, cart_idle_timeout)
 
-        self.cart_list = {}
-        self.id_carts = 0
+        self.closed = threading.Event()
+
+        # notified when units go back on a shelf while checkouts are waiting for stock
+        self.restocked = threading.Condition(threading.Lock())
+        self.restock_generation = 0
+        self.checkout_waiters = 0
 
         self.mutex_qsize = threading.Lock()
-        self.mutex_addcart = threading.Lock()
-        self.mutex_cart = threading.Lock()
-        self.mutex_printing = threading.Lock()
-
-        logging.Formatter.converter = time.gmtime
-        formatter = logging.Formatter('%(asctime)s %(levelname)8s: %(message)s')
-        self.log = logging.basicConfig(filename='marketplace.log', level=logging.INFO)
-        self.log = logging.getLogger('marketplace.log')
-        my_handler = logging.handlers.RotatingFileHandler('marketplace.log',
-			maxBytes=50000, backupCount=10)
-        my_handler.setFormatter(formatter)
-        self.log.addHandler(my_handler)
+        self.fulfillment = Fulfillment(sink, fulfillment_workers)
+
+        # queued, written by a background thread; see tema.logger.set_level
+        self.log = get_logger()
+
+        self.hooks = Hooks()
+        self.metrics = None
+        if metrics:
+            self.metrics = Metrics()
+            self.metrics.instrument(self)
+
+        self._start_reaper()
 
     def register_producer(self):
         """
@@ -56,12 +141,30 @@ class Marketplace:
         """
 
         self.log.info("Register new producer loading.")
-        self.id_producer = self.id_producer + 1
-        self.size[self.id_producer - 1] = 0  #queue size for producs
-        self.log.info("Registered new producer with id %d", self.id_producer - 1)
-        return self.id_producer - 1
+        with self.mutex_qsize:
+            producer_id = self.id_producer
+            self.id_producer = self.id_producer + 1
+            self.size[producer_id] = 0  #queue size for producs
+            self.slot_freed[producer_id] = threading.Condition(threading.Lock())
+        self.log.info("Registered new producer with id %d", producer_id)
+        return producer_id
+
+    def stripe_for(self, product):
+        """
+        Returns the inventory stripe that holds the given product.
+        """
+        return self.stripes[self.catalog.intern(product) % len(self.stripes)]
+
+    def stock(self, product):
+        """
+        Returns a snapshot of the units of product on the shelves, by producer id.
+        """
+        product_id = self.catalog.intern(product)
+        stripe = self.stripes[product_id % len(self.stripes)]
+        with stripe.lock:
+            return dict(stripe.inventory.get(product_id, {}))
 
-    def publish(self, producer_id, product):
+    def publish(self, producer_id, product, block=False, timeout=None):
         """
         Adds the product provided by the producer to the marketplace
 
@@ -71,40 +174,148 @@ class Marketplace:
         :type product: Product
         :param product: the Product that will be published in the Marketplace
 
+        :type block: Bool
+        :param block: if the producer's queue is full, wait until add_to_cart frees
+        one of its slots, a consumer starts waiting for the product or the
+        marketplace is shut down
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None for no limit
+
         :returns True or False. If the caller receives False, it should wait and then try again.
         """
+        return self.publish_many(producer_id, product, 1, block, timeout) == 1
 
-		# check if there is room for a new product and then adds it to the list
-        self.log.info("Publish new product %s loading.", str(product))
+    def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace,
+        as many as fit in the producer's queue, in a single critical section.
 
-        if self.size[int(producer_id)] is not self.queue_size_per_producer:
-            self.size[int(producer_id)] += 1
-            self.product_list.append(product)
-            self.producer_list[product] = int(producer_id)
-            self.log.info("Product %s was not published.", str(product))
-            return True
+        :type producer_id: String
+        :param producer_id: producer id
+
+        :type product: Product
+        :param product: the Product that will be published in the Marketplace
 
-        self.log.info("Product %s was not published.", str(product))
-        return False
+        :type quantity: Int
+        :param quantity: the number of units to publish
+
+        :type block: Bool
+        :param block: wait for free slots until every unit is published, see publish
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None for no limit
+
+        :returns the number of units published
+        """
+        producer_id = int(producer_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        product_id = self.catalog.intern(product)
+        stripe = self.stripes[product_id % len(self.stripes)]
+        slot_freed = self.slot_freed[producer_id]
+        published = 0
+
+		# units go to waiting carts first, the rest to the free slots of the producer's queue
+        while True:
+            with stripe.lock:
+                published += self._hand_off(stripe, product_id, producer_id,
+                                            quantity - published)
+                if published < quantity:
+                    with slot_freed:
+                        room = min(quantity - published,
+                                   self.queue_size_per_producer - self.size[producer_id])
+                        if room > 0:
+                            self.size[producer_id] += room
+                    if room > 0:
+                        self._put_unit(stripe, product_id, producer_id, room)
+                        published += room
+                if published == quantity:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or self.closed.is_set() or (remaining is not None and remaining <= 0):
+                    break
+                stripe.blocked_publishers.setdefault(product_id, set()).add(producer_id)
+
+            self._wait_for_slot(stripe, producer_id, product_id, remaining)
+
+        self.log.debug("Published %d of %d units of product %s from producer %d.",
+                       published, quantity, product, producer_id)
+        return published
+
+    def _wait_for_slot(self, stripe, producer_id, product_id, timeout):
+        """
+        Parks a producer whose queue is full until it may be able to publish product:
+        one of its slots frees up, a consumer waits for product or the marketplace closes.
+        Must be called with no lock held, after registering in stripe.blocked_publishers.
+        """
+        slot_freed = self.slot_freed[producer_id]
+        with slot_freed:
+            slot_freed.wait_for(lambda: self.size[producer_id] < self.queue_size_per_producer
+                                or product_id in stripe.waiters or self.closed.is_set(),
+                                timeout)
+        with stripe.lock:
+            blocked = stripe.blocked_publishers[product_id]
+            blocked.discard(producer_id)
+            if not blocked:
+                del stripe.blocked_publishers[product_id]
+
+    def shutdown(self):
+        """
+        Marks the marketplace as closed and wakes up every blocked producer.
+        Blocked and later blocking publish calls return False instead of waiting.
+        """
+        self.log.info("Shutting down the marketplace.")
+        self.closed.set()
+        for slot_freed in list(self.slot_freed.values()):
+            with slot_freed:
+                slot_freed.notify_all()
 
-    def new_cart(self):
+    def is_closed(self):
+        """
+        Returns True once the marketplace is shut down.
         """
-        Creates a new cart for the consumer
+        return self.closed.is_set()
 
-        :returns an int representing the cart_id
+    def wait_closed(self, timeout):
         """
-        self.log.info("Add new cart loading.")
+        Sleeps for at most timeout seconds, waking up early if the marketplace shuts down.
 
-        self.mutex_cart.acquire()
-        self.id_carts = self.id_carts + 1
-        self.mutex_cart.release()
+        :returns True if the marketplace is closed
+        """
+        return self.closed.wait(timeout)
 
-        self.cart_list[self.id_carts] = list()  # queue for products from the cart
-        self.log.info("Added new cart with id %s.", self.id_carts)
+    def add_hook(self, hook):
+        """
+        Installs a hook that runs before and after the methods of this
+        marketplace, see tema.hooks. The first hook wraps the methods.
 
-        return self.id_carts
+        :type hook: Hook
+        :param hook: the hook
+        """
+        self.hooks.wrap_methods(self, MARKETPLACE_OPERATIONS)
+        self.hooks.install(hook)
 
-    def add_to_cart(self, cart_id, product):
+    def stats(self):
+        """
+        Returns a snapshot of the marketplace: the units on every producer's
+        shelf, the cart counters, the fulfillment ledger and, with metrics,
+        the calls, failures and latency of every public method and the wait
+        and hold times of the locks.
+        """
+        with self.mutex_qsize:
+            producer_ids = list(self.slot_freed)
+        shelves = {}
+        for producer_id in producer_ids:
+            with self.slot_freed[producer_id]:
+                shelves[producer_id] = self.size[producer_id]
+        ledger = self.fulfillment.ledger()
+        ledger["sold"] = {str(product): units for product, units in ledger["sold"].items()}
+        stats = {"shelves": shelves, "carts": self.cart_stats(), "ledger": ledger}
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot())
+        return stats
+
+    def add_to_cart(self, cart_id, product, quantity=1, block=False, timeout=None):
         """
         Adds a product to the given cart. The method returns
 
@@ -114,24 +325,69 @@ class Marketplace:
         :type product: Product
         :param product: the product to add to cart
 
-        :returns True or False. If the caller receives False, it should wait and then try again
-        """
-        self.log.info("Add to cart with id %d product %s.", cart_id, str(product))
+        :type quantity: Int
+        :param quantity: the number of units to add; if fewer are in stock,
+        the available ones are added
 
-        with self.mutex_addcart:
-            if product in self.product_list:  # check if the product is valid
-                self.cart_list[cart_id].append(product)
-                self.product_list.remove(product)  # remove it from the product lists
-                producer = self.producer_list[product]
-                self.size[producer] = self.size[producer] - 1
-                self.log.info("Succeded to add to cart with id %d product %s.",
-				cart_id, str(product))
-                return True
+        :type block: Bool
+        :param block: if the product is out of stock, wait until a publish or
+        remove_from_cart restocks it; waiting consumers are served in FIFO order
 
-        self.log.info("Failed to add to cart with id %d product %s.", cart_id, str(product))
-        return False
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None for no limit
 
-    def remove_from_cart(self, cart_id, product):
+        :returns the number of units added, so for one unit 1 or 0 work as True or False.
+        If the caller receives less than it asked for, it should wait and then try again
+        """
+        product_id = self.catalog.intern(product)
+        stripe = self.stripes[product_id % len(self.stripes)]
+        waiter = None
+
+        with self._in_use(cart_id):
+            with stripe.lock:
+                added = 0
+                stock = stripe.inventory.get(product_id)
+                # an unknown cart is an error only once something would go in it
+                if (stock or block) and cart_id not in self.cart_list:
+                    raise KeyError(cart_id)
+                while stock and added < quantity:  # take units while the product is on a shelf
+                    producer, units = self._take_unit(stripe, product_id, stock, quantity - added)
+                    self._fill_cart(cart_id, product_id, producer, units)
+                    added += units
+                    stock = stripe.inventory.get(product_id)
+                if block and added < quantity:
+                    waiter = _Waiter(cart_id, quantity - added)
+                    stripe.waiters.setdefault(product_id, deque()).append(waiter)
+                    # a producer stuck on a full queue can now hand this product off
+                    for producer in stripe.blocked_publishers.get(product_id, ()):
+                        slot_freed = self.slot_freed[producer]
+                        with slot_freed:
+                            slot_freed.notify()
+
+            if waiter is not None:
+                added += self._wait_for_unit(stripe, product_id, waiter, timeout)
+
+        self.log.debug("Added %d of %d units of product %s to cart with id %d.",
+                       added, quantity, product, cart_id)
+        return added
+
+    @staticmethod
+    def _wait_for_unit(stripe, product_id, waiter, timeout):
+        """
+        Blocks until the waiter's cart got all the units it wants or the timeout expires.
+
+        :returns the number of units handed to the waiter's cart
+        """
+        waiter.event.wait(timeout)
+        with stripe.lock:
+            if waiter.received < waiter.wanted:
+                queue = stripe.waiters[product_id]
+                queue.remove(waiter)
+                if not queue:
+                    del stripe.waiters[product_id]
+            return waiter.received
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
         """
         Removes a product from cart.
 
@@ -140,51 +396,237 @@ class Marketplace:
 
         :type product: Product
         :param product: the product to remove from cart
+
+        :type quantity: Int
+        :param quantity: the number of units to remove, at most the ones in the cart
+
+        :returns the number of units removed
+        """
+        product_id = self.catalog.intern(product)
+        stripe = self.stripes[product_id % len(self.stripes)]
+
+        with self._in_use(cart_id), stripe.lock:
+            removed = self._remove_units(stripe, cart_id, product_id, quantity)
+
+        self.log.debug("Removed %d of %d units of product %s from cart with id %d.",
+                       removed, quantity, product, cart_id)
+        return removed
+
+    def _remove_units(self, stripe, cart_id, product_id, quantity):
         """
-        self.log.info("Remove from cart with id %d product %s.", cart_id, str(product))
+        Takes at most quantity units of product out of the cart and gives them back
+        to the producers they came from, the last ones first.
+        Must be called with the product's stripe lock held.
 
-        if self.cart_list[cart_id] is not None:  # check if the cart is valid
-            if product in self.cart_list[cart_id]:  # check if the product is in the cart
+        :returns the number of units removed
+        """
+        cart = self.cart_list[cart_id]
+        origin = cart.get(product_id)
+        removed = 0
+        while origin and removed < quantity:
+            producer = next(reversed(origin))
+            units = min(quantity - removed, origin[producer])
+            if origin[producer] == units:
+                del origin[producer]
+                if not origin:
+                    del cart[product_id]
+            else:
+                origin[producer] -= units
+            removed += units
+            units -= self._hand_off(stripe, product_id, producer, units)
+            if units:
+                with self.slot_freed[producer]:
+                    self.size[producer] += units
+                self._put_unit(stripe, product_id, producer, units)
+        return removed
+
+    def _take_unit(self, stripe, product_id, stock, quantity):
+        """
+        Takes at most quantity units of product off the shelf of one of its producers.
+        Must be called with the product's stripe lock held.
 
-                self.mutex_qsize.acquire()
-                self.cart_list[cart_id].remove(product)  # remove it from the cart
-                producer = self.producer_list[product]  # add it back tp the products list
-                self.size[producer] = self.size[producer] + 1
-                self.product_list.append(product)
-                self.mutex_qsize.release()
-        self.log.info("Removed from cart with id %d product %s.", cart_id, str(product))
+        :returns the id of the producer the units came from and the number of units
+        """
+        producer = next(iter(stock))
+        units = min(quantity, stock[producer])
+        if stock[producer] == units:
+            del stock[producer]
+            if not stock:
+                del stripe.inventory[product_id]
+        else:
+            stock[producer] -= units
+        slot_freed = self.slot_freed[producer]
+        with slot_freed:
+            self.size[producer] -= units
+            slot_freed.notify()
+        return producer, units
+
+    def _put_unit(self, stripe, product_id, producer, units=1):
+        """
+        Puts units of product on the shelf of the given producer, whose size
+        the caller has already accounted for.
+        Must be called with the product's stripe lock held.
+        """
+        stock = stripe.inventory.setdefault(product_id, {})
+        stock[producer] = stock.get(producer, 0) + units
+        if self.checkout_waiters:
+            with self.restocked:
+                self.restock_generation += 1
+                self.restocked.notify_all()
+
+    def _fill_cart(self, cart_id, product_id, producer, units=1):
+        """
+        Puts units of product, coming from producer, in the cart.
+        Must be called with the product's stripe lock held.
+        """
+        origin = self.cart_list[cart_id].setdefault(product_id, {})
+        origin[producer] = origin.get(producer, 0) + units
 
-        return True
+    def _hand_off(self, stripe, product_id, producer, units):
+        """
+        Gives restocked units straight to the longest waiting consumers, if any.
+        These units never reach the shelf, so they do not take producer slots.
+        Must be called with the product's stripe lock held.
 
+        :returns the number of units handed off
+        """
+        queue = stripe.waiters.get(product_id)
+        handed = 0
+        while queue and handed < units:
+            waiter = queue[0]
+            given = min(units - handed, waiter.wanted - waiter.received)
+            self._fill_cart(waiter.cart_id, product_id, producer, given)
+            waiter.received += given
+            handed += given
+            self.log.debug("Handed %d units of product %s to cart with id %d.",
+                           given, self.catalog.products[product_id], waiter.cart_id)
+            if waiter.received == waiter.wanted:
+                queue.popleft()
+                waiter.event.set()
+        if queue is not None and not queue:
+            del stripe.waiters[product_id]
+        return handed
+
+    def checkout(self, cart_ops, block=False, timeout=None, name=None):
+        """
+        Fills a new cart with the net result of all the operations of one cart
+        and places the order, in a single transaction: either every unit is
+        reserved or the stock is left untouched.
+
+        :type cart_ops: List
+        :param cart_ops: the add and remove operations of the cart, as dicts
+        with the "type", "product" and "quantity" keys
+
+        :type block: Bool
+        :param block: wait until the whole cart can be satisfied at once
+
+        :type timeout: Float
+        :param timeout: the maximum number of seconds to block, None for no limit
 
+        :type name: String
+        :param name: the buyer, see place_order
 
-    def place_order(self, cart_id):
+        :returns the list of products bought, or None if the cart could not be satisfied
         """
-        Return a list with all the products in the cart.
+        wanted = {}
+        for operation in cart_ops:
+            product_id = self.catalog.intern(operation["product"])
+            if operation["type"] == "add":
+                wanted[product_id] = wanted.get(product_id, 0) + operation["quantity"]
+            elif operation["type"] == "remove":
+                wanted[product_id] = max(0, wanted.get(product_id, 0) - operation["quantity"])
+        wanted = {product_id: units for product_id, units in wanted.items() if units}
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        if block:
+            with self.restocked:
+                self.checkout_waiters += 1
+        try:
+            while True:
+                generation = self.restock_generation
+                cart_id = self._reserve(wanted)
+                if cart_id is not None:
+                    return self.place_order(cart_id, name)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or self.closed.is_set() or (remaining is not None and remaining <= 0):
+                    self.log.debug("Checkout of %d products failed.", len(wanted))
+                    return None
+                with self.restocked:
+                    self.restocked.wait_for(lambda: self.restock_generation != generation
+                                            or self.closed.is_set(), remaining)
+        finally:
+            if block:
+                with self.restocked:
+                    self.checkout_waiters -= 1
+
+    def _reserve(self, wanted):
+        """
+        Moves the wanted units of every product to a new cart if they are all in stock.
+
+        :type wanted: Dict
+        :param wanted: product id -> number of units
+
+        :returns the id of the new cart, or None if some product is short
+        """
+        # lock every stripe involved, in ascending index to respect the lock ordering
+        stripes = [self.stripes[index] for index
+                   in sorted({product_id % len(self.stripes) for product_id in wanted})]
+        for stripe in stripes:
+            stripe.lock.acquire()
+        try:
+            for product_id, units in wanted.items():
+                stock = self.stripes[product_id % len(self.stripes)].inventory.get(product_id, {})
+                if sum(stock.values()) < units:
+                    return None
+            cart_id = self.new_cart()
+            for product_id, units in wanted.items():
+                stripe = self.stripes[product_id % len(self.stripes)]
+                while units:
+                    producer, taken = self._take_unit(stripe, product_id,
+                                                      stripe.inventory[product_id], units)
+                    self._fill_cart(cart_id, product_id, producer, taken)
+                    units -= taken
+            return cart_id
+        finally:
+            for stripe in reversed(stripes):
+                stripe.lock.release()
+
+    def place_order(self, cart_id, name=None):
+        """
+        Return a list with all the products in the cart, release the cart and
+        pass the order on to the fulfillment stage.
 
         :type cart_id: Int
         :param cart_id: id cart
+
+        :type name: String
+        :param name: the buyer written to the sink for each product, by default
+        the name of the calling thread
         """
-        self.log.info("Place order from cart with id %s.", str(cart_id))
+        self.log.info("Place order from cart with id %s.", cart_id)
+        if name is None:
+            name = threading.current_thread().name
 
-        for product_in in self.cart_list[cart_id]:
-            self.mutex_printing.acquire()
-            print(currentThread().getName() + " bought " + str(product_in))  # print the details
-            self.mutex_printing.release()
-        self.log.info("Placed order from cart and got the list-> %s.", str(self.cart_list[cart_id]))
+        self._claim(cart_id)
+        products = self.cart_products(cart_id)
+        self._release_cart(cart_id, "placed")
+        self.fulfillment.submit(name, products)
 
-        return self.cart_list[cart_id]
+        return products
 
 
-class TestMarketplace(unittest.TestCase):
+class MarketplaceTestsMixin:
     """
-    unittest class
+    The unit tests of the Marketplace methods, mixed into a unittest.TestCase
+    per implementation, which sets marketplace_class to the class under test
     """
-    def setUp(self):
+    marketplace_class = None
+
+    def setUp(self):  # pylint: disable=invalid-name
         """
         initialization
         """
-        self.marketplace = Marketplace(3)
+        self.marketplace = self.marketplace_class(3)  # pylint: disable=not-callable
         self.first_product = Tea("tea", 5, "hot")
         self.list = []
         self.list.append(self.first_product)
@@ -236,6 +678,194 @@ class TestMarketplace(unittest.TestCase):
         self.marketplace.new_cart()
         self.marketplace.add_to_cart(1, self.first_product)
 
+    def test_equal_products_keep_their_producer(self):
+        """
+        testing that a returned unit goes back to the producer it came from
+        """
+        self.marketplace.register_producer()
+        self.marketplace.register_producer()
+        self.marketplace.publish("0", Tea("tea", 5, "hot"))
+        self.marketplace.publish("1", Tea("tea", 5, "hot"))
+        self.marketplace.new_cart()
+        self.marketplace.add_to_cart(1, self.first_product)
+        self.assertEqual(sum(self.marketplace.size.values()), 1)
+        taken = 0 if self.marketplace.size[1] == 1 else 1
+        self.marketplace.remove_from_cart(1, self.first_product)
+        self.assertEqual(self.marketplace.size[taken], 1)
+        self.assertEqual(self.marketplace.stock(self.first_product), {0: 1, 1: 1})
+
+    def test_publish_respects_queue_size(self):
+        """
+        testing that a full producer queue rejects publishing
+        """
+        self.marketplace.register_producer()
+        for _ in range(3):
+            self.assertTrue(self.marketplace.publish("0", self.first_product))
+        self.assertFalse(self.marketplace.publish("0", self.first_product))
+
+    def test_quantities_are_partially_filled(self):
+        """
+        testing publish_many and the quantity of add_to_cart and remove_from_cart
+        """
+        self.marketplace.register_producer()
+        self.assertEqual(self.marketplace.publish_many("0", self.first_product, 5), 3)
+        self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_to_cart(1, self.first_product, 5), 3)
+        self.assertEqual(self.marketplace.size[0], 0)
+        self.assertEqual(self.marketplace.remove_from_cart(1, self.first_product, 2), 2)
+        self.assertEqual(self.marketplace.remove_from_cart(1, self.first_product, 2), 1)
+        self.assertEqual(self.marketplace.stock(self.first_product), {0: 3})
+
+    def test_checkout_is_all_or_nothing(self):
+        """
+        testing that checkout reserves the whole cart or nothing
+        """
+        other_product = Tea("green", 3, "cold")
+        self.marketplace.register_producer()
+        self.marketplace.publish_many("0", self.first_product, 2)
+        cart_ops = [{"type": "add", "product": self.first_product, "quantity": 2},
+                    {"type": "add", "product": other_product, "quantity": 2},
+                    {"type": "remove", "product": other_product, "quantity": 1}]
+        self.assertIsNone(self.marketplace.checkout(cart_ops))
+        self.assertEqual(self.marketplace.stock(self.first_product), {0: 2})
+
+        self.marketplace.publish("0", other_product)
+        self.assertEqual(self.marketplace.checkout(cart_ops), self.list * 2 + [other_product])
+        self.assertEqual(self.marketplace.size[0], 0)
+
+
+class TestMarketplace(MarketplaceTestsMixin, unittest.TestCase):
+    """
+    unittest class
+    """
+    marketplace_class = Marketplace
+
+
+class TestMarketplaceBlocking(unittest.TestCase):
+    """
+    unittest class for the blocking calls, which rely on the in-process
+    Marketplace's hand-off and wake-up internals
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        self.marketplace = Marketplace(3)
+        self.first_product = Tea("tea", 5, "hot")
+        self.list = []
+        self.list.append(self.first_product)
+
+    def test_blocking_add_is_served_in_fifo_order(self):
+        """
+        testing that restocked units go to the longest waiting consumer
+        """
+        self.marketplace.register_producer()
+        first, second = self.marketplace.new_cart(), self.marketplace.new_cart()
+        results = {}
+        stripe = self.marketplace.stripe_for(self.first_product)
+        product_id = self.marketplace.catalog.intern(self.first_product)
+
+        def wait(cart_id):
+            results[cart_id] = self.marketplace.add_to_cart(cart_id, self.first_product,
+                                                            block=True, timeout=5)
+
+        waiting = []
+        for cart_id in (first, second):
+            waiting.append(threading.Thread(target=wait, args=(cart_id,)))
+            waiting[-1].start()
+            while len(stripe.waiters.get(product_id, ())) < len(waiting):
+                time.sleep(0.001)
+
+        self.marketplace.publish("0", self.first_product)
+        waiting[0].join()
+        self.assertEqual(self.marketplace.cart_products(first), self.list)
+        self.assertEqual(self.marketplace.size[0], 0)
+        self.assertEqual(self.marketplace.cart_products(second), [])
+
+        self.marketplace.remove_from_cart(first, self.first_product)
+        waiting[1].join()
+        self.assertEqual(results, {first: True, second: True})
+        self.assertEqual(self.marketplace.cart_products(second), self.list)
+
+    def test_blocking_add_times_out(self):
+        """
+        testing that a blocking add gives up after the timeout
+        """
+        self.marketplace.new_cart()
+        self.assertFalse(self.marketplace.add_to_cart(1, self.first_product,
+                                                      block=True, timeout=0.01))
+        self.assertEqual(self.marketplace.stripe_for(self.first_product).waiters, {})
+
+    def test_blocking_publish_waits_for_a_free_slot(self):
+        """
+        testing that a blocked producer publishes once add_to_cart frees a slot
+        """
+        self.marketplace.register_producer()
+        for _ in range(3):
+            self.marketplace.publish("0", self.first_product)
+        self.marketplace.new_cart()
+        producer = threading.Thread(target=self.marketplace.publish,
+                                    args=("0", Tea("green", 3, "cold")), kwargs={"block": True})
+        producer.start()
+        while not self.marketplace.stripe_for(Tea("green", 3, "cold")).blocked_publishers:
+            time.sleep(0.001)
+        self.marketplace.add_to_cart(1, self.first_product)
+        producer.join()
+        self.assertEqual(self.marketplace.size[0], 3)
+        self.assertEqual(self.marketplace.stock(Tea("green", 3, "cold")), {0: 1})
+
+    def test_shutdown_wakes_blocked_producers(self):
+        """
+        testing that shutdown makes a blocked publish return False
+        """
+        self.marketplace.register_producer()
+        for _ in range(3):
+            self.marketplace.publish("0", self.first_product)
+        results = []
+        producer = threading.Thread(target=lambda: results.append(
+            self.marketplace.publish("0", self.first_product, block=True)))
+        producer.start()
+        while not self.marketplace.stripe_for(self.first_product).blocked_publishers:
+            time.sleep(0.001)
+        self.marketplace.shutdown()
+        producer.join()
+        self.assertEqual(results, [False])
+
+    def test_publish_many_hands_off_before_filling_the_queue(self):
+        """
+        testing that a batch serves a waiting cart before taking queue slots
+        """
+        self.marketplace.register_producer()
+        self.marketplace.new_cart()
+        stripe = self.marketplace.stripe_for(self.first_product)
+        consumer = threading.Thread(target=self.marketplace.add_to_cart,
+                                    args=(1, self.first_product, 2), kwargs={"block": True})
+        consumer.start()
+        while not stripe.waiters:
+            time.sleep(0.001)
+        self.assertEqual(self.marketplace.publish_many("0", self.first_product, 6), 5)
+        consumer.join()
+        self.assertEqual(self.marketplace.cart_products(1), self.list * 2)
+        self.assertEqual(self.marketplace.size[0], 3)
+
+    def test_blocking_checkout_waits_for_the_whole_cart(self):
+        """
+        testing that a blocking checkout completes once every product is restocked
+        """
+        self.marketplace.register_producer()
+        cart_ops = [{"type": "add", "product": self.first_product, "quantity": 2}]
+        results = []
+        consumer = threading.Thread(target=lambda: results.append(
+            self.marketplace.checkout(cart_ops, block=True, timeout=5)))
+        consumer.start()
+        while not self.marketplace.checkout_waiters:
+            time.sleep(0.001)
+        self.marketplace.publish("0", self.first_product)
+        self.marketplace.publish("0", self.first_product)
+        consumer.join()
+        self.assertEqual(results, [self.list * 2])
+
+
 if __name__ == '__main__':
     """
     for unittest
@@ -0,0 +1,327 @@
+"""
+This module measures the Marketplace: the latency and outcome of its public
+methods and the wait and hold times of its locks.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+Nothing here runs unless a Marketplace is built with metrics=True: the
+methods and locks are only replaced by their timed counterparts then, so a
+marketplace without metrics runs exactly the code it ran before.
+"""
+
+import functools
+import io
+import json
+import sys
+import threading
+import time
+import unittest
+
+from tema.histogram import Histogram
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+# methods whose calls are counted and timed
+METHODS = ("register_producer", "publish", "publish_many", "new_cart", "add_to_cart",
+           "remove_from_cart", "checkout", "place_order", "abandon_cart")
+# methods that fail by returning False, 0 or None, i.e. the caller has to retry
+FALLIBLE = ("publish", "publish_many", "add_to_cart", "checkout")
+
+
+def _summary(histogram):
+    """
+    Returns the count and the p50/p99/max of a histogram of nanoseconds, in microseconds.
+    """
+    return {"count": histogram.count,
+            "p50_us": histogram.value_at_percentile(50) / 1000,
+            "p99_us": histogram.value_at_percentile(99) / 1000,
+            "max_us": (histogram.max or 0) / 1000}
+
+
+class TimedLock:
+    """
+    A lock that records how long its callers waited to acquire it and how
+    long they held it. The histograms are only updated while the lock is held,
+    so the lock itself guards them.
+    """
+    def __init__(self, lock=None):
+        self.lock = threading.Lock() if lock is None else lock
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.acquired_at = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        """
+        Acquires the lock, see threading.Lock.acquire.
+        """
+        start = time.perf_counter_ns()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.acquired_at = time.perf_counter_ns()
+        self.wait.record(self.acquired_at - start)
+        return True
+
+    def release(self):
+        """
+        Releases the lock, see threading.Lock.release.
+        """
+        self.hold.record(time.perf_counter_ns() - self.acquired_at)
+        self.lock.release()
+
+    def locked(self):
+        """
+        Returns True if the lock is held.
+        """
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def snapshot(self):
+        """
+        Returns copies of the wait and hold histograms.
+        """
+        wait, hold = Histogram(), Histogram()
+        with self.lock:
+            wait.merge(self.wait)
+            hold.merge(self.hold)
+        return wait, hold
+
+
+class MethodStats:
+    """
+    The number of calls, failures and the latency of one method.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.latency = Histogram()
+
+    def record(self, elapsed, failed):
+        """
+        Records one call that took elapsed nanoseconds.
+        """
+        with self.lock:
+            self.calls += 1
+            self.failures += failed
+            self.latency.record(elapsed)
+
+    def summary(self, fallible):
+        """
+        Returns the counters and the latency percentiles of the method.
+        """
+        with self.lock:
+            summary = {"calls": self.calls}
+            if fallible:
+                summary["failures"] = self.failures
+                summary["success_ratio"] = ((self.calls - self.failures) / self.calls
+                                            if self.calls else 1.0)
+            summary.update(_summary(self.latency))
+        del summary["count"]
+        return summary
+
+
+class Metrics:
+    """
+    The measurements of one Marketplace, installed by instrument.
+    """
+    def __init__(self):
+        self.methods = {}
+        # lock name -> TimedLock
+        self.locks = {}
+        # depth of the thread's calls to timed methods, e.g. publish calls publish_many
+        self.calls = threading.local()
+
+    def instrument(self, marketplace):
+        """
+        Replaces the locks of the marketplace by timed ones and its public
+        methods by wrappers that time them, on this instance only. Must be
+        called before the marketplace is shared with other threads.
+        """
+        # the inventory stripes are reported one by one, by index
+        for index, stripe in enumerate(marketplace.stripes):
+            stripe.lock = TimedLock(stripe.lock)
+            self.locks["stripe-%d" % index] = stripe.lock
+        marketplace.mutex_qsize = TimedLock(marketplace.mutex_qsize)
+        self.locks["mutex_qsize"] = marketplace.mutex_qsize
+        marketplace.mutex_cart = TimedLock(marketplace.mutex_cart)
+        self.locks["mutex_cart"] = marketplace.mutex_cart
+        sink = marketplace.fulfillment.sink
+        if hasattr(sink, "lock"):
+            sink.lock = TimedLock(sink.lock)
+            self.locks["sink"] = sink.lock
+
+        for name in METHODS:
+            self.methods[name] = MethodStats()
+            setattr(marketplace, name, self._timed(getattr(marketplace, name),
+                                                   self.methods[name], name in FALLIBLE))
+
+    def _timed(self, method, stats, fallible):
+        """
+        Returns a wrapper of the bound method that records every call in stats,
+        unless another timed method made it, so a call is only counted once.
+        """
+        calls = self.calls
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            if getattr(calls, "depth", 0):
+                return method(*args, **kwargs)
+            calls.depth = 1
+            try:
+                start = time.perf_counter_ns()
+                result = method(*args, **kwargs)
+                stats.record(time.perf_counter_ns() - start, fallible and not result)
+            finally:
+                calls.depth = 0
+            return result
+        return timed
+
+    def snapshot(self):
+        """
+        Returns the method and lock measurements.
+        """
+        locks = {}
+        for name, timed_lock in self.locks.items():
+            wait, hold = timed_lock.snapshot()
+            locks[name] = {"acquisitions": wait.count,
+                           "wait_total_ms": wait.total / 1e6,
+                           "wait": _summary(wait), "hold": _summary(hold)}
+        return {"methods": {name: stats.summary(name in FALLIBLE)
+                            for name, stats in self.methods.items()},
+                "locks": locks}
+
+
+class StatsReporter:
+    """
+    Writes a JSON line with marketplace.stats() to a stream every interval
+    seconds, from a background thread, and once more when it is stopped.
+    """
+    def __init__(self, stream=None, interval=None):
+        """
+        Constructor
+
+        :type stream: File
+        :param stream: where the snapshots are written, sys.stderr by default
+
+        :type interval: Float
+        :param interval: seconds between two snapshots, None for the final one only
+        """
+        self.stream = sys.stderr if stream is None else stream
+        self.interval = interval
+        self.marketplace = None
+        self.start_time = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, marketplace):
+        """
+        Starts reporting the stats of the marketplace, built with metrics=True.
+        """
+        self.marketplace = marketplace
+        self.start_time = time.monotonic()
+        if self.interval:
+            self.thread = threading.Thread(target=self._report, name="stats-reporter",
+                                           daemon=True)
+            self.thread.start()
+
+    def _report(self):
+        """
+        Body of the background thread.
+        """
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def dump(self, final=False):
+        """
+        Writes one snapshot.
+        """
+        snapshot = dict(self.marketplace.stats(), final=final,
+                        elapsed=round(time.monotonic() - self.start_time, 3))
+        self.stream.write(json.dumps(snapshot) + "\n")
+        self.stream.flush()
+
+    def stop(self):
+        """
+        Stops the background thread and writes the final snapshot.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.dump(final=True)
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        # imported here, tema.marketplace imports this module
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.marketplace = Marketplace(1, sink=MemorySink(), metrics=True)
+        self.product = Tea("Linden", 9, "Herbal")
+
+    def test_methods_are_counted(self):
+        """
+        testing the calls and failures of publish and add_to_cart
+        """
+        producer_id = self.marketplace.register_producer()
+        self.assertTrue(self.marketplace.publish(producer_id, self.product))
+        self.assertFalse(self.marketplace.publish(producer_id, self.product))
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product), 1)
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.product), 0)
+        self.marketplace.place_order(cart_id, "cons1")
+
+        stats = self.marketplace.stats()
+        self.assertEqual(stats["methods"]["publish"]["calls"], 2)
+        self.assertEqual(stats["methods"]["publish"]["success_ratio"], 0.5)
+        self.assertEqual(stats["methods"]["add_to_cart"]["failures"], 1)
+        self.assertEqual(stats["methods"]["place_order"]["calls"], 1)
+        self.assertGreater(stats["locks"]["stripe-0"]["acquisitions"], 0)
+        self.assertEqual(stats["locks"]["stripe-1"]["acquisitions"], 0)
+        self.assertGreater(stats["locks"]["mutex_cart"]["acquisitions"], 0)
+        self.assertEqual(stats["locks"]["sink"]["acquisitions"], 1)
+        self.assertEqual(stats["shelves"], {producer_id: 0})
+        self.assertEqual(stats["ledger"]["sold"], {str(self.product): 1})
+
+    def test_nested_calls_are_counted_once(self):
+        """
+        testing that only the outermost of the methods calling each other is counted
+        """
+        producer_id = self.marketplace.register_producer()
+        self.marketplace.publish(producer_id, self.product)
+        self.marketplace.checkout([{"type": "add", "product": self.product, "quantity": 1}],
+                                  name="cons1")
+
+        methods = self.marketplace.stats()["methods"]
+        self.assertEqual(methods["publish"]["calls"], 1)
+        self.assertEqual(methods["publish_many"]["calls"], 0)
+        self.assertEqual(methods["checkout"]["calls"], 1)
+        self.assertEqual(methods["new_cart"]["calls"], 0)
+        self.assertEqual(methods["place_order"]["calls"], 0)
+
+    def test_reporter_writes_a_final_snapshot(self):
+        """
+        testing that stop writes one JSON line
+        """
+        stream = io.StringIO()
+        reporter = StatsReporter(stream)
+        reporter.start(self.marketplace)
+        self.marketplace.new_cart()
+        reporter.stop()
+        snapshot = json.loads(stream.getvalue())
+        self.assertTrue(snapshot["final"])
+        self.assertEqual(snapshot["carts"]["opened"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+"""
+This module runs the consumers' carts on a bounded pool of worker threads.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import io
+import itertools
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+
+
+class _ConsumerTask:
+    """
+    One consumer: the carts it has yet to buy and how far it got through the
+    one in progress.
+    """
+    def __init__(self, name, carts, retry_wait_time):
+        self.name = name
+        self.carts = iter(carts)
+        self.retry_wait_time = retry_wait_time
+        self.cart = None
+        self.id_cart = None
+        self.position = 0  # index of the operation in progress
+        self.done = 0  # units of that operation already added
+
+    def next_cart(self):
+        """
+        Moves on to the next cart.
+
+        :returns False once every cart is bought
+        """
+        self.cart = next(self.carts, None)
+        self.id_cart = None
+        self.position = self.done = 0
+        return self.cart is not None
+
+
+class ConsumerPool:
+    """
+    Runs the carts of any number of consumers as tasks on a fixed number of
+    worker threads, instead of one thread per consumer. Orders are placed in
+    the name of the consumer that owns the cart, and a consumer's carts are
+    bought one after the other. A cart whose product is out of stock gives up
+    its worker and is queued again retry_wait_time seconds later, so waiting
+    carts never keep the others from running.
+    """
+
+    def __init__(self, marketplace, workers):
+        """
+        Constructor.
+
+        :type marketplace: Marketplace
+        :param marketplace: a reference to the marketplace
+
+        :type workers: Int
+        :param workers: the number of worker threads
+        """
+        self.marketplace = marketplace
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="consumer-pool")
+        self.pending = 0
+        self.error = None
+        self.stopped = False
+        self.finished = threading.Condition()
+        # heap of (time, sequence number, _ConsumerTask) of the carts waiting to be retried
+        self.retries = []
+        self.sequence = itertools.count()
+        self.retrier = threading.Thread(target=self._retry, name="consumer-pool-retry",
+                                        daemon=True)
+        self.retrier.start()
+
+    def submit(self, carts, retry_wait_time, name):
+        """
+        Queues every cart of a consumer.
+
+        :type carts: List
+        :param carts: a list of add and remove operations, or an iterable of
+        them that is read once, like the carts of tema.scenario
+
+        :type retry_wait_time: Time
+        :param retry_wait_time: the number of seconds between two checks of a
+        product that is out of stock
+
+        :type name: String
+        :param name: the consumer's name, which its orders are placed in
+        """
+        with self.finished:
+            self.pending += 1
+        self.executor.submit(self._step, _ConsumerTask(name, carts, retry_wait_time))
+
+    def join(self):
+        """
+        Waits until every submitted consumer is done and stops the workers.
+        On the first error raised by a cart, drops the work still queued and
+        re-raises the error.
+        """
+        with self.finished:
+            self.finished.wait_for(lambda: self.pending == 0 or self.error is not None)
+            self.stopped = True
+            self.finished.notify_all()
+        self.retrier.join()
+        self.executor.shutdown(cancel_futures=True)
+        if self.error is not None:
+            raise self.error
+
+    def _step(self, task):
+        """
+        Buys the consumer's carts as far as the stock allows, then either
+        finishes the consumer or queues it to be retried.
+        """
+        if self.error is not None:
+            return
+        try:
+            while task.cart is not None or task.next_cart():
+                if not self._advance(task):
+                    with self.finished:
+                        heapq.heappush(self.retries, (time.monotonic() + task.retry_wait_time,
+                                                      next(self.sequence), task))
+                        self.finished.notify_all()
+                    return
+                task.cart = None
+        except Exception as error:  # pylint: disable=broad-except
+            with self.finished:
+                if self.error is None:
+                    self.error = error
+                self.finished.notify_all()
+            return
+        with self.finished:
+            self.pending -= 1
+            self.finished.notify_all()
+
+    def _advance(self, task):
+        """
+        Runs the cart's operations from where it stopped, without waiting for stock.
+
+        :returns True if the order was placed, False if the cart has to wait for stock
+        """
+        marketplace = self.marketplace
+        if task.id_cart is None:
+            # fast path: the whole cart is in stock and is bought in one transaction
+            if marketplace.checkout(task.cart, name=task.name) is not None:
+                return True
+            task.id_cart = marketplace.new_cart()
+
+        while task.position < len(task.cart):
+            command = task.cart[task.position]
+            quantity = command["quantity"]
+            if command["type"] == "add":
+                while task.done < quantity:
+                    added = marketplace.add_to_cart(task.id_cart, command["product"],
+                                                    quantity - task.done)
+                    if not added:
+                        return False
+                    task.done += added
+            elif command["type"] == "remove":
+                marketplace.remove_from_cart(task.id_cart, command["product"], quantity)
+            task.position += 1
+            task.done = 0
+
+        marketplace.place_order(task.id_cart, task.name)
+        return True
+
+    def _retry(self):
+        """
+        Body of the thread that queues the waiting carts again once their
+        retry_wait_time is up.
+        """
+        with self.finished:
+            while not self.stopped:
+                if not self.retries:
+                    self.finished.wait()
+                elif self.retries[0][0] > time.monotonic():
+                    self.finished.wait(self.retries[0][0] - time.monotonic())
+                else:
+                    self.executor.submit(self._step, heapq.heappop(self.retries)[2])
+
+
+class TestConsumerPool(unittest.TestCase):
+    """
+    unittest class
+    """
+    def test_waiting_cart_does_not_block_the_worker(self):
+        """
+        testing that a cart waiting for stock lets another consumer's cart run
+        on the only worker, and that the consumer's next cart waits for it
+        """
+        marketplace = Marketplace(3)
+        producer_id = marketplace.register_producer()
+        black, green = Tea("black", 1, "Black"), Tea("green", 2, "Green")
+        marketplace.publish_many(producer_id, green, 2)
+
+        output = io.StringIO()
+        pool = ConsumerPool(marketplace, 1)
+        restock = threading.Timer(0.05, marketplace.publish, (producer_id, black))
+        with redirect_stdout(output):
+            pool.submit([[{"type": "add", "product": black, "quantity": 1}],
+                         [{"type": "add", "product": green, "quantity": 1}]], 0.01, "cons1")
+            pool.submit([[{"type": "add", "product": green, "quantity": 1}]], 0.01, "cons2")
+            restock.start()
+            pool.join()
+            marketplace.fulfillment.join()
+
+        self.assertEqual(output.getvalue().splitlines(),
+                         ["cons2 bought " + str(green), "cons1 bought " + str(black),
+                          "cons1 bought " + str(green)])
+
+    def test_error_drops_the_queued_consumers(self):
+        """
+        testing that join re-raises a cart's error and the consumers still
+        queued are not run
+        """
+        marketplace = Marketplace(3)
+        producer_id = marketplace.register_producer()
+        green = Tea("green", 2, "Green")
+        marketplace.publish_many(producer_id, green, 3)
+
+        pool = ConsumerPool(marketplace, 1)
+        pool.submit([[{"type": "add", "product": green}]], 0.01, "cons1")
+        for index in range(2, 4):
+            pool.submit([[{"type": "add", "product": green, "quantity": 1}]], 0.01,
+                        "cons%d" % index)
+        with self.assertRaises(KeyError):
+            pool.join()
+        self.assertEqual(marketplace.size[producer_id], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,14 +7,15 @@ March 2021
 """
 
 from threading import Thread
-import time
+
+from tema.hooks import agent_hooks
 
 class Producer(Thread):
     """
     Class that represents a producer.
     """
 
-    def __init__(self, products, marketplace, republish_wait_time, **kwargs):
+    def __init__(self, products, marketplace, republish_wait_time, sleep=None, **kwargs):
         """
         Constructor.
 
@@ -26,7 +27,13 @@ class Producer(Thread):
 
         @type republish_wait_time: Time
         @param republish_wait_time: the number of seconds that a producer must
-        wait until the marketplace becomes available
+        wait until the marketplace becomes available; only used with sleep,
+        otherwise publish blocks until a slot frees up
+
+        @type sleep: Function
+        @param sleep: waits the given number of seconds, like time.sleep; with it
+        the producer never blocks in the marketplace but polls it and sleeps,
+        so a simulation can run it on a virtual clock, see tema.simulation
 
         @type kwargs:
         @param kwargs: other arguments that are passed to the Thread's __init__()
@@ -34,17 +41,51 @@ class Producer(Thread):
         self.products = products
         self.marketplace = marketplace
         self.republish_wait_time = republish_wait_time
+        self.sleep = sleep
         self.id_producer = self.marketplace.register_producer()
 
         Thread.__init__(self, **kwargs)
 
     def run(self):
-
-        while True:
-			# continuously trying to publish products from producer's list
+        """
+        Publishes the products in a loop until the marketplace shuts down.
+        Each batch is published at once; a full queue blocks in publish_many
+        until enough of our slots free up.
+        """
+        publish_batch = self.publish_batch
+        hooks = agent_hooks(self.marketplace)
+        if hooks is not None:
+            publish_batch = hooks.wrap(publish_batch, "producer.batch")
+        while not self.marketplace.is_closed():
             for product, size, publish_wait_time in self.products:
-                for _ in range(size):
-                    if not self.marketplace.publish(str(self.id_producer), product):
-                        time.sleep(self.republish_wait_time)
-                        break
-                    time.sleep(publish_wait_time)
+                if not publish_batch(product, size, publish_wait_time):
+                    return
+
+    def publish_batch(self, product, size, publish_wait_time):
+        """
+        Publishes size units of the product, then waits publish_wait_time
+        seconds for each of them.
+
+        @returns False if the marketplace shut down meanwhile
+        """
+        if self.sleep is not None:
+            return self._poll_batch(product, size, publish_wait_time)
+        if self.marketplace.publish_many(str(self.id_producer), product, size,
+                                         block=True) < size:
+            return False
+        return not self.marketplace.wait_closed(size * publish_wait_time)
+
+    def _poll_batch(self, product, size, publish_wait_time):
+        """
+        publish_batch with the injected sleep: a full queue is retried every
+        republish_wait_time seconds.
+        """
+        published = self.marketplace.publish_many(str(self.id_producer), product, size)
+        while published < size:
+            if self.marketplace.is_closed():
+                return False
+            self.sleep(self.republish_wait_time)
+            published += self.marketplace.publish_many(str(self.id_producer), product,
+                                                        size - published)
+        self.sleep(size * publish_wait_time)
+        return not self.marketplace.is_closed()
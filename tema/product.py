@@ -6,23 +6,32 @@ Assignment 1
 March 2021
 """
 
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
 class Product:
     """
     Class that represents a product.
+
+    The classes declare their __slots__ themselves, which dataclass(slots=True)
+    would only do from Python 3.10 on.
     """
+    __slots__ = ("name", "price")
     name: str
     price: int
 
+    def __reduce__(self):
+        # the default pickling of slots assigns the fields, which frozen forbids
+        return self.__class__, tuple(getattr(self, field.name) for field in fields(self))
+
 
 @dataclass(init=True, repr=True, order=False, frozen=True)
 class Tea(Product):
     """
     Tea products
     """
+    __slots__ = ("type",)
     type: str
 
 
@@ -31,5 +40,6 @@ class Coffee(Product):
     """
     Coffee products
     """
+    __slots__ = ("acidity", "roast_level")
     acidity: str
     roast_level: str
@@ -0,0 +1,247 @@
+"""
+This module profiles every thread of a run.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+StackSampler looks at the stack of every thread at a fixed interval and counts
+the stacks it sees, which it writes in the folded format of flamegraph.pl and
+speedscope: one "thread;outer frame;...;inner frame count" line per stack.
+Time spent waiting for a lock, logging, printing or sleeping shows up under
+the frames that wait, whatever the thread is blocked on. ThreadProfiler runs
+a cProfile profiler in every thread started while it is active and merges
+their statistics, which are pstats rather than folded stacks: cProfile only
+records callers and callees.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import unittest
+from collections import Counter
+
+# cProfile sees every thread from a single profiler
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+
+def frame_name(code):
+    """
+    Returns the name of a frame in the folded output, "function (file:line)".
+    """
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class StackSampler:
+    """
+    Sampling profiler of all the threads of the process, run by a background thread.
+    """
+    def __init__(self, interval=0.005):
+        """
+        Constructor
+
+        :type interval: Float
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample_loop, name="stack-sampler",
+                                       daemon=True)
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and waits for the sampling thread.
+        """
+        self.stopped.set()
+        self.thread.join()
+
+    def _sample_loop(self):
+        """
+        Body of the sampling thread.
+        """
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Counts the current stack of every thread but the sampling one.
+        """
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, "thread-%d" % ident))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def write_folded(self, output_file, by_thread=False):
+        """
+        Writes the counted stacks in the folded format.
+
+        :type by_thread: Bool
+        :param by_thread: keep the thread names as the root frames; by default
+        the threads are merged by their name without its number, e.g. every
+        "Thread-3 (run)" becomes "Thread (run)"
+        """
+        merged = Counter()
+        for stack, count in self.stacks.items():
+            if not by_thread:
+                thread, _, rest = stack.partition(";")
+                stack = _thread_group(thread) + ";" + rest
+            merged[stack] += count
+        for stack, count in sorted(merged.items()):
+            output_file.write("%s %d\n" % (stack, count))
+
+
+def _thread_group(name):
+    """
+    Returns a thread name without the number that tells threads apart.
+    """
+    head, _, tail = name.partition("-")
+    number, _, rest = tail.partition(" ")
+    return head + (" " + rest if rest else "") if number.isdigit() else name
+
+
+class ThreadProfiler:
+    """
+    Runs cProfile in every thread started while it is active, and in the
+    thread that starts it. From Python 3.12 on, cProfile is built on
+    sys.monitoring, which sees every thread and lets only one profiler be
+    enabled, so a single profiler is run. Before, every thread gets its own
+    profiler and stop merges their statistics.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (thread, its profiler)
+        self.profiles = []
+
+    def _start_thread(self, _frame, _event, _arg):
+        """
+        Profile function installed in the new threads, which replaces itself
+        by a cProfile profiler on the first event.
+        """
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append((threading.current_thread(), profile))
+        profile.enable()
+
+    def start(self):
+        """
+        Starts profiling the current thread and the threads started from now on.
+        """
+        if not PROCESS_WIDE_PROFILER:
+            threading.setprofile(self._start_thread)
+        self._start_thread(None, None, None)
+
+    def stop(self):
+        """
+        Stops profiling. Before Python 3.12, only the thread that runs a
+        profiler can disable it, and a thread's profiler is unhooked when the
+        thread ends, so only the calling thread and the threads that are over
+        are merged. Those still running, like a logging QueueListener, are
+        left out, since their profilers are still recording.
+
+        :returns the pstats.Stats of the profiled threads
+        """
+        if PROCESS_WIDE_PROFILER:
+            profile = self.profiles[0][1]
+            profile.disable()
+            return pstats.Stats(profile)
+
+        threading.setprofile(None)
+        current = threading.current_thread()
+        with self.lock:
+            # the calling thread's first: disabling any profiler unhooks the calling thread
+            pairs = sorted(self.profiles, key=lambda pair: pair[0] is not current)
+        profiles = [profile for thread, profile in pairs
+                    if thread is current or not thread.is_alive()]
+        for profile in profiles:
+            profile.disable()
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+class TestProfiling(unittest.TestCase):
+    """
+    unittest class
+    """
+    @staticmethod
+    def spin(seconds):
+        """
+        keeps a thread busy
+        """
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            pass
+
+    def test_sampler_sees_the_busy_thread(self):
+        """
+        testing that the folded output has the stack of a worker thread
+        """
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        worker = threading.Thread(target=self.spin, args=(0.2,), name="Thread-7 (spin)")
+        worker.start()
+        worker.join()
+        sampler.stop()
+        output = io.StringIO()
+        sampler.write_folded(output)
+        lines = [line for line in output.getvalue().splitlines()
+                 if line.startswith("Thread (spin);")]
+        self.assertTrue(lines)
+        self.assertIn("spin (profiling.py:", lines[0])
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+
+    def test_thread_profiler_profiles_new_threads(self):
+        """
+        testing that a thread started while profiling is in the merged stats
+        """
+        profiler = ThreadProfiler()
+        profiler.start()
+        worker = threading.Thread(target=self.spin, args=(0.05,))
+        worker.start()
+        worker.join()
+        stats = profiler.stop()
+        functions = {function for _, _, function in stats.stats}
+        self.assertIn("spin", functions)
+
+    def test_thread_profiler_stops_with_a_thread_running(self):
+        """
+        testing that stop works while a profiled thread is still running
+        """
+        profiler = ThreadProfiler()
+        profiler.start()
+        release = threading.Event()
+        worker = threading.Thread(target=release.wait)
+        worker.start()
+        self.spin(0.01)
+        stats = profiler.stop()
+        release.set()
+        worker.join()
+        functions = {function for _, _, function in stats.stats}
+        self.assertIn("spin", functions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,445 @@
+"""
+This module loads the market configuration files, streaming the consumers.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+Two formats are read. A JSON document (tests/*.in) has the "products",
+"producers", "consumers" and "marketplace" keys. A line-delimited scenario
+(*.jsonl) has one JSON object with a single key per line:
+
+    {"marketplace": {"queue_size_per_producer": 15}}
+    {"products": {"id1": {"product_type": "Tea", ...}}}
+    {"producer": {"name": "prod1", "products": [["id1", 2, 0.18]], ...}}
+    {"consumer": {"name": "cons1", "retry_wait_time": 0.31, "carts": [...]}}
+
+with the consumers last. A JSON document may have its keys in any order; it
+is read a chunk at a time and its consumers array is skipped over until the
+caller asks for the consumers. In both formats the consumers are decoded one
+at a time, as the caller asks for them, and the product ids of a cart are
+only resolved when the consumer reaches that cart.
+"""
+
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import unittest
+
+from tema.product import Coffee, Product, Tea
+
+PRODUCT_TYPES = {"Product": Product, "Tea": Tea, "Coffee": Coffee}
+LINE_SUFFIXES = (".jsonl", ".ndjson")
+
+CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+class Carts:
+    """
+    The carts of a consumer, whose operations still name the products by id.
+    Iterating over it yields every cart with the ids replaced by products.
+    """
+    def __init__(self, carts, products):
+        self.carts = carts
+        self.products = products
+
+    def __len__(self):
+        return len(self.carts)
+
+    def __iter__(self):
+        products = self.products
+        for cart in self.carts:
+            yield [dict(operation, product=products[operation["product"]]) for operation in cart]
+
+
+def make_products(descriptions):
+    """
+    Returns the products of a "products" mapping, by id.
+    """
+    products = {}
+    for product_id, description in descriptions.items():
+        params = {k: v for k, v in description.items() if k != "product_type"}
+        products[product_id] = PRODUCT_TYPES[description["product_type"]](**params)
+    return products
+
+
+def make_producer(config, products):
+    """
+    Returns the producer configuration with its product ids replaced by products.
+    """
+    return dict(config, products=[(products[product_id], quantity, sleep_time)
+                                  for product_id, quantity, sleep_time in config["products"]])
+
+
+def make_consumer(config, products):
+    """
+    Returns the consumer configuration with its carts resolved lazily.
+    """
+    return dict(config, carts=Carts(config["carts"], products))
+
+
+def load_scenario(filename):
+    """
+    Reads the marketplace, the products and the producers of a market
+    configuration file and returns them as a dict, with "consumers" an
+    iterator that reads the consumers one at a time.
+    """
+    if filename.endswith(LINE_SUFFIXES):
+        return _load_lines(filename)
+    return _load_document(filename)
+
+
+def _load_lines(filename):
+    """
+    Loads a line-delimited scenario, see the module docstring.
+    """
+    scenario = {"products": {}, "producers": [], "consumers": iter(())}
+    with open(filename, encoding="utf-8") as input_file:
+        # readline, since iterating over a file does not let it tell its position
+        for line in iter(input_file.readline, ""):
+            if not line.strip():
+                continue
+            (kind, value), = json.loads(line).items()
+            if kind == "consumer":
+                # the consumers are read again from here, when they are asked for
+                scenario["consumers"] = _read_consumer_lines(filename, input_file.tell(),
+                                                              value, scenario["products"])
+                break
+            if kind == "marketplace":
+                scenario["marketplace"] = value
+            elif kind == "products":
+                scenario["products"].update(make_products(value))
+            elif kind == "producer":
+                scenario["producers"].append(make_producer(value, scenario["products"]))
+    return scenario
+
+
+def _read_consumer_lines(filename, position, first, products):
+    """
+    Yields the first consumer, then those of the lines starting at the given
+    position of a line-delimited scenario.
+    """
+    yield make_consumer(first, products)
+    with open(filename, encoding="utf-8") as input_file:
+        input_file.seek(position)
+        for line in input_file:
+            if line.strip():
+                yield make_consumer(json.loads(line)["consumer"], products)
+
+
+def _load_document(filename):
+    """
+    Loads a JSON document, reading it a chunk at a time and decoding its top
+    level values one at a time. The consumers array is only skipped over,
+    wherever it is, and decoded from the file again when they are asked for.
+    """
+    values = {}
+    consumers_at = None
+    with open(filename, encoding="utf-8") as input_file:
+        stream = JSONStream(input_file)
+        if stream.peek() != "{":
+            raise ValueError("a market configuration must be a JSON object")
+        for key in stream.keys():
+            if key == "consumers":
+                consumers_at = stream.tell()
+                stream.skip()
+            else:
+                values[key] = stream.decode()
+
+    products = make_products(values["products"])
+    return {"marketplace": values["marketplace"], "products": products,
+            "producers": [make_producer(config, products) for config in values["producers"]],
+            "consumers": _decode_consumers(filename, consumers_at, products)}
+
+
+def _decode_consumers(filename, position, products):
+    """
+    Yields the consumers of the JSON array starting at the given character of the file.
+    """
+    if position is None:
+        return
+    with open(filename, encoding="utf-8") as input_file:
+        stream = JSONStream(input_file)
+        stream.seek(position)
+        for config in stream.elements():
+            yield make_consumer(config, products)
+
+
+class JSONStream:
+    """
+    A JSON text read from a file a chunk at a time. Its values are decoded or
+    skipped one at a time, and only the unread part of the current chunk and
+    the value being decoded are kept in memory.
+    """
+    def __init__(self, input_file, chunk_size=CHUNK_SIZE):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text = ""
+        self.position = 0
+        # the characters of the file dropped before self.text
+        self.offset = 0
+
+    def _read(self, size=0):
+        """
+        Drops the consumed text and appends the next chunk of the file, or
+        size characters if that is more.
+
+        :returns False at the end of the file
+        """
+        chunk = self.input_file.read(max(size, self.chunk_size))
+        self.offset += self.position
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+
+    def _truncated(self):
+        return ValueError("the JSON text ends at character %d before its value does"
+                          % self.tell())
+
+    def tell(self):
+        """
+        Returns the number of characters of the file consumed.
+        """
+        return self.offset + self.position
+
+    def seek(self, position):
+        """
+        Skips forward to the given character of the file.
+        """
+        while self.offset + len(self.text) < position:
+            self.position = len(self.text)
+            if not self._read():
+                raise self._truncated()
+        self.position = position - self.offset
+
+    def peek(self):
+        """
+        Skips the whitespace and returns the next character, "" at the end of the file.
+        """
+        while True:
+            self.position = _WHITESPACE.match(self.text, self.position).end()
+            if self.position < len(self.text) or not self._read():
+                return self.text[self.position:self.position + 1]
+
+    def expect(self, characters):
+        """
+        Consumes the next character, which must be one of characters.
+
+        :returns the character
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("expected one of %r at character %d" % (characters, self.tell()))
+        self.position += 1
+        return character
+
+    def _read_more(self):
+        """
+        Reads as many characters again as the unconsumed text holds, so that
+        a value parsed again from its start after every read is parsed a
+        number of times logarithmic in its length.
+
+        :returns False at the end of the file
+        """
+        return self._read(len(self.text) - self.position)
+
+    def decode(self):
+        """
+        Decodes the next value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.position)
+            except json.JSONDecodeError:
+                if self._read_more():  # the value goes on in the next chunk
+                    continue
+                raise
+            if end == len(self.text) and self._read():  # so may a number
+                continue
+            self.position = end
+            return value
+
+    def skip(self):
+        """
+        Skips the next value. The elements of an array and the values of an
+        object are decoded one at a time and dropped, so only one of them is
+        kept in memory and the scanning is left to the json module.
+        """
+        character = self.peek()
+        if character == "[":
+            for _ in self.elements():
+                pass
+        elif character == "{":
+            for _ in self.keys():
+                self.skip()
+        else:
+            self.decode()
+
+    def keys(self):
+        """
+        Yields the keys of the next object. The caller decodes or skips the
+        value of every key before asking for the next one.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.position += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        """
+        Yields the decoded elements of the next array.
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
+
+
+def write_lines(market_config, output_file):
+    """
+    Writes a market configuration, as read from a JSON document, in the
+    line-delimited format.
+    """
+    output_file.write(json.dumps({"marketplace": market_config["marketplace"]}) + "\n")
+    output_file.write(json.dumps({"products": market_config["products"]}) + "\n")
+    for producer in market_config["producers"]:
+        output_file.write(json.dumps({"producer": producer}) + "\n")
+    for consumer in market_config["consumers"]:
+        output_file.write(json.dumps({"consumer": consumer}) + "\n")
+
+
+class TestScenario(unittest.TestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        self.market_config = {
+            "products": {"id1": {"product_type": "Tea", "name": "Linden", "type": "Herbal",
+                                 "price": 9}},
+            "producers": [{"name": "prod1", "products": [["id1", 2, 0.18]],
+                           "republish_wait_time": 0.15}],
+            "consumers": [{"name": "cons%d" % i, "retry_wait_time": 0.31,
+                           "carts": [[{"type": "add", "product": "id1", "quantity": i}]]}
+                          for i in (1, 2)],
+            "marketplace": {"queue_size_per_producer": 15}}
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        removes the scenario files
+        """
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def check(self, scenario):
+        """
+        checks a scenario loaded from self.market_config
+        """
+        tea = Tea("Linden", 9, "Herbal")
+        self.assertEqual(scenario["marketplace"], {"queue_size_per_producer": 15})
+        self.assertEqual(scenario["producers"][0]["products"], [(tea, 2, 0.18)])
+        consumers = list(scenario["consumers"])
+        self.assertEqual([consumer["name"] for consumer in consumers], ["cons1", "cons2"])
+        self.assertEqual(list(consumers[1]["carts"]),
+                         [[{"type": "add", "product": tea, "quantity": 2}]])
+
+    def test_document_with_the_marketplace_last(self):
+        """
+        testing the JSON document format, as written by test_generator.py
+        """
+        path = os.path.join(self.directory, "scenario.in")
+        with open(path, "w", encoding="utf-8") as output_file:
+            json.dump(self.market_config, output_file, indent=4)
+        self.check(load_scenario(path))
+
+    def test_document_with_the_consumers_first(self):
+        """
+        testing a JSON document whose consumers come before the other keys
+        """
+        path = os.path.join(self.directory, "scenario.in")
+        consumers_first = {"consumers": self.market_config["consumers"]}
+        consumers_first.update(self.market_config)
+        with open(path, "w", encoding="utf-8") as output_file:
+            json.dump(consumers_first, output_file)
+        self.check(load_scenario(path))
+
+    def test_stream_across_chunks(self):
+        """
+        testing a JSON text decoded and skipped a few characters at a time
+        """
+        text = json.dumps({"skipped": [{"a": "]\\\"}"}, [1.25, "x"]], "decoded": [12345, "[{"]})
+        stream = JSONStream(io.StringIO(text), chunk_size=3)
+        values = {}
+        position = None
+        for key in stream.keys():
+            if key == "skipped":
+                position = stream.tell()
+                stream.skip()
+            else:
+                values[key] = stream.decode()
+        self.assertEqual(values, {"decoded": [12345, "[{"]})
+        self.assertEqual(stream.peek(), "")
+
+        stream = JSONStream(io.StringIO(text), chunk_size=3)
+        stream.seek(position)
+        self.assertEqual(list(stream.elements()), [{"a": "]\\\"}"}, [1.25, "x"]])
+
+    def test_large_document_loads_like_json_load(self):
+        """
+        testing that a large document, one consumer of which is many chunks
+        long, is streamed in a time of the order of json.load's
+        """
+        operation = {"type": "add", "product": "id1", "quantity": 1}
+        self.market_config["consumers"] = [
+            {"name": "cons%d" % i, "retry_wait_time": 0.31, "carts": [[operation] * 10] * 5}
+            for i in range(2000)]
+        self.market_config["consumers"][0]["carts"] = [[operation] * 10] * 10000
+        path = os.path.join(self.directory, "scenario.in")
+        with open(path, "w", encoding="utf-8") as output_file:
+            output_file.write(json.dumps(self.market_config))
+
+        start = time.perf_counter()
+        with open(path, encoding="utf-8") as input_file:
+            json.load(input_file)
+        json_time = time.perf_counter() - start
+        start = time.perf_counter()
+        consumers = sum(1 for _ in load_scenario(path)["consumers"])
+        stream_time = time.perf_counter() - start
+
+        self.assertEqual(consumers, 2000)
+        # the consumers are decoded twice, once to skip them and once when asked for
+        self.assertLess(stream_time, 5 * json_time + 0.1)
+
+    def test_lines(self):
+        """
+        testing the line-delimited format
+        """
+        path = os.path.join(self.directory, "scenario.jsonl")
+        with open(path, "w", encoding="utf-8") as output_file:
+            write_lines(self.market_config, output_file)
+        self.check(load_scenario(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
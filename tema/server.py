@@ -0,0 +1,667 @@
+"""
+This module serves a Marketplace to other processes over a Unix domain socket.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+Every message is a frame made of a fixed header, packed as (payload length,
+request id, opcode or status), followed by the payload. A request carries the
+(args, kwargs) of one Marketplace call, a response carries its result or the
+exception it raised. The payloads are packed with struct, one tag byte per
+value followed by its fields; a product is sent whole the first time it
+crosses a connection and by a small id after that, and only the product
+classes of tema.product can be built, so a peer can send data but never code.
+A connection is served by its own server thread, in order, so a client can
+pipeline requests: write many frames and read the responses later. A batch
+frame carries several calls at once and is answered with the list of their
+results.
+"""
+
+import dataclasses
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from tema.marketplace import Marketplace
+from tema.product import Tea
+from tema.scenario import PRODUCT_TYPES
+
+_HEADER = struct.Struct("!IIB")
+_COUNT = struct.Struct("!I")
+_INT = struct.Struct("!q")
+_FLOAT = struct.Struct("!d")
+
+# the opcode of a call is the index of the method in this tuple
+METHODS = ("register_producer", "publish", "publish_many", "new_cart", "add_to_cart",
+           "remove_from_cart", "place_order", "checkout", "shutdown", "is_closed",
+           "wait_closed", "abandon_cart", "cart_stats")
+_OPCODES = {method: opcode for opcode, method in enumerate(METHODS)}
+OP_BATCH = 254
+OP_STOP = 255
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+class ProtocolError(Exception):
+    """
+    Raised when a peer sends a frame that does not follow the protocol.
+    """
+
+
+class RemoteError(Exception):
+    """
+    Raised in the client for a server exception that has no local counterpart.
+    """
+
+
+# the exceptions a response can raise in the client, any other one is a RemoteError
+_ERRORS = {error.__name__: error for error in (KeyError, ValueError, TypeError, IndexError,
+                                               RuntimeError, ProtocolError)}
+
+
+class _Codec:
+    """
+    Packs and unpacks the payloads of one connection. Each side numbers the
+    products it sends in the order it first sends them and remembers the
+    numbers of the products it received.
+    """
+    def __init__(self):
+        self.sent = {}
+        self.received = []
+
+    def encode(self, value):
+        """
+        Returns the bytes of a payload.
+        """
+        chunks = []
+        self._encode(value, chunks)
+        return b"".join(chunks)
+
+    def _encode(self, value, chunks):
+        """
+        Appends the packed value to chunks.
+        """
+        if value is None or isinstance(value, bool):
+            chunks.append(_TAGS[value])
+        elif isinstance(value, int):
+            chunks.append(b"i" + _INT.pack(value))
+        elif isinstance(value, float):
+            chunks.append(b"f" + _FLOAT.pack(value))
+        elif isinstance(value, str):
+            encoded = value.encode()
+            chunks.append(b"s" + _COUNT.pack(len(encoded)) + encoded)
+        elif isinstance(value, (list, tuple)):
+            chunks.append(b"l" + _COUNT.pack(len(value)))
+            for item in value:
+                self._encode(item, chunks)
+        elif isinstance(value, dict):
+            chunks.append(b"d" + _COUNT.pack(len(value)))
+            for key, item in value.items():
+                self._encode(key, chunks)
+                self._encode(item, chunks)
+        elif type(value).__name__ in PRODUCT_TYPES:
+            self._encode_product(value, chunks)
+        else:
+            raise TypeError("cannot send a %s" % type(value).__name__)
+
+    def _encode_product(self, product, chunks):
+        """
+        Appends the product's id, preceded by its class and fields the first time.
+        """
+        product_id = self.sent.get(product)
+        if product_id is not None:
+            chunks.append(b"p" + _COUNT.pack(product_id))
+            return
+        product_id = self.sent[product] = len(self.sent)
+        chunks.append(b"P" + _COUNT.pack(product_id))
+        self._encode(type(product).__name__, chunks)
+        self._encode([getattr(product, field.name) for field in dataclasses.fields(product)],
+                     chunks)
+
+    def decode(self, data):
+        """
+        Returns the value packed in a payload.
+        """
+        try:
+            value, end = self._decode(data, 0)
+        except (struct.error, IndexError, KeyError, TypeError, UnicodeDecodeError) as error:
+            raise ProtocolError("malformed payload: %r" % error) from error
+        if end != len(data):
+            raise ProtocolError("%d bytes after the payload" % (len(data) - end))
+        return value
+
+    def _decode(self, data, position):
+        """
+        Unpacks the value at position.
+
+        :returns (value, position after it)
+        """
+        tag = data[position:position + 1]
+        position += 1
+        if tag in _CONSTANTS:
+            return _CONSTANTS[tag], position
+        if tag == b"i":
+            return _INT.unpack_from(data, position)[0], position + _INT.size
+        if tag == b"f":
+            return _FLOAT.unpack_from(data, position)[0], position + _FLOAT.size
+        count = _COUNT.unpack_from(data, position)[0]
+        return self._decode_counted(tag, count, data, position + _COUNT.size)
+
+    def _decode_counted(self, tag, count, data, position):
+        """
+        Unpacks the value of a tag followed by a count: a string, a list, a
+        dict or a product.
+        """
+        if tag == b"s":
+            if position + count > len(data):
+                raise IndexError("string past the end of the payload")
+            return data[position:position + count].decode(), position + count
+        if tag == b"l":
+            items = []
+            for _ in range(count):
+                item, position = self._decode(data, position)
+                items.append(item)
+            return items, position
+        if tag == b"d":
+            items = {}
+            for _ in range(count):
+                key, position = self._decode(data, position)
+                items[key], position = self._decode(data, position)
+            return items, position
+        if tag == b"p":
+            return self.received[count], position
+        if tag == b"P":
+            if count != len(self.received):
+                raise ProtocolError("product %d defined out of order" % count)
+            product_type, position = self._decode(data, position)
+            product_fields, position = self._decode(data, position)
+            self.received.append(PRODUCT_TYPES[product_type](*product_fields))
+            return self.received[count], position
+        raise ProtocolError("unknown tag %r" % tag)
+
+    def encode_error(self, error):
+        """
+        Returns the payload of the exception a call raised.
+        """
+        try:
+            return self.encode([type(error).__name__, list(error.args)])
+        except TypeError:
+            return self.encode([type(error).__name__, [str(error)]])
+
+    def decode_error(self, data):
+        """
+        Returns the exception packed by encode_error.
+        """
+        name, args = self.decode(data)
+        if name in _ERRORS:
+            return _ERRORS[name](*args)
+        return RemoteError(name, *args)
+
+
+_CONSTANTS = {b"N": None, b"T": True, b"F": False}
+_TAGS = {value: tag for tag, value in _CONSTANTS.items()}
+
+
+def _write_frame(sock, request_id, code, data):
+    """
+    Sends one frame with an encoded payload.
+    """
+    sock.sendall(_HEADER.pack(len(data), request_id, code) + data)
+
+
+def _read_frame(rfile):
+    """
+    Reads one frame from a buffered socket file.
+
+    :returns (request id, opcode or status, encoded payload), or None if the
+    peer closed the connection between two frames
+    """
+    header = rfile.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise ProtocolError("connection closed inside a frame header")
+    length, request_id, code = _HEADER.unpack(header)
+    data = rfile.read(length)
+    if len(data) < length:
+        raise ProtocolError("connection closed inside a frame")
+    return request_id, code, data
+
+
+class _MarketplaceHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the requests of one client connection, one at a time.
+    """
+
+    def handle(self):
+        marketplace = self.server.marketplace
+        codec = _Codec()
+        while True:
+            try:
+                frame = _read_frame(self.rfile)
+            except ProtocolError:
+                return
+            if frame is None:
+                return
+            request_id, opcode, data = frame
+
+            if opcode == OP_STOP:
+                _write_frame(self.request, request_id, STATUS_OK, codec.encode(None))
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+            try:
+                payload = codec.decode(data)
+            except ProtocolError as error:
+                # the products of the connection may be out of step, so drop it
+                _write_frame(self.request, request_id, STATUS_ERROR, codec.encode_error(error))
+                return
+
+            try:
+                if opcode == OP_BATCH:
+                    result = [getattr(marketplace, METHODS[code])(*args, **kwargs)
+                              for code, args, kwargs in payload]
+                else:
+                    args, kwargs = payload
+                    result = getattr(marketplace, METHODS[opcode])(*args, **kwargs)
+                response = codec.encode(result)
+            except Exception as error:  # pylint: disable=broad-except
+                _write_frame(self.request, request_id, STATUS_ERROR, codec.encode_error(error))
+            else:
+                _write_frame(self.request, request_id, STATUS_OK, response)
+
+
+class MarketplaceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server that owns a Marketplace, one thread per client connection.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, marketplace):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the path of the Unix domain socket
+
+        :type marketplace: Marketplace
+        :param marketplace: the marketplace the requests are applied to
+        """
+        self.marketplace = marketplace
+        socketserver.UnixStreamServer.__init__(self, path, _MarketplaceHandler)
+
+
+def serve(path, marketplace_config):
+    """
+    Runs a marketplace server until a client stops it; meant as the target of
+    a multiprocessing.Process.
+
+    :type path: String
+    :param path: the path of the Unix domain socket
+
+    :type marketplace_config: Dict
+    :param marketplace_config: the keyword arguments of the Marketplace
+    """
+    with MarketplaceServer(path, Marketplace(**marketplace_config)) as server:
+        server.serve_forever()
+
+
+class _Connection:
+    """
+    The socket a client thread talks to the server through.
+    """
+    def __init__(self, path, connect_timeout):
+        deadline = time.monotonic() + connect_timeout
+        while True:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                self.sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.rfile = self.sock.makefile("rb")
+        self.next_id = 0
+        self.codec = _Codec()
+
+    def send(self, code, payload):
+        """
+        Sends a request without waiting for its response.
+
+        :returns the request id
+        """
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        _write_frame(self.sock, request_id, code, self.codec.encode(payload))
+        return request_id
+
+    def close(self):
+        """
+        Closes the socket.
+        """
+        self.rfile.close()
+        self.sock.close()
+
+    def receive(self, request_id):
+        """
+        Reads the response to the oldest request still waiting for one.
+
+        :returns the result of the request
+        """
+        frame = _read_frame(self.rfile)
+        if frame is None:
+            raise ProtocolError("the server closed the connection")
+        response_id, status, data = frame
+        if response_id != request_id:
+            raise ProtocolError("response %d came for request %d" % (response_id, request_id))
+        if status == STATUS_ERROR:
+            raise self.codec.decode_error(data)
+        return self.codec.decode(data)
+
+
+class Pipeline:
+    """
+    Collects calls and sends them back to back when the with block ends, then
+    reads all the responses; see MarketplaceClient.pipeline.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.results = None
+
+    def __getattr__(self, method):
+        if method not in _OPCODES:
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.calls.append((_OPCODES[method], args, kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            connection = self.client.connection()
+            sent = [connection.send(code, (args, kwargs)) for code, args, kwargs in self.calls]
+            # every response is read before an error is raised, so that the
+            # connection is left in step with the server
+            self.results, error = [], None
+            for request_id in sent:
+                try:
+                    self.results.append(connection.receive(request_id))
+                except ProtocolError:
+                    self.client.drop_connection()
+                    raise
+                except Exception as call_error:  # pylint: disable=broad-except
+                    self.results.append(None)
+                    if error is None:
+                        error = call_error
+            if error is not None:
+                raise error
+
+
+class MarketplaceClient:
+    """
+    Proxy with the methods of the Marketplace that forwards every call to a
+    MarketplaceServer. Each thread gets its own connection, so blocking calls
+    only block the thread that made them.
+    """
+
+    def __init__(self, path, connect_timeout=10):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the path of the server's Unix domain socket
+
+        :type connect_timeout: Float
+        :param connect_timeout: the number of seconds to wait for the server to listen
+        """
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.local = threading.local()
+
+    def connection(self):
+        """
+        Returns the calling thread's connection, opening it on first use.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = _Connection(self.path, self.connect_timeout)
+        return connection
+
+    def drop_connection(self):
+        """
+        Closes the calling thread's connection, the next call opens a new one.
+        """
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            self.local.connection = None
+            connection.close()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Calls a Marketplace method on the server and returns its result.
+        """
+        connection = self.connection()
+        return connection.receive(connection.send(_OPCODES[method], (args, kwargs)))
+
+    def batch(self, calls):
+        """
+        Runs several calls in a single request.
+
+        :type calls: List
+        :param calls: (method name, args, kwargs) tuples
+
+        :returns the list of their results
+        """
+        connection = self.connection()
+        payload = [(_OPCODES[method], args, kwargs) for method, args, kwargs in calls]
+        return connection.receive(connection.send(OP_BATCH, payload))
+
+    def pipeline(self):
+        """
+        Returns a Pipeline: calls made on it in a with block are sent together
+        at the end of the block and their results are left in its results list.
+        """
+        return Pipeline(self)
+
+    def stop_server(self):
+        """
+        Stops the server once the current requests are answered.
+        """
+        connection = self.connection()
+        connection.receive(connection.send(OP_STOP, None))
+
+    def register_producer(self):
+        """
+        See Marketplace.register_producer.
+        """
+        return self.call("register_producer")
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        See Marketplace.publish.
+        """
+        return self.call("publish", producer_id, product, block, timeout)
+
+    def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        See Marketplace.publish_many.
+        """
+        return self.call("publish_many", producer_id, product, quantity, block, timeout)
+
+    def new_cart(self):
+        """
+        See Marketplace.new_cart.
+        """
+        return self.call("new_cart")
+
+    def add_to_cart(self, cart_id, product, quantity=1, block=False, timeout=None):
+        """
+        See Marketplace.add_to_cart.
+        """
+        return self.call("add_to_cart", cart_id, product, quantity, block, timeout)
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        See Marketplace.remove_from_cart.
+        """
+        return self.call("remove_from_cart", cart_id, product, quantity)
+
+    def place_order(self, cart_id, name=None):
+        """
+        See Marketplace.place_order; the buyer defaults to the calling client thread.
+        """
+        return self.call("place_order", cart_id, name or threading.current_thread().name)
+
+    def checkout(self, cart_ops, block=False, timeout=None, name=None):
+        """
+        See Marketplace.checkout; the buyer defaults to the calling client thread.
+        """
+        return self.call("checkout", cart_ops, block, timeout,
+                         name or threading.current_thread().name)
+
+    def abandon_cart(self, cart_id):
+        """
+        See Marketplace.abandon_cart.
+        """
+        return self.call("abandon_cart", cart_id)
+
+    def cart_stats(self):
+        """
+        See Marketplace.cart_stats.
+        """
+        return self.call("cart_stats")
+
+    def shutdown(self):
+        """
+        See Marketplace.shutdown.
+        """
+        return self.call("shutdown")
+
+    def is_closed(self):
+        """
+        See Marketplace.is_closed.
+        """
+        return self.call("is_closed")
+
+    def wait_closed(self, timeout):
+        """
+        See Marketplace.wait_closed.
+        """
+        return self.call("wait_closed", timeout)
+
+
+class TestMarketplaceServer(unittest.TestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "marketplace.sock")
+        self.server = MarketplaceServer(path, Marketplace(3))
+        threading.Thread(target=self.server.serve_forever).start()
+        self.client = MarketplaceClient(path)
+        self.first_product = Tea("tea", 5, "hot")
+
+    def tearDown(self):
+        """
+        stops the server
+        """
+        self.client.stop_server()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_calls(self):
+        """
+        testing calls forwarded to the marketplace
+        """
+        self.assertEqual(self.client.register_producer(), 0)
+        self.assertEqual(self.client.publish_many("0", self.first_product, 2), 2)
+        cart_id = self.client.new_cart()
+        self.assertEqual(self.client.add_to_cart(cart_id, self.first_product, 3), 2)
+        self.assertEqual(self.server.marketplace.size[0], 0)
+        self.assertEqual(self.client.abandon_cart(cart_id), 2)
+        self.assertEqual(self.client.cart_stats()["live"], 0)
+
+    def test_errors_are_raised_by_the_client(self):
+        """
+        testing that an exception raised by the marketplace reaches the caller
+        """
+        self.assertRaises(KeyError, self.client.publish, "7", self.first_product)
+
+    def test_products_are_sent_once(self):
+        """
+        testing that a product crosses a connection whole once, then by id
+        """
+        codec = _Codec()
+        first = codec.encode([self.first_product, "x"])
+        second = codec.encode([self.first_product, "x"])
+        self.assertLess(len(second), len(first))
+        peer = _Codec()
+        decoded = peer.decode(first)
+        self.assertEqual(decoded, [self.first_product, "x"])
+        self.assertIs(peer.decode(second)[0], decoded[0])
+
+    def test_code_cannot_be_sent(self):
+        """
+        testing that only the product classes can be built and that bad frames are refused
+        """
+        codec = _Codec()
+        data = b"P" + _COUNT.pack(0) + codec.encode("Popen") + codec.encode([["ls"]])
+        self.assertRaises(ProtocolError, _Codec().decode, data)
+        self.assertRaises(ProtocolError, _Codec().decode, b"l" + _COUNT.pack(3) + b"N")
+        self.assertRaises(TypeError, codec.encode, object())
+
+    def test_pipeline_and_batch(self):
+        """
+        testing pipelined and batched calls
+        """
+        with self.client.pipeline() as pipe:
+            pipe.register_producer()
+            pipe.publish("0", self.first_product)
+            pipe.new_cart()
+        self.assertEqual(pipe.results, [0, True, 1])
+        self.assertEqual(self.client.batch([("add_to_cart", (1, self.first_product), {}),
+                                            ("remove_from_cart", (1, self.first_product), {})]),
+                         [1, 1])
+
+    def test_pipeline_error_reads_every_response(self):
+        """
+        testing that a failed pipelined call is raised after the responses of
+        the other calls are read, leaving the connection usable
+        """
+        with self.assertRaises(KeyError):
+            with self.client.pipeline() as pipe:
+                pipe.publish("7", self.first_product)
+                pipe.register_producer()
+        self.assertEqual(pipe.results, [None, 0])
+        self.assertEqual(self.client.register_producer(), 1)
+
+    def test_protocol_error_drops_the_connection(self):
+        """
+        testing that a connection out of step with the server is replaced
+        """
+        connection = self.client.connection()
+        connection.send(_OPCODES["register_producer"], ((), {}))
+        with self.assertRaises(ProtocolError):
+            with self.client.pipeline() as pipe:
+                pipe.register_producer()
+        self.assertIsNot(self.client.connection(), connection)
+        self.assertEqual(self.client.register_producer(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
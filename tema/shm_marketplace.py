@@ -0,0 +1,627 @@
+"""
+This module represents a Marketplace whose stock lives in shared memory.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+
+from tema import marketplace
+from tema.fulfillment import Fulfillment
+from tema.logger import get_logger
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+
+class SharedInventory:
+    """
+    Stock counters in a multiprocessing.shared_memory block, so producers and
+    consumers in different processes update them directly, without any IPC.
+
+    The block is an array of int64: the number of registered producers, then
+    the size of every producer's queue, then the total stock of every product,
+    then the stock of every (product, producer) pair, then for every product
+    the number of producers that have it in stock and their ids. Products are
+    indexed by their interned id.
+    A product's counters are guarded by one of the stripe locks and a
+    producer's size by one of the producer locks, always taken in the order
+    stripe lock -> producer lock.
+    """
+
+    def __init__(self, max_products=256, max_producers=64, lock_stripes=16):
+        """
+        Constructor
+
+        :type max_products: Int
+        :param max_products: the number of distinct products that can be stocked
+
+        :type max_producers: Int
+        :param max_producers: the number of producers that can register
+
+        :type lock_stripes: Int
+        :param lock_stripes: the number of locks the products and the producers are sharded over
+        """
+        self.max_products = max_products
+        self.max_producers = max_producers
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=8 * (1 + max_producers + max_products * (2 + 2 * max_producers)))
+        self.owner = True
+        self.counts = self.memory.buf.cast("q")
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+
+        self.registration_lock = multiprocessing.Lock()
+        self.stripe_locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+        self.producer_locks = [multiprocessing.Lock() for _ in range(lock_stripes)]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["memory"], state["counts"]
+        state["name"] = self.memory.name
+        state["owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("name")
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=name)
+        self.counts = self.memory.buf.cast("q")
+
+    def close(self):
+        """
+        Detaches this process from the block; the process that created it also frees it.
+        """
+        self.counts.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def producers(self):
+        """
+        Returns the number of registered producers.
+        """
+        return self.counts[0]
+
+    def register_producer(self):
+        """
+        Returns the id of a new producer.
+        """
+        with self.registration_lock:
+            producer_id = self.counts[0]
+            if producer_id == self.max_producers:
+                raise ValueError("at most %d producers can register" % self.max_producers)
+            self.counts[0] = producer_id + 1
+        return producer_id
+
+    def size_index(self, producer_id):
+        """
+        Returns the index of a producer's queue size in counts.
+        """
+        return 1 + producer_id
+
+    def total_index(self, product_id):
+        """
+        Returns the index of a product's total stock in counts.
+        """
+        return 1 + self.max_producers + product_id
+
+    def stock_index(self, product_id, producer_id):
+        """
+        Returns the index of the stock of a product from a producer in counts.
+        """
+        return (1 + self.max_producers + self.max_products
+                + product_id * self.max_producers + producer_id)
+
+    def holders_index(self, product_id):
+        """
+        Returns the index of the number of producers that have a product in stock.
+        """
+        return 1 + self.max_producers + self.max_products * (1 + self.max_producers) + product_id
+
+    def holder_index(self, product_id, position):
+        """
+        Returns the index of the id of the position-th producer that has a product in stock.
+        """
+        return (1 + self.max_producers + self.max_products * (2 + self.max_producers)
+                + product_id * self.max_producers + position)
+
+    def put(self, product_id, producer_id, units):
+        """
+        Adds units of a product to a producer's stock. Must be called with the
+        product's stripe lock held.
+        """
+        counts = self.counts
+        stock_index = self.stock_index(product_id, producer_id)
+        if not counts[stock_index]:
+            holders_index = self.holders_index(product_id)
+            position = counts[holders_index]
+            counts[self.holder_index(product_id, position)] = producer_id
+            counts[holders_index] = position + 1
+        counts[stock_index] += units
+        counts[self.total_index(product_id)] += units
+
+    def take(self, product_id, quantity):
+        """
+        Takes at most quantity units of a product out of the stock of the
+        producers that have it, visiting only those. Must be called with the
+        product's stripe lock held; the producers' sizes are left to the caller.
+
+        :returns (producer id, units) pairs
+        """
+        counts = self.counts
+        holders_index = self.holders_index(product_id)
+        taken = []
+        while quantity and counts[holders_index]:
+            producer = counts[self.holder_index(product_id, 0)]
+            stock_index = self.stock_index(product_id, producer)
+            units = min(quantity, counts[stock_index])
+            counts[stock_index] -= units
+            counts[self.total_index(product_id)] -= units
+            if not counts[stock_index]:
+                # move the last holder into the emptied first position
+                last = counts[holders_index] - 1
+                moved = counts[self.holder_index(product_id, last)]
+                counts[self.holder_index(product_id, 0)] = moved
+                counts[holders_index] = last
+            taken.append((producer, units))
+            quantity -= units
+        return taken
+
+    def stripe_lock(self, product_id):
+        """
+        Returns the lock that guards a product's counters.
+        """
+        return self.stripe_locks[product_id % len(self.stripe_locks)]
+
+    def producer_lock(self, producer_id):
+        """
+        Returns the lock that guards a producer's queue size.
+        """
+        return self.producer_locks[producer_id % len(self.producer_locks)]
+
+
+class _SharedSizes(Mapping):
+    """
+    Read-only view of the producers' queue sizes, like Marketplace.size.
+    """
+    def __init__(self, inventory):
+        self.inventory = inventory
+
+    def __getitem__(self, producer_id):
+        if not 0 <= producer_id < self.inventory.producers():
+            raise KeyError(producer_id)
+        return self.inventory.counts[self.inventory.size_index(producer_id)]
+
+    def __iter__(self):
+        return iter(range(self.inventory.producers()))
+
+    def __len__(self):
+        return self.inventory.producers()
+
+
+class SharedMemoryMarketplace:
+    """
+    Marketplace with the same methods as tema.marketplace.Marketplace, whose
+    stock is a SharedInventory, so it can be shared by producer and consumer
+    processes: create it before starting them and pass it along. Carts are
+    private to the process that created them.
+
+    Products get their ids in the order they are first seen, so every product
+    must be registered with register_product, or passed to the constructor,
+    before the other processes start; the other processes refuse new
+    products. Waiting in the blocking calls is done by polling the counters
+    every poll_interval seconds; units are not handed off to waiting
+    consumers across processes.
+
+    Every process fulfills the orders placed in it: a copy of the
+    marketplace sent to another process writes them to stdout and keeps a
+    ledger of its own.
+    """
+    def __init__(self, queue_size_per_producer, products=(), poll_interval=0.001, sink=None,
+                 fulfillment_workers=0, **kwargs):
+        """
+        Constructor
+
+        :type queue_size_per_producer: Int
+        :param queue_size_per_producer: the maximum size of a queue associated with each producer
+
+        :type products: List
+        :param products: the products that will be sold
+
+        :type poll_interval: Float
+        :param poll_interval: the number of seconds between two checks of a blocking call
+
+        :type sink: PrintSink
+        :param sink: where the orders placed in this process are written, see tema.sinks
+
+        :type fulfillment_workers: Int
+        :param fulfillment_workers: the number of threads that fulfill the
+        placed orders in every process, see tema.fulfillment
+
+        :type kwargs:
+        :param kwargs: the sizes of the SharedInventory
+        """
+        self.queue_size_per_producer = queue_size_per_producer
+        self.poll_interval = poll_interval
+        self.inventory = SharedInventory(**kwargs)
+        self.size = _SharedSizes(self.inventory)
+        self.closed = multiprocessing.Event()
+
+        self.products = []
+        self.product_ids = {}
+        # the only process that may give ids to new products
+        self.creator_pid = os.getpid()
+        for product in products:
+            self.register_product(product)
+
+        # cart_id -> {product id: {producer_id: units of the product taken from the producer}}
+        self.cart_list = {}
+        self.id_carts = 0
+        self.mutex_cart = threading.Lock()
+        self.fulfillment_workers = fulfillment_workers
+        self.fulfillment = Fulfillment(sink, fulfillment_workers)
+
+        self.log = get_logger()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["mutex_cart"], state["fulfillment"], state["log"]
+        state["cart_list"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mutex_cart = threading.Lock()
+        self.fulfillment = Fulfillment(workers=self.fulfillment_workers)
+        self.log = get_logger()
+
+    def close(self):
+        """
+        Detaches from the shared stock, freeing it in the creating process.
+        """
+        self.inventory.close()
+
+    def register_product(self, product):
+        """
+        Returns the id of a product, giving it the next free id if it has none.
+        """
+        product_id = self.product_ids.get(product)
+        if product_id is None:
+            if os.getpid() != self.creator_pid:
+                # an id given here could be given to another product in another process
+                raise ValueError("%s was not registered before the processes started" % (product,))
+            if len(self.products) == self.inventory.max_products:
+                raise ValueError("at most %d products can be sold" % self.inventory.max_products)
+            product_id = self.product_ids[product] = len(self.products)
+            self.products.append(product)
+        return product_id
+
+    def register_producer(self):
+        """
+        Returns an id for the producer that calls this.
+        """
+        producer_id = self.inventory.register_producer()
+        self.log.info("Registered new producer with id %d", producer_id)
+        return producer_id
+
+    def stock(self, product):
+        """
+        Returns a snapshot of the units of product on the shelves, by producer id.
+        """
+        inventory = self.inventory
+        product_id = self.register_product(product)
+        with inventory.stripe_lock(product_id):
+            stock = {producer: inventory.counts[inventory.stock_index(product_id, producer)]
+                     for producer in range(inventory.producers())}
+        return {producer: units for producer, units in stock.items() if units}
+
+    def publish(self, producer_id, product, block=False, timeout=None):
+        """
+        Adds the product provided by the producer to the marketplace, see Marketplace.publish.
+        """
+        return self.publish_many(producer_id, product, 1, block, timeout) == 1
+
+    def publish_many(self, producer_id, product, quantity, block=False, timeout=None):
+        """
+        Adds quantity units of the product provided by the producer to the marketplace,
+        see Marketplace.publish_many.
+
+        :returns the number of units published
+        """
+        inventory, counts = self.inventory, self.inventory.counts
+        producer_id = int(producer_id)
+        product_id = self.register_product(product)
+        size_index = inventory.size_index(producer_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        published = 0
+
+        while True:
+            with inventory.stripe_lock(product_id):
+                with inventory.producer_lock(producer_id):
+                    room = min(quantity - published,
+                               self.queue_size_per_producer - counts[size_index])
+                    if room > 0:
+                        counts[size_index] += room
+                if room > 0:
+                    inventory.put(product_id, producer_id, room)
+                    published += room
+            if not self._keep_waiting(published < quantity, block, deadline):
+                break
+
+        self.log.debug("Published %d of %d units of product %s from producer %d.",
+                       published, quantity, product, producer_id)
+        return published
+
+    def _keep_waiting(self, unfinished, block, deadline):
+        """
+        Decides whether a blocking call polls again, sleeping until then.
+        """
+        if not unfinished or not block or self.closed.is_set():
+            return False
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(self.poll_interval)
+        return True
+
+    def shutdown(self):
+        """
+        Marks the marketplace as closed in every process.
+        """
+        self.log.info("Shutting down the marketplace.")
+        self.closed.set()
+
+    def is_closed(self):
+        """
+        Returns True once the marketplace is shut down.
+        """
+        return self.closed.is_set()
+
+    def wait_closed(self, timeout):
+        """
+        Sleeps for at most timeout seconds, waking up early if the marketplace shuts down.
+        """
+        return self.closed.wait(timeout)
+
+    def new_cart(self):
+        """
+        Creates a new cart for the consumer
+
+        :returns an int representing the cart_id
+        """
+        with self.mutex_cart:
+            self.id_carts = self.id_carts + 1
+            cart_id = self.id_carts
+            self.cart_list[cart_id] = {}
+        self.log.info("Added new cart with id %s.", cart_id)
+        return cart_id
+
+    def add_to_cart(self, cart_id, product, quantity=1, block=False, timeout=None):
+        """
+        Adds a product to the given cart, see Marketplace.add_to_cart.
+
+        :returns the number of units added
+        """
+        inventory = self.inventory
+        product_id = self.register_product(product)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        added = 0
+
+        while True:
+            with inventory.stripe_lock(product_id):
+                for producer, units in self._take_units(product_id, quantity - added):
+                    self._fill_cart(cart_id, product_id, producer, units)
+                    added += units
+            if not self._keep_waiting(added < quantity, block, deadline):
+                break
+
+        self.log.debug("Added %d of %d units of product %s to cart with id %d.",
+                       added, quantity, product, cart_id)
+        return added
+
+    def remove_from_cart(self, cart_id, product, quantity=1):
+        """
+        Removes a product from cart, see Marketplace.remove_from_cart.
+
+        :returns the number of units removed
+        """
+        inventory, counts = self.inventory, self.inventory.counts
+        product_id = self.register_product(product)
+        cart = self.cart_list[cart_id]
+        origin = cart.get(product_id)
+        returned = []
+        removed = 0
+        # give the units back to the producers they came from, the last ones first
+        while origin and removed < quantity:
+            producer = next(reversed(origin))
+            units = min(quantity - removed, origin[producer])
+            if origin[producer] == units:
+                del origin[producer]
+                if not origin:
+                    del cart[product_id]
+            else:
+                origin[producer] -= units
+            returned.append((producer, units))
+            removed += units
+        if returned:
+            with inventory.stripe_lock(product_id):
+                for producer, units in returned:
+                    with inventory.producer_lock(producer):
+                        counts[inventory.size_index(producer)] += units
+                    inventory.put(product_id, producer, units)
+
+        self.log.debug("Removed %d of %d units of product %s from cart with id %d.",
+                       removed, quantity, product, cart_id)
+        return removed
+
+    def checkout(self, cart_ops, block=False, timeout=None, name=None):
+        """
+        Fills a new cart with the net result of all the operations of one cart
+        and places the order in a single transaction, see Marketplace.checkout.
+
+        :returns the list of products bought, or None if the cart could not be satisfied
+        """
+        inventory, counts = self.inventory, self.inventory.counts
+        wanted = {}
+        for operation in cart_ops:
+            product_id = self.register_product(operation["product"])
+            if operation["type"] == "add":
+                wanted[product_id] = wanted.get(product_id, 0) + operation["quantity"]
+            elif operation["type"] == "remove":
+                wanted[product_id] = max(0, wanted.get(product_id, 0) - operation["quantity"])
+        wanted = {product_id: units for product_id, units in wanted.items() if units}
+        # lock every stripe involved, in ascending index like Marketplace.checkout
+        stripes = len(inventory.stripe_locks)
+        locks = [inventory.stripe_locks[index]
+                 for index in sorted({product_id % stripes for product_id in wanted})]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            cart_id = None
+            for lock in locks:
+                lock.acquire()
+            try:
+                if all(counts[inventory.total_index(product_id)] >= units
+                       for product_id, units in wanted.items()):
+                    cart_id = self.new_cart()
+                    for product_id, units in wanted.items():
+                        for producer, taken in self._take_units(product_id, units):
+                            self._fill_cart(cart_id, product_id, producer, taken)
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+            if cart_id is not None:
+                return self.place_order(cart_id, name)
+            if not self._keep_waiting(True, block, deadline):
+                return None
+
+    def _take_units(self, product_id, quantity):
+        """
+        Takes at most quantity units of a product off the producers' shelves
+        and frees their slots. Must be called with the product's stripe lock held.
+
+        :returns (producer id, units) pairs
+        """
+        inventory, counts = self.inventory, self.inventory.counts
+        taken = inventory.take(product_id, quantity)
+        for producer, units in taken:
+            with inventory.producer_lock(producer):
+                counts[inventory.size_index(producer)] -= units
+        return taken
+
+    def _fill_cart(self, cart_id, product_id, producer, units):
+        """
+        Puts units of product, coming from producer, in the cart.
+        """
+        origin = self.cart_list[cart_id].setdefault(product_id, {})
+        origin[producer] = origin.get(producer, 0) + units
+
+    def cart_products(self, cart_id):
+        """
+        Returns the list of products in the cart, see Marketplace.cart_products.
+        """
+        return [self.products[product_id] for product_id, origin in self.cart_list[cart_id].items()
+                for _ in range(sum(origin.values()))]
+
+    def place_order(self, cart_id, name=None):
+        """
+        Return a list with all the products in the cart, release the cart and
+        pass the order on to the fulfillment stage, see Marketplace.place_order.
+        """
+        self.log.info("Place order from cart with id %s.", cart_id)
+        if name is None:
+            name = threading.current_thread().name
+        products = self.cart_products(cart_id)
+        with self.mutex_cart:
+            del self.cart_list[cart_id]
+        self.fulfillment.submit(name, products)
+        return products
+
+
+class TestSharedMemoryMarketplace(marketplace.MarketplaceTestsMixin, unittest.TestCase):
+    """
+    runs the Marketplace unit tests against the shared memory stock
+    """
+    marketplace_class = SharedMemoryMarketplace
+
+    def tearDown(self):
+        """
+        frees the shared memory
+        """
+        self.marketplace.close()
+
+    def test_stock_is_shared_between_processes(self):
+        """
+        testing that a producer process publishes into the consumer's stock
+        """
+        self.marketplace.register_product(self.first_product)
+        producer_id = self.marketplace.register_producer()
+        producer = multiprocessing.get_context("fork").Process(
+            target=self.marketplace.publish_many, args=(producer_id, self.first_product, 2))
+        producer.start()
+        producer.join()
+        cart_id = self.marketplace.new_cart()
+        self.assertEqual(self.marketplace.add_to_cart(cart_id, self.first_product, 3,
+                                                      block=True, timeout=0.05), 2)
+        self.assertEqual(self.marketplace.size[producer_id], 0)
+
+    def test_other_processes_refuse_new_products(self):
+        """
+        testing that a product first seen after the fork gets no id
+        """
+        errors = multiprocessing.get_context("fork").Queue()
+
+        def register():
+            try:
+                self.marketplace.register_product(Tea("green", 3, "cold"))
+            except ValueError as error:
+                errors.put(str(error))
+
+        child = multiprocessing.get_context("fork").Process(target=register)
+        child.start()
+        child.join()
+        self.assertIn("not registered", errors.get(timeout=5))
+
+    def test_takes_visit_the_producers_with_stock(self):
+        """
+        testing the holders of a product as units are published and taken
+        """
+        inventory = self.marketplace.inventory
+        for _ in range(3):
+            self.marketplace.register_producer()
+        self.marketplace.publish("2", self.first_product)
+        self.marketplace.publish_many("0", self.first_product, 2)
+        product_id = self.marketplace.register_product(self.first_product)
+        self.assertEqual(inventory.counts[inventory.holders_index(product_id)], 2)
+        with inventory.stripe_lock(product_id):
+            self.assertEqual(inventory.take(product_id, 2), [(2, 1), (0, 1)])
+        self.assertEqual(inventory.counts[inventory.holders_index(product_id)], 1)
+        self.assertEqual(self.marketplace.stock(self.first_product), {0: 1})
+
+    def test_place_order_goes_through_the_sink(self):
+        """
+        testing that a placed order is written to the sink and recorded in the ledger
+        """
+        sink = MemorySink()
+        shared = SharedMemoryMarketplace(3, sink=sink)
+        try:
+            shared.register_producer()
+            shared.publish("0", self.first_product)
+            cart_id = shared.new_cart()
+            shared.add_to_cart(cart_id, self.first_product)
+            self.assertEqual(shared.place_order(cart_id, "cons1"), [self.first_product])
+            self.assertEqual(sink.lines(), ["cons1 bought " + str(self.first_product)])
+            self.assertEqual(shared.fulfillment.ledger()["orders"], 1)
+        finally:
+            shared.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
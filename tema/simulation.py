@@ -0,0 +1,225 @@
+"""
+This module runs the Producers and Consumers as a discrete-event simulation.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import heapq
+import random
+import threading
+import time
+import unittest
+
+from tema.consumer import Consumer
+from tema.marketplace import Marketplace
+from tema.producer import Producer
+from tema.product import Tea
+from tema.sinks import MemorySink
+
+
+class SimulationStopped(BaseException):
+    """
+    Raised in an agent still waiting in sleep when the simulation stops, to
+    unwind it. It is not an Exception, so the agents' handlers let it through.
+    """
+
+
+class _Agent:
+    """
+    The thread of one agent and the semaphore it waits for its turn on.
+    """
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.resume = threading.Semaphore(0)
+        self.thread = None
+
+
+class Simulation:
+    """
+    Discrete-event scheduler with a virtual clock. Every agent runs the real
+    Producer or Consumer code in a thread of its own, but only one agent runs
+    at a time: it keeps the turn until it calls sleep, which schedules its
+    wake-up and hands the turn back. The scheduler then resumes the agent
+    with the earliest wake-up time and moves the clock straight to it, so
+    waiting costs no wall time. Agents due at the same time run in an order
+    drawn from a generator seeded with seed, which makes a run with a given
+    seed repeatable.
+    """
+    def __init__(self, seed=None, max_time=1e6):
+        """
+        Constructor
+
+        :type seed: Int
+        :param seed: the seed of the order of simultaneous events
+
+        :type max_time: Float
+        :param max_time: the virtual second after which run gives up
+        """
+        self.now = 0.0
+        self.random = random.Random(seed)
+        self.max_time = max_time
+        # heap of (wake-up time, random tie-break, sequence number, agent)
+        self.events = []
+        self.sequence = 0
+        self.agents = []
+        self.running = 0
+        self.stopped = False
+        self.error = None
+        # released by the agent that has the turn when it sleeps or finishes
+        self.turn_over = threading.Semaphore(0)
+        self.local = threading.local()
+
+    def clock(self):
+        """
+        Returns the virtual time, in seconds since the simulation started.
+        """
+        return self.now
+
+    def spawn(self, function, daemon=False, name=None):
+        """
+        Starts an agent at the current virtual time.
+
+        :type function: Callable
+        :param function: the body of the agent, e.g. the run method of a
+        Producer or Consumer built with sleep=simulation.sleep
+
+        :type daemon: Bool
+        :param daemon: run does not wait for daemon agents, like producers
+        that never stop
+
+        :type name: String
+        :param name: the name of the agent's thread
+        """
+        agent = _Agent(daemon)
+        agent.thread = threading.Thread(target=self._run_agent, args=(agent, function),
+                                        name=name, daemon=True)
+        self.agents.append(agent)
+        if not daemon:
+            self.running += 1
+        self._schedule(agent, 0)
+        agent.thread.start()
+
+    def _schedule(self, agent, delay):
+        """
+        Queues the agent to be resumed after delay virtual seconds.
+        """
+        heapq.heappush(self.events, (self.now + delay, self.random.random(),
+                                     self.sequence, agent))
+        self.sequence += 1
+
+    def _run_agent(self, agent, function):
+        """
+        Body of an agent's thread: waits for its first turn, runs the agent
+        and hands the turn back when it is done.
+        """
+        self.local.agent = agent
+        agent.resume.acquire()
+        try:
+            if not self.stopped:
+                function()
+        except SimulationStopped:
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = error
+        finally:
+            if not agent.daemon:
+                self.running -= 1
+            self.turn_over.release()
+
+    def sleep(self, seconds):
+        """
+        Waits seconds of virtual time; called by the agent that has the turn.
+        """
+        agent = self.local.agent
+        self._schedule(agent, seconds)
+        self.turn_over.release()
+        agent.resume.acquire()
+        if self.stopped:
+            raise SimulationStopped
+
+    def run(self):
+        """
+        Runs the agents until every non-daemon agent has finished, then stops
+        the others.
+
+        :returns the virtual time at the end of the run
+        """
+        try:
+            while self.running and self.error is None:
+                if not self.events or self.events[0][0] > self.max_time:
+                    raise RuntimeError("the agents are still waiting after %g virtual seconds"
+                                       % self.max_time)
+                self.now, _, _, agent = heapq.heappop(self.events)
+                agent.resume.release()
+                # released by the agent, in its own thread, so no with block
+                self.turn_over.acquire()  # pylint: disable=consider-using-with
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.stop()
+        return self.now
+
+    def stop(self):
+        """
+        Unwinds the agents still waiting for their turn and waits for their threads.
+        """
+        self.stopped = True
+        for _, _, _, agent in self.events:
+            agent.resume.release()
+        self.events = []
+        for agent in self.agents:
+            agent.thread.join()
+
+
+class TestSimulation(unittest.TestCase):
+    """
+    unittest class
+    """
+    def simulate(self, seed):
+        """
+        runs one producer and two consumers of the same product
+        """
+        sink = MemorySink()
+        marketplace = Marketplace(2, sink=sink)
+        simulation = Simulation(seed)
+        tea = Tea("Linden", 9, "Herbal")
+        producer = Producer([(tea, 2, 1.0)], marketplace, 0.5, sleep=simulation.sleep,
+                            name="prod1")
+        simulation.spawn(producer.run, daemon=True, name="prod1")
+        for name in ("cons1", "cons2"):
+            cart = [{"type": "add", "product": tea, "quantity": 3}]
+            consumer = Consumer([cart, cart], marketplace, 0.25, sleep=simulation.sleep,
+                                name=name)
+            simulation.spawn(consumer.run, name=name)
+        return simulation.run(), sink.orders
+
+    def test_virtual_time_costs_no_wall_time(self):
+        """
+        testing that waiting advances the virtual clock only
+        """
+        start = time.monotonic()
+        now, orders = self.simulate(0)
+        self.assertGreater(now, 5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(orders), 4)
+
+    def test_a_seed_repeats_the_run(self):
+        """
+        testing that two runs with the same seed buy in the same order
+        """
+        self.assertEqual(self.simulate(7), self.simulate(7))
+
+    def test_stop_unwinds_the_waiting_agents(self):
+        """
+        testing that run leaves no agent thread behind, daemon or failing
+        """
+        simulation = Simulation(0, max_time=10)
+        simulation.spawn(lambda: simulation.sleep(20), name="late")
+        self.assertRaises(RuntimeError, simulation.run)
+        self.assertFalse(any(agent.thread.is_alive() for agent in simulation.agents))
+
+
+if __name__ == '__main__':
+    unittest.main()
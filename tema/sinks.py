@@ -0,0 +1,231 @@
+"""
+This module offers the sinks the Marketplace writes the placed orders to.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from tema.product import Coffee, Tea
+
+
+def format_order(name, products):
+    """
+    Returns the lines of an order, one "<name> bought <product>" line per unit.
+
+    :type name: String
+    :param name: the buyer
+
+    :type products: List
+    :param products: the products bought
+    """
+    prefix = name + " bought "
+    return "".join([prefix + str(product) + "\n" for product in products])
+
+
+class PrintSink:
+    """
+    Prints every order to the current sys.stdout as soon as it is placed,
+    with a single write per order.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def write(self, name, products):
+        """
+        Writes the order of the buyer.
+
+        :type name: String
+        :param name: the buyer
+
+        :type products: List
+        :param products: the products bought
+        """
+        if products:
+            text = format_order(name, products)
+            with self.lock:
+                sys.stdout.write(text)
+
+    def flush(self):
+        """
+        Writes the orders still buffered, if any.
+        """
+
+    def close(self):
+        """
+        Flushes the sink and releases its resources.
+        """
+
+
+class BufferedSink(PrintSink):
+    """
+    Formats every order in the consumer's thread, but leaves the writing to a
+    background thread that sends all the orders gathered since its last write
+    to the stream at once, every flush_interval seconds.
+    """
+    def __init__(self, stream=None, flush_interval=0.05):
+        """
+        Constructor
+
+        :type stream: TextIO
+        :param stream: where the orders are written, sys.stdout by default
+
+        :type flush_interval: Float
+        :param flush_interval: the number of seconds between two writes
+        """
+        super().__init__()
+        self.stream = sys.stdout if stream is None else stream
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.closed = threading.Event()
+        self.writer = threading.Thread(target=self._write_periodically,
+                                       name="order-sink", daemon=True)
+        self.writer.start()
+
+    def write(self, name, products):
+        if products:
+            text = format_order(name, products)
+            with self.lock:
+                self.pending.append(text)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                self.stream.write("".join(pending))
+                self.stream.flush()
+
+    def close(self):
+        self.closed.set()
+        self.writer.join()
+        self.flush()
+
+    def _write_periodically(self):
+        """
+        Body of the writer thread, which runs until the sink is closed.
+        """
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+
+class FileSink(BufferedSink):
+    """
+    Buffered sink that writes the orders to a file, which close closes.
+    """
+    DEFAULT_PATH = "orders.out"
+
+    def __init__(self, path=DEFAULT_PATH, flush_interval=0.05):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the file the orders are written to, truncated first
+
+        :type flush_interval: Float
+        :param flush_interval: the number of seconds between two writes
+        """
+        # closed by close, or right away if the writer thread cannot start
+        stream = open(path, "w", encoding="utf-8")  # pylint: disable=consider-using-with
+        try:
+            super().__init__(stream, flush_interval)
+        except BaseException:
+            stream.close()
+            raise
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.stream.close()
+
+
+class MemorySink(PrintSink):
+    """
+    Keeps the orders in memory instead of writing them anywhere, for tests
+    and benchmarks that should not pay for terminal output.
+    """
+    def __init__(self):
+        super().__init__()
+        self.orders = []
+
+    def write(self, name, products):
+        with self.lock:
+            self.orders.append((name, products))
+
+    def lines(self):
+        """
+        Returns the lines the orders would have been printed as.
+        """
+        with self.lock:
+            return "".join(format_order(name, products)
+                           for name, products in self.orders).splitlines()
+
+
+SINKS = {"print": PrintSink, "buffered": BufferedSink, "file": FileSink, "memory": MemorySink}
+
+
+def make_sink(output, path=None):
+    """
+    Returns a new sink of the kind named output in SINKS.
+
+    :type path: String
+    :param path: the file of the "file" sink, FileSink.DEFAULT_PATH by default
+    """
+    if output == "file" and path is not None:
+        return FileSink(path)
+    return SINKS[output]()
+
+
+class TestSinks(unittest.TestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        self.products = [Tea("Linden", 9, "Herbal"), Coffee("Arabica", 10, 5.1, "MEDIUM")]
+        self.lines = ["cons1 bought " + str(product) for product in self.products]
+
+    def test_buffered_sink_writes_on_flush(self):
+        """
+        testing that a buffered order is written once flushed
+        """
+        stream = io.StringIO()
+        sink = BufferedSink(stream, flush_interval=60)
+        sink.write("cons1", self.products)
+        self.assertEqual(stream.getvalue(), "")
+        sink.close()
+        self.assertEqual(stream.getvalue().splitlines(), self.lines)
+
+    def test_file_sink_closes_its_file(self):
+        """
+        testing that the file sink writes the orders and closes the file
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "orders.out")
+            sink = make_sink("file", path)
+            sink.write("cons1", self.products)
+            sink.close()
+            self.assertTrue(sink.stream.closed)
+            with open(path, encoding="utf-8") as orders:
+                self.assertEqual(orders.read().splitlines(), self.lines)
+
+    def test_memory_sink_keeps_the_orders(self):
+        """
+        testing the in-memory collector
+        """
+        sink = MemorySink()
+        sink.write("cons1", self.products)
+        self.assertEqual(sink.lines(), self.lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,632 @@
+"""
+This module records the calls made to a Marketplace in a binary trace file
+and replays them against any marketplace.
+
+Computer Systems Architecture Course
+Assignment 1
+March 2021
+
+A trace starts with MAGIC and is a sequence of records, each one starting
+with its kind:
+
+    b"M" marketplace H length, the marketplace's configuration as JSON
+    b"S" string      I id, H length, a thread or buyer name in UTF-8
+    b"P" product     i id, H length, the product as JSON, like in tests/*.in
+    b"C" call        CALL, the fields of Call, followed for checkout by
+                     quantity CART_OPERATION entries
+
+Names and products are written once, before the first call that uses them,
+and calls refer to them by id. Products have their marketplace catalog id.
+Calls are written when they return, in the order they returned; their two
+timestamps are the nanoseconds from the start of the recording to the start
+and to the end of the call. Calls made by another marketplace method, like the publish_many
+of publish, are not recorded, and neither are the calls that raised.
+"""
+
+import bisect
+import dataclasses
+import heapq
+import inspect
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from tema.hooks import Hook
+from tema.product import Tea
+from tema.scenario import make_products
+from tema.sinks import MemorySink
+
+MAGIC = b"MKTRACE2"
+CONFIG = struct.Struct("<H")
+STRING = struct.Struct("<IH")
+PRODUCT = struct.Struct("<iH")
+# timestamp, returned, thread, method, flags, subject, product, quantity, timeout, result, buyer
+CALL = struct.Struct("<QQIBBiiifqI")
+CART_OPERATION = struct.Struct("<Bii")
+
+METHODS = ("register_producer", "publish", "publish_many", "new_cart", "add_to_cart",
+           "remove_from_cart", "checkout", "place_order", "abandon_cart", "shutdown")
+# the methods whose first argument is a producer id, the others' being a cart id
+PRODUCER_METHODS = ("publish", "publish_many")
+CART_OPERATION_TYPES = ("add", "remove")
+
+FLAG_BLOCK = 1
+FLAG_TIMEOUT = 2
+NONE = -1
+NO_NAME = 0xFFFFFFFF
+# the longest a fast replay waits for the calls another one has to come after
+FAST_WAIT = 0.2
+
+
+@dataclasses.dataclass(frozen=True)
+class Call:
+    """
+    One recorded call. timestamp and returned are the times it started and
+    returned at, thread is the name of the calling thread, subject the
+    producer or cart id, product and quantity the product id and units, NONE
+    where the method has none, and result the result as an int: a bool or a
+    number of units, an id, the number of products bought or NONE for None.
+    """
+    timestamp: int
+    returned: int
+    thread: str
+    method: str
+    block: bool
+    timeout: float
+    subject: int
+    product: int
+    quantity: int
+    result: int
+    # the name argument of place_order and checkout
+    buyer: str = None
+    # (type, product id, quantity) of every operation of a checkout
+    cart: tuple = ()
+
+
+def encode_result(result):
+    """
+    Returns the int recorded for the result of a marketplace call.
+    """
+    if result is None:
+        return NONE
+    if isinstance(result, list):
+        return len(result)
+    return int(result)
+
+
+class TraceRecorder(Hook):
+    """
+    Hook that writes every call made to a marketplace to a trace file.
+    """
+    def __init__(self, path):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the trace file, overwritten
+        """
+        self.path = path
+        self.output_file = None
+        self.marketplace = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.strings = {}
+        self.products = set()
+        self.signatures = {}
+        self.start_time = 0
+
+    def start(self, marketplace):
+        """
+        Starts recording the calls made to the marketplace from now on.
+        """
+        self.marketplace = marketplace
+        self.signatures = {name: inspect.signature(getattr(type(marketplace), name))
+                           for name in METHODS}
+        self.output_file = open(self.path, "wb")
+        config = json.dumps({"queue_size_per_producer":
+                             marketplace.queue_size_per_producer}).encode()
+        self.output_file.write(MAGIC + b"M" + CONFIG.pack(len(config)) + config)
+        self.start_time = time.perf_counter_ns()
+        marketplace.add_hook(self)
+
+    def stop(self):
+        """
+        Stops recording and closes the trace file.
+        """
+        self.marketplace.hooks.remove(self)
+        with self.lock:
+            self.output_file.close()
+
+    def before(self, operation, _args, _kwargs):
+        """
+        Notes the start of a call, unless another marketplace method made it.
+        """
+        if operation not in self.signatures:
+            return  # a producer's batch, a consumer's cart or a sleep
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        if depth == 0:
+            self.local.started = time.perf_counter_ns() - self.start_time
+
+    def raised(self, operation, _args, _kwargs, _error):
+        """
+        Leaves a call that raised out of the trace.
+        """
+        if operation in self.signatures:
+            self.local.depth -= 1
+
+    def after(self, operation, args, kwargs, result):
+        """
+        Writes an outermost call that returned, with the names and products it
+        uses that were not written yet.
+        """
+        if operation not in self.signatures:
+            return
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+        returned = time.perf_counter_ns() - self.start_time
+        arguments = self.signatures[operation].bind(None, *args, **kwargs)
+        arguments.apply_defaults()
+        arguments = arguments.arguments
+
+        subject = product_id = quantity = NONE
+        cart = ()
+        if operation in PRODUCER_METHODS:
+            subject = int(arguments["producer_id"])
+        elif "cart_id" in arguments:
+            subject = arguments["cart_id"]
+        catalog = self.marketplace.catalog
+        if "product" in arguments:
+            product_id = catalog.intern(arguments["product"])
+            quantity = arguments.get("quantity", 1)
+        if operation == "checkout":
+            cart = tuple((CART_OPERATION_TYPES.index(command["type"]),
+                          catalog.intern(command["product"]), command["quantity"])
+                         for command in arguments["cart_ops"])
+            quantity = len(cart)
+        buyer = arguments.get("name")
+        timeout = arguments.get("timeout")
+        flags = ((FLAG_BLOCK if arguments.get("block") else 0)
+                 | (0 if timeout is None else FLAG_TIMEOUT))
+
+        with self.lock:
+            if self.output_file.closed:
+                return
+            for used in {product_id, *(entry[1] for entry in cart)} - {NONE}:
+                if used not in self.products:
+                    self.products.add(used)
+                    self._write_product(used, catalog.product(used))
+            self.output_file.write(b"C" + CALL.pack(
+                self.local.started, returned, self._string_id(threading.current_thread().name),
+                METHODS.index(operation), flags, subject, product_id, quantity,
+                0.0 if timeout is None else timeout, encode_result(result),
+                NO_NAME if buyer is None else self._string_id(buyer)))
+            for operation_type, used, units in cart:
+                self.output_file.write(CART_OPERATION.pack(operation_type, used, units))
+
+    def _string_id(self, string):
+        """
+        Returns the id of a name, writing it the first time.
+        """
+        if string not in self.strings:
+            self.strings[string] = len(self.strings)
+            encoded = string.encode()
+            self.output_file.write(b"S" + STRING.pack(self.strings[string], len(encoded))
+                                   + encoded)
+        return self.strings[string]
+
+    def _write_product(self, product_id, product):
+        """
+        Writes the definition of a product.
+        """
+        description = json.dumps(dict(dataclasses.asdict(product),
+                                      product_type=type(product).__name__)).encode()
+        self.output_file.write(b"P" + PRODUCT.pack(product_id, len(description)) + description)
+
+
+def read_trace(path):
+    """
+    Reads a trace file.
+
+    :returns (the marketplace configuration, {product id: product}, the list of Calls)
+    """
+    config, strings, descriptions, calls = {}, {}, {}, []
+    with open(path, "rb") as input_file:
+        if input_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a marketplace trace" % path)
+        while True:
+            kind = input_file.read(1)
+            if not kind:
+                break
+            if kind == b"M":
+                length, = CONFIG.unpack(input_file.read(CONFIG.size))
+                config = json.loads(input_file.read(length))
+            elif kind == b"S":
+                string_id, length = STRING.unpack(input_file.read(STRING.size))
+                strings[string_id] = input_file.read(length).decode()
+            elif kind == b"P":
+                product_id, length = PRODUCT.unpack(input_file.read(PRODUCT.size))
+                descriptions[product_id] = json.loads(input_file.read(length))
+            elif kind == b"C":
+                calls.append(_read_call(input_file, strings))
+            else:
+                raise ValueError("corrupt trace record %r in %s" % (kind, path))
+    return config, make_products(descriptions), calls
+
+
+def _read_call(input_file, strings):
+    """
+    Reads a call record, after its kind.
+    """
+    (timestamp, returned, thread, method, flags, subject, product_id, quantity,
+     timeout, result, buyer) = CALL.unpack(input_file.read(CALL.size))
+    method = METHODS[method]
+    cart = ()
+    if method == "checkout":
+        cart = tuple(CART_OPERATION.iter_unpack(input_file.read(CART_OPERATION.size * quantity)))
+    return Call(timestamp, returned, strings[thread], method, bool(flags & FLAG_BLOCK),
+                timeout if flags & FLAG_TIMEOUT else None,
+                subject, product_id, quantity, result, strings.get(buyer), cart)
+
+
+class _ReturnOrder:
+    """
+    The progress of a fast replay through the order the calls returned in
+    when recorded. The frontier is the position in that order of the first
+    call not replayed yet, leaving out the calls of the idle threads, which
+    may be blocked for good once the replay diverges.
+    """
+    def __init__(self, calls, lock):
+        by_return = sorted(range(len(calls)), key=lambda index: calls[index].returned)
+        # the position of every call in the order, and of the first call that
+        # had not returned when it started
+        self.rank = [0] * len(calls)
+        for rank, index in enumerate(by_return):
+            self.rank[index] = rank
+        returned = [calls[index].returned for index in by_return]
+        self.started_at = [bisect.bisect_left(returned, call.timestamp) for call in calls]
+        # the position of the next call of every thread, and a heap of
+        # (position, id, Event) of the threads waiting for the frontier to reach
+        # a position, all guarded by lock
+        self.lock = lock
+        self.pending = {}
+        self.frontier = 0
+        self.waiting = []
+
+    def reset(self, pending):
+        """
+        Starts a replay, given the position of the first call of every thread.
+        """
+        self.pending, self.frontier, self.waiting = pending, 0, []
+
+    def advance(self, idle):
+        """
+        Recomputes the frontier and wakes the threads waiting for it.
+        Must be called with the lock held.
+        """
+        self.frontier = min((pending for name, pending in self.pending.items()
+                             if name not in idle), default=len(self.rank))
+        while self.waiting and self.waiting[0][0] <= self.frontier:
+            heapq.heappop(self.waiting)[2].set()
+
+    def wait(self, rank):
+        """
+        Waits until the frontier reaches the given position, or for FAST_WAIT.
+        """
+        with self.lock:
+            if self.frontier >= rank:
+                return
+            reached = threading.Event()
+            # the id tells apart the waiters of one position, Events do not compare
+            heapq.heappush(self.waiting, (rank, id(reached), reached))
+        reached.wait(FAST_WAIT)
+
+
+class TraceReplayer:
+    """
+    Re-issues the calls of a trace against a marketplace, mapping the
+    recorded producer and cart ids to the ones the marketplace returns.
+    """
+    def __init__(self, path):
+        """
+        Constructor
+
+        :type path: String
+        :param path: the trace file
+        """
+        self.config, self.products, self.calls = read_trace(path)
+        self.lock = threading.Lock()
+        self.producer_ids = {}
+        self.cart_ids = {}
+        self.mismatches = 0
+        # the names of the replay threads done, in their last call or blocked
+        # with no timeout, notified when a thread joins them
+        self.idle = set()
+        self.idle_changed = threading.Condition(self.lock)
+        self.order = _ReturnOrder(self.calls, self.lock)
+
+    def replay(self, marketplace, speed=None, serial=False):
+        """
+        Replays the trace. By default every recorded thread is replayed by a
+        thread of the same name, the calls of different threads racing like
+        they did when recorded.
+
+        Unless speed is given, add_to_cart and publish_many only ask for the
+        units the recorded call got and the calls that got none are skipped:
+        they only waited for stock, which would make a fast replay take
+        longer than the recording instead of shorter. For the same reason the
+        recorded timeouts are not waited: instead of their pacing, the threads
+        keep the order of their calls. A call is issued once the calls that had
+        returned when it started have been replayed, and a call that blocked
+        with a timeout is made without blocking and, if it got less than the
+        recorded one, once more when the calls that returned before it have
+        been replayed. These waits last at most FAST_WAIT, as the replay may
+        diverge and the calls waited for never come, and leave out the threads
+        blocked with no timeout.
+
+        The producers of a recorded run are usually blocked in publish_many
+        until the marketplace shuts down, and the replayed consumers may buy
+        less than the recorded ones, so the recorded shutdown is issued once
+        every thread has started its last call or is blocked with no timeout.
+
+        :type marketplace: Marketplace
+        :param marketplace: any implementation of the marketplace methods
+
+        :type speed: Float
+        :param speed: issue every call at its recorded time divided by speed,
+        1 for the original pacing; None to issue the calls as fast as possible
+
+        :type serial: Bool
+        :param serial: issue every call from the current thread, in the order
+        they returned when recorded and without blocking, which gives the same
+        results on every run
+
+        :returns the number of calls whose result differs from the recorded one
+        """
+        self.producer_ids, self.cart_ids, self.mismatches = {}, {}, 0
+        self.idle = set()
+        start = time.monotonic()
+        if serial:
+            self._replay_calls(marketplace, range(len(self.calls)), start, speed, serial)
+            return self.mismatches
+
+        by_thread = {}
+        shutdowns = []
+        for index, call in enumerate(self.calls):
+            if call.method == "shutdown":
+                shutdowns.append(index)
+            else:
+                by_thread.setdefault(call.thread, []).append(index)
+        self.order.reset({name: self.order.rank[calls[0]] for name, calls in by_thread.items()})
+        threads = [threading.Thread(target=self._replay_calls, name=name,
+                                    args=(marketplace, calls, start, speed, serial))
+                   for name, calls in by_thread.items()]
+        for thread in threads:
+            thread.start()
+        if shutdowns:
+            with self.idle_changed:
+                self.idle_changed.wait_for(lambda: len(self.idle) == len(threads))
+            self._replay_calls(marketplace, shutdowns, start, speed, serial)
+        for thread in threads:
+            thread.join()
+        return self.mismatches
+
+    def _replay_calls(self, marketplace, indices, start, speed, serial):
+        """
+        Issues the calls of the given indices in order, waiting for their time
+        if speed is given, or else for the calls that returned before they started.
+        """
+        name = threading.current_thread().name
+        ordered = not speed and not serial and name in self.order.pending
+        for position, index in enumerate(indices):
+            call = self.calls[index]
+            last = position == len(indices) - 1
+            if not speed and call.method in ("add_to_cart", "publish_many") and not call.result:
+                self._replayed(name, indices, position, ordered)
+                continue
+            if speed:
+                delay = start + call.timestamp / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            elif ordered:
+                self.order.wait(self.order.started_at[index])
+            untimed = call.block and call.timeout is None and not serial
+            if last or untimed:
+                with self.idle_changed:
+                    self.idle.add(name)
+                    self.idle_changed.notify()
+                    self.order.advance(self.idle)
+            if ordered and call.block and call.timeout is not None:
+                result = encode_result(self._issue_caught_up(marketplace, call, index))
+            else:
+                result = encode_result(self._issue(marketplace, call, speed, not serial))
+            with self.lock:
+                if untimed and not last:
+                    self.idle.discard(name)
+                self.mismatches += result != call.result
+            self._replayed(name, indices, position, ordered)
+        with self.idle_changed:
+            self.idle.add(name)
+            self.idle_changed.notify()
+            self.order.advance(self.idle)
+
+    def _replayed(self, name, indices, position, ordered):
+        """
+        Notes that the thread of the given name replayed the call at position of indices.
+        """
+        if ordered:
+            with self.lock:
+                self.order.pending[name] = (self.order.rank[indices[position + 1]]
+                                            if position + 1 < len(indices) else len(self.calls))
+                self.order.advance(self.idle)
+
+    def _issue_caught_up(self, marketplace, call, index):
+        """
+        Makes a call that blocked with a timeout when recorded, in a fast
+        replay. Instead of blocking, it is made once, and if it got less than
+        the recorded call once more when the calls that returned before the
+        recorded one have been replayed, or after FAST_WAIT.
+        """
+        result = self._issue(marketplace, call, None, False)
+        if encode_result(result) == call.result:
+            return result
+        self.order.wait(self.order.rank[index])
+        if call.method == "add_to_cart":
+            remaining = dataclasses.replace(call, result=call.result - result)
+            return result + self._issue(marketplace, remaining, None, False)
+        return result or self._issue(marketplace, call, None, False)
+
+    def _issue(self, marketplace, call, speed, block):
+        """
+        Makes one call, blocking like the recorded one unless block is False.
+        """
+        method = getattr(marketplace, call.method)
+        blocking = {}
+        if call.block and block:
+            blocking = {"block": True, "timeout": call.timeout}
+
+        if call.method in ("register_producer", "new_cart"):
+            result = method()
+            with self.lock:
+                ids = self.producer_ids if call.method == "register_producer" else self.cart_ids
+                ids[call.result] = result
+            return call.result if result is not None else None
+        if call.method == "checkout":
+            cart_ops = [{"type": CART_OPERATION_TYPES[operation_type],
+                         "product": self.products[product_id], "quantity": quantity}
+                        for operation_type, product_id, quantity in call.cart]
+            return method(cart_ops, name=call.buyer or call.thread, **blocking)
+        if call.method == "shutdown":
+            return method()
+        if call.method in PRODUCER_METHODS:
+            subject = str(self.producer_ids[call.subject])
+        else:
+            subject = self.cart_ids[call.subject]
+        if call.method == "publish":
+            return method(subject, self.products[call.product], **blocking)
+        if call.method in ("publish_many", "add_to_cart"):
+            quantity = call.quantity if speed else min(call.quantity, call.result)
+            return method(subject, self.products[call.product], quantity, **blocking)
+        if call.method == "remove_from_cart":
+            return method(subject, self.products[call.product], call.quantity)
+        if call.method == "place_order":
+            return method(subject, call.buyer or call.thread)
+        return method(subject)
+
+
+class TestTrace(unittest.TestCase):
+    """
+    unittest class
+    """
+    def setUp(self):
+        """
+        initialization
+        """
+        # imported here, tema.marketplace imports tema.hooks
+        from tema.marketplace import Marketplace  # pylint: disable=import-outside-toplevel
+        self.make_marketplace = lambda: Marketplace(2, sink=MemorySink())
+        self.tea = Tea("Linden", 9, "Herbal")
+        descriptor, self.path = tempfile.mkstemp(suffix=".trace")
+        os.close(descriptor)
+
+    def tearDown(self):
+        """
+        removes the trace file
+        """
+        os.remove(self.path)
+
+    def record(self):
+        """
+        records a producer and a consumer on one marketplace
+        """
+        marketplace = self.make_marketplace()
+        recorder = TraceRecorder(self.path)
+        recorder.start(marketplace)
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, self.tea)
+        marketplace.publish_many(str(producer_id), self.tea, 3)
+        cart_id = marketplace.new_cart()
+        marketplace.add_to_cart(cart_id, self.tea, 3)
+        marketplace.remove_from_cart(cart_id, self.tea)
+        marketplace.place_order(cart_id, "cons1")
+        marketplace.checkout([{"type": "add", "product": self.tea, "quantity": 1}])
+        recorder.stop()
+        return marketplace
+
+    def test_calls_are_recorded_once(self):
+        """
+        testing that nested calls are left out of the trace
+        """
+        self.record()
+        config, products, calls = read_trace(self.path)
+        self.assertEqual(config, {"queue_size_per_producer": 2})
+        self.assertEqual({call.thread for call in calls}, {threading.current_thread().name})
+        self.assertEqual(list(products.values()), [self.tea])
+        self.assertEqual([call.method for call in calls],
+                         ["register_producer", "publish", "publish_many", "new_cart",
+                          "add_to_cart", "remove_from_cart", "place_order", "checkout"])
+        self.assertEqual([call.result for call in calls], [0, 1, 1, 1, 2, 1, 1, 1])
+        self.assertEqual(calls[-2].buyer, "cons1")
+        self.assertEqual(calls[-1].cart, ((0, 0, 1),))
+
+    def test_serial_replay_gives_the_recorded_results(self):
+        """
+        testing that replaying serially on a fresh marketplace matches the trace
+        """
+        recorded = self.record()
+        marketplace = self.make_marketplace()
+        self.assertEqual(TraceReplayer(self.path).replay(marketplace, serial=True), 0)
+        self.assertEqual(marketplace.fulfillment.ledger(), recorded.fulfillment.ledger())
+        self.assertEqual(marketplace.fulfillment.sink.lines(), recorded.fulfillment.sink.lines())
+
+    def test_fast_replay_keeps_the_order_not_the_waits(self):
+        """
+        testing that a fast replay adds to the cart after the publish it came
+        after when recorded, and gives a blocked consumer the unit published
+        while it waited without waiting for its timeout
+        """
+        marketplace = self.make_marketplace()
+        recorder = TraceRecorder(self.path)
+        recorder.start(marketplace)
+        cart_created, published = threading.Event(), threading.Event()
+
+        def buy():
+            cart_id = marketplace.new_cart()
+            cart_created.set()
+            published.wait()
+            marketplace.add_to_cart(cart_id, self.tea)
+            marketplace.add_to_cart(cart_id, self.tea, block=True, timeout=5)
+            marketplace.place_order(cart_id, "cons1")
+
+        consumer = threading.Thread(target=buy, name="cons1")
+        consumer.start()
+        cart_created.wait()
+        producer_id = marketplace.register_producer()
+        marketplace.publish(producer_id, self.tea)
+        published.set()
+        time.sleep(0.1)
+        marketplace.publish(producer_id, self.tea)
+        consumer.join()
+        recorder.stop()
+
+        start = time.monotonic()
+        self.assertEqual(TraceReplayer(self.path).replay(self.make_marketplace()), 0)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_corrupt_trace(self):
+        """
+        testing that a file that is not a trace is rejected
+        """
+        with open(self.path, "wb") as output_file:
+            output_file.write(b"not a trace")
+        with self.assertRaises(ValueError):
+            read_trace(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,3 +11,8 @@ python3 test_generator.py 08 10 50 5 40 1 5
 python3 test_generator.py 09 20 5 2 25 1 2
 python3 test_generator.py 10 50 200 10 40 1 5
 
+
+# large scenarios: large_test_generator.py [-h] [--seed SEED] test_name {100k,1k,1m}
+# python3 large_test_generator.py large1k 1k
+# python3 large_test_generator.py large100k 100k
+# python3 large_test_generator.py large1m 1m
@@ -0,0 +1,176 @@
+"""
+Generates large tests for the homework, streaming the input and reference
+output files to disk.
+
+Script input
+    - test file name
+    - preset: 1k, 100k or 1m cart operations
+    - seed
+    - whether to write a line-delimited .jsonl scenario instead of a .in file
+
+Product names are synthetic, so the catalog can be as large as needed, and
+every producer makes a single product, so a producer's queue can only fill up
+with a product nobody is waiting for and the scenario cannot deadlock.
+Consumers are generated in the order of their names, which makes the
+reference output come out sorted without sorting it in memory.
+"""
+import argparse
+import random
+from collections import Counter
+from json import dumps
+
+from tema.product import *  # pylint: disable=wildcard-import, unused-wildcard-import
+from test_utils import *  # pylint: disable=wildcard-import, unused-wildcard-import
+
+# preset -> (cart operations, products, consumers, max add operations per cart,
+# max quantity per operation, queue size per producer)
+PRESETS = {
+    "1k": (1_000, 20, 20, 5, 5, 20),
+    "100k": (100_000, 200, 200, 10, 10, 50),
+    "1m": (1_000_000, 500, 1_000, 10, 10, 100),
+}
+# operations drawn from the random generator at once
+BATCH = 4096
+
+
+def parse_input():
+    """
+    Parses command line input.
+    :return: the argparse namespace
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("test_name", help="Test file name (no extension)")
+    parser.add_argument("preset", choices=sorted(PRESETS), help="the number of cart operations")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random generator")
+    parser.add_argument("--lines", action="store_true",
+                        help="write a line-delimited .jsonl scenario, see tema/scenario.py")
+    return parser.parse_args()
+
+
+def generate_products(rng, count):
+    """
+    Generates count products with synthetic names, half coffee and half tea.
+    :return: a dict of product descriptions and the list of the products, by index
+    """
+    descriptions = {}
+    products = []
+    tea_names = list(TEA_NAMES_TYPES)
+    for i in range(count):
+        price = rng.randint(1, 10)
+        if i < count / 2:
+            description = {"product_type": "Coffee",
+                           "name": f"{COFFEE_NAMES[i % len(COFFEE_NAMES)]} {i + 1}",
+                           "price": price,
+                           "acidity": round(rng.uniform(MIN_ACIDITY, MAX_ACIDITY), 2),
+                           "roast_level": rng.choice(ROAST_LEVEL)}
+        else:
+            tea = tea_names[i % len(tea_names)]
+            description = {"product_type": "Tea", "name": f"{tea} {i + 1}", "price": price,
+                           "type": TEA_NAMES_TYPES[tea]}
+        descriptions[PRODUCT_PREFIX + str(i + 1)] = description
+        params = {k: v for k, v in description.items() if k != "product_type"}
+        products.append(globals()[description["product_type"]](**params))
+    return descriptions, products
+
+
+def generate_producers(rng, count):
+    """
+    Generates one producer for each of the count products.
+    :return: a list with all producers
+    """
+    return [{"name": PRODUCER_NAME_PREFIX + str(i + 1),
+             "products": [[PRODUCT_PREFIX + str(i + 1), rng.randint(1, 5),
+                           round(rng.uniform(0.001, 0.01), 3)]],
+             "republish_wait_time": round(rng.uniform(0.001, 0.01), 3)}
+            for i in range(count)]
+
+
+def generate_carts(rng, operations, products, max_adds, max_quantity):
+    """
+    Generates carts until they hold the given number of operations, drawing
+    the products and quantities in batches.
+    :return: yields (cart operations, Counter of the units bought by product index)
+    """
+    indices = range(len(products))
+    quantities = range(1, max_quantity + 1)
+    product_batch, quantity_batch = [], []
+    while operations > 0:
+        adds = min(rng.randint(1, max_adds), operations)
+        if len(product_batch) < adds:
+            product_batch += rng.choices(indices, k=BATCH)
+            quantity_batch += rng.choices(quantities, k=BATCH)
+        chosen, product_batch = product_batch[:adds], product_batch[adds:]
+        amounts, quantity_batch = quantity_batch[:adds], quantity_batch[adds:]
+
+        cart = [{"type": ADD_TO_CART_OP, "product": PRODUCT_PREFIX + str(index + 1),
+                 "quantity": quantity} for index, quantity in zip(chosen, amounts)]
+        bought = Counter()
+        for index, quantity in zip(chosen, amounts):
+            bought[index] += quantity
+        operations -= adds
+
+        # not all carts have a removal
+        if operations > 0 and rng.random() < 0.5:
+            index = chosen[-1]
+            quantity = rng.randint(1, amounts[-1])
+            cart.append({"type": REMOVE_FROM_CART_OP, "product": PRODUCT_PREFIX + str(index + 1),
+                         "quantity": quantity})
+            bought[index] -= quantity
+            operations -= 1
+        yield cart, bought
+
+
+def generate_test():
+    """
+    Generates the test and writes the input and reference output files
+    :return: nothing
+    """
+    args = parse_input()
+    rng = random.Random(args.seed)
+    operations, num_products, num_consumers, max_adds, max_quantity, queue_size = \
+        PRESETS[args.preset]
+
+    descriptions, products = generate_products(rng, num_products)
+    producers = generate_producers(rng, num_products)
+    # in the order of the names, which is the order of the sorted reference lines
+    names = sorted(CONSUMER_NAME_PREFIX + str(i + 1) for i in range(num_consumers))
+
+    marketplace = {"queue_size_per_producer": queue_size}
+    extension = "jsonl" if args.lines else "in"
+
+    with open(f'{TESTS_DIR}/{args.test_name}.{extension}', 'w') as input_file, \
+            open(f'{TESTS_DIR}/{args.test_name}.ref.out', 'w') as output_file:
+        if args.lines:
+            input_file.write(dumps({"marketplace": marketplace}) + "\n"
+                             + dumps({"products": descriptions}) + "\n")
+            input_file.writelines(dumps({"producer": producer}) + "\n" for producer in producers)
+        else:
+            input_file.write('{"products": ' + dumps(descriptions)
+                             + ', "producers": ' + dumps(producers)
+                             + ', "consumers": [')
+        for i, name in enumerate(names):
+            # spread the remaining operations over the remaining consumers
+            share = operations // (num_consumers - i)
+            operations -= share
+            carts = []
+            bought = Counter()
+            for cart, cart_bought in generate_carts(rng, share, products, max_adds,
+                                                    max_quantity):
+                carts.append(cart)
+                bought.update(cart_bought)
+            consumer = {"name": name, "retry_wait_time": round(rng.uniform(0.001, 0.01), 3),
+                        "carts": carts}
+            if args.lines:
+                input_file.write(dumps({"consumer": consumer}) + "\n")
+            else:
+                input_file.write((", " if i else "") + dumps(consumer))
+
+            lines = sorted(f"{name} bought {products[index]}\n"
+                           for index, count in bought.items() for _ in range(count))
+            output_file.writelines(lines)
+        if not args.lines:
+            input_file.write('], "marketplace": ' + dumps(marketplace) + '}\n')
+
+
+if __name__ == "__main__":
+    generate_test()
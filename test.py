@@ -6,13 +6,29 @@ Assignment 1
 March 2020
 """
 
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
 import sys
-from json import loads
+import tempfile
 
+from tema.async_agents import AsyncConsumer, AsyncProducer
+from tema.async_marketplace import AsyncMarketplace
+from tema.logger import set_level
+from tema.pool import ConsumerPool
+from tema.server import MarketplaceClient, serve
 from tema.producer import Producer
+from tema.profiling import StackSampler, ThreadProfiler
 from tema.consumer import Consumer
 from tema.marketplace import Marketplace
-from tema.product import Product, Coffee, Tea
+from tema.metrics import StatsReporter
+from tema.scenario import load_scenario
+from tema.simulation import Simulation
+from tema.shm_marketplace import SharedMemoryMarketplace
+from tema.sinks import SINKS, FileSink, make_sink
+from tema.trace import TraceRecorder
 
 
 def main():
@@ -20,55 +36,326 @@ def main():
         Convert the market_configuration input file into specific models:
         Producer, Consumer, Marketplace
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filename", help="the market configuration file, a JSON document "
+                                         "or a line-delimited .jsonl scenario")
+    parser.add_argument("--log-level", default="INFO",
+                        help="marketplace log level, DEBUG also traces every operation")
+    parser.add_argument("--mode", choices=["threads", "asyncio", "pool", "processes", "shm",
+                                           "simulate"],
+                        default="threads",
+                        help="one thread per agent, every agent on one event loop, "
+                             "the consumers' carts on a pool of worker threads, the agents "
+                             "spread over processes talking to a marketplace server, one "
+                             "thread per agent on the shared memory marketplace, or a "
+                             "discrete-event simulation where waiting takes no time")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="worker threads of the consumer pool in pool mode, "
+                             "worker processes in processes mode")
+    parser.add_argument("--output", choices=sorted(SINKS), default="print",
+                        help="print every order when it is placed, write the orders in "
+                             "batches from a background thread to stdout or to a file, "
+                             "or keep them in memory; not in processes mode")
+    parser.add_argument("--output-file", default=None,
+                        help="the file of --output file, %s by default" % FileSink.DEFAULT_PATH)
+    parser.add_argument("--fulfillment-workers", type=int, default=1,
+                        help="threads that write the placed orders, 0 to write them in "
+                             "place_order; threads, asyncio, pool and shm modes only")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the order of simultaneous events in simulate mode")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="measure the marketplace and append JSON snapshots of its "
+                             "stats to FILE, - for stderr; threads, pool and simulate "
+                             "modes only")
+    parser.add_argument("--stats-interval", type=float, default=None,
+                        help="seconds between two stats snapshots, only one at exit by default")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record every marketplace call in a binary trace, see "
+                             "tema/trace.py and bench/replay.py; threads, pool and simulate "
+                             "modes only")
+    parser.add_argument("--profile", choices=["sample", "cprofile"],
+                        help="sample the stacks of every thread and write them folded, for "
+                             "flamegraph.pl or speedscope, or run cProfile in every thread "
+                             "and write the merged pstats; not in processes mode")
+    parser.add_argument("--profile-output", default=None,
+                        help="the profile file, profile.folded or profile.prof by default")
+    parser.add_argument("--profile-interval", type=float, default=0.005,
+                        help="seconds between two stack samples")
+    args = parser.parse_args()
+    set_level(args.log_level)
+
+    stats_file = None
+    if args.stats:
+        stats_file = sys.stderr if args.stats == "-" else open(args.stats, "a")
+    try:
+        observers = []
+        if stats_file is not None:
+            observers.append(StatsReporter(stats_file, args.stats_interval))
+        if args.record:
+            observers.append(TraceRecorder(args.record))
+        market_config = load_scenario(args.filename)
+        if args.profile:
+            run_profiled(args, market_config, observers)
+        else:
+            run(market_config, args.mode, args.workers, args.output,
+                args.fulfillment_workers, args.seed, observers, args.output_file)
+    finally:
+        if stats_file not in (None, sys.stderr):
+            stats_file.close()
+
+
+def run_profiled(args, market_config, observers):
+    """
+        Runs a market configuration under the profiler chosen by --profile
+        and writes the profile
+    """
+    if args.profile == "sample":
+        profiler = StackSampler(args.profile_interval)
+        profiler.start()
+    else:
+        profiler = ThreadProfiler()
+        profiler.start()
     try:
-        filename = sys.argv[1]
-    except IndexError:
-        print("no input file specified")
-        raise SystemExit
-
-    with open(filename) as input_file:
-        market_config = loads(input_file.read())
-
-    # turn product definitions into actual products
-    products = {}
-
-    for k, products_dict in market_config['products'].items():
-        params = {k: products_dict[k] for k in products_dict.keys() if k != 'product_type'}
-        products[k] = globals()[products_dict['product_type']](**params)
-    del market_config['products']
-
-    # turn product ids into products in producers
-    for producer in market_config['producers']:
-        producer['products'] = [(products[i], quantity, sleep_time)
-                                for i, quantity, sleep_time
-                                in producer['products']]
-
-    # turn product ids into products in consumer order lists and expected carts
-    for consumer in market_config['consumers']:
-        for cart in consumer['carts']:
-            for operation in cart:
-                operation['product'] = products[operation['product']]
+        run(market_config, args.mode, args.workers, args.output,
+            args.fulfillment_workers, args.seed, observers, args.output_file)
+    finally:
+        if args.profile == "sample":
+            profiler.stop()
+            with open(args.profile_output or "profile.folded", "w") as output_file:
+                profiler.write_folded(output_file)
+        else:
+            profiler.stop().dump_stats(args.profile_output or "profile.prof")
+
+
+def run(market_config, mode="threads", workers=8, output="print", fulfillment_workers=1,
+        seed=None, observers=(), output_file=None):
+    """
+        Runs a market configuration in the given mode, see the command line help
+    """
+    if mode == "asyncio":
+        asyncio.run(run_asyncio(market_config, make_sink(output, output_file),
+                                fulfillment_workers))
+    elif mode == "pool":
+        run_pool(market_config, workers, make_sink(output, output_file), fulfillment_workers,
+                 observers)
+    elif mode == "processes":
+        run_processes(market_config, workers)
+    elif mode == "shm":
+        run_shm(market_config, make_sink(output, output_file), fulfillment_workers)
+    elif mode == "simulate":
+        run_simulation(market_config, make_sink(output, output_file), seed, observers)
+    else:
+        run_threads(market_config, make_sink(output, output_file), fulfillment_workers, observers)
+
 
+def build_marketplace(market_config, sink, fulfillment_workers=0, observers=()):
+    """
+        Builds the marketplace of a market configuration and starts the
+        observers on it: stats reporters and trace recorders
+    """
+    metrics = any(isinstance(observer, StatsReporter) for observer in observers)
+    marketplace = Marketplace(**market_config['marketplace'], sink=sink,
+                              fulfillment_workers=fulfillment_workers, metrics=metrics)
+    for observer in observers:
+        observer.start(marketplace)
+    return marketplace
+
+
+def stop_observers(observers):
+    """
+        Stops the observers started by build_marketplace, last started first
+    """
+    for observer in reversed(observers):
+        observer.stop()
+
+
+def run_threads(market_config, sink, fulfillment_workers, observers=()):
+    """
+        Runs every producer and consumer in its own thread
+    """
     # build the marketplace
-    marketplace = Marketplace(**market_config['marketplace'])
+    marketplace = build_marketplace(market_config, sink, fulfillment_workers, observers)
+    run_agent_threads(market_config, marketplace)
+    stop_observers(observers)
+
 
+def run_shm(market_config, sink, fulfillment_workers):
+    """
+        Runs every producer and consumer in its own thread against a
+        marketplace whose stock lives in shared memory
+    """
+    marketplace = SharedMemoryMarketplace(**market_config['marketplace'], sink=sink,
+                                          fulfillment_workers=fulfillment_workers)
+    try:
+        run_agent_threads(market_config, marketplace)
+    finally:
+        marketplace.close()
+
+
+def run_agent_threads(market_config, marketplace):
+    """
+        Runs every producer and consumer in its own thread until the
+        consumers are done and their orders fulfilled
+    """
     # build and start the producers
-    producers = [Producer(**p_market_config, marketplace=marketplace, daemon=True)
+    producers = [Producer(**p_market_config, marketplace=marketplace)
                  for p_market_config in market_config['producers']]
 
     for producer in producers:
         producer.start()
 
-    # build and start the consumers
-    consumers = [Consumer(**c_market_config, marketplace=marketplace)
-                 for c_market_config in market_config['consumers']]
+    # build and start the consumers, each one as soon as it is read
+    consumers = []
+    for c_market_config in market_config['consumers']:
+        consumers.append(Consumer(**c_market_config, marketplace=marketplace))
+        consumers[-1].start()
 
     for consumer in consumers:
-        consumer.start()
+        consumer.join()
+
+    # wake up the producers blocked on full queues and wait for them to stop
+    marketplace.shutdown()
+    for producer in producers:
+        producer.join()
+    # write the orders still queued for fulfillment
+    marketplace.fulfillment.join()
+
+
+def run_pool(market_config, workers, sink, fulfillment_workers, observers=()):
+    """
+        Runs every producer in its own thread and the consumers' carts on a
+        pool of worker threads
+    """
+    marketplace = build_marketplace(market_config, sink, fulfillment_workers, observers)
+
+    producers = [Producer(**p_market_config, marketplace=marketplace)
+                 for p_market_config in market_config['producers']]
+
+    for producer in producers:
+        producer.start()
 
+    pool = ConsumerPool(marketplace, workers)
+    for c_market_config in market_config['consumers']:
+        pool.submit(**c_market_config)
+    pool.join()
+
+    marketplace.shutdown()
+    for producer in producers:
+        producer.join()
+    # write the orders still queued for fulfillment
+    marketplace.fulfillment.join()
+    stop_observers(observers)
+
+
+def run_processes(market_config, workers):
+    """
+        Runs the marketplace in a server process and spreads the producers and
+        consumers over a pool of worker processes that call it through its socket
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "marketplace.sock")
+    server = multiprocessing.Process(target=serve, args=(path, market_config['marketplace']))
+    server.start()
+
+    consumer_configs = list(market_config['consumers'])
+    groups = [(market_config['producers'][i::workers], consumer_configs[i::workers])
+              for i in range(workers)]
+    consumers_done = multiprocessing.Semaphore(0)
+
+    with multiprocessing.Pool(workers, initializer=init_agents_process,
+                              initargs=(consumers_done,)) as pool:
+        results = [pool.apply_async(run_agents, (path, producers, consumers))
+                   for producers, consumers in groups]
+        # the producers of every process run until all the consumers are done
+        for _ in groups:
+            consumers_done.acquire()
+        client = MarketplaceClient(path)
+        client.shutdown()
+        for result in results:
+            result.get()
+
+    client.stop_server()
+    server.join()
+    shutil.rmtree(directory)
+
+
+CONSUMERS_DONE = None
+
+
+def init_agents_process(consumers_done):
+    """
+        Initializes a worker process of run_processes
+    """
+    global CONSUMERS_DONE  # pylint: disable=global-statement
+    CONSUMERS_DONE = consumers_done
+
+
+def run_agents(path, producer_configs, consumer_configs):
+    """
+        Runs some producers and consumers in threads of a worker process,
+        against the marketplace server listening on path
+    """
+    marketplace = MarketplaceClient(path)
+
+    producers = [Producer(**p_market_config, marketplace=marketplace)
+                 for p_market_config in producer_configs]
+    for producer in producers:
+        producer.start()
+
+    consumers = [Consumer(**c_market_config, marketplace=marketplace)
+                 for c_market_config in consumer_configs]
+    for consumer in consumers:
+        consumer.start()
     for consumer in consumers:
         consumer.join()
 
+    CONSUMERS_DONE.release()
+    for producer in producers:
+        producer.join()
+
+
+def run_simulation(market_config, sink, seed, observers=()):
+    """
+        Runs every producer and consumer as an agent of a discrete-event
+        simulation, on a virtual clock
+    """
+    marketplace = build_marketplace(market_config, sink, observers=observers)
+    simulation = Simulation(seed)
+
+    for p_market_config in market_config['producers']:
+        producer = Producer(**p_market_config, marketplace=marketplace, sleep=simulation.sleep)
+        simulation.spawn(producer.run, daemon=True, name=producer.name)
+    for c_market_config in market_config['consumers']:
+        consumer = Consumer(**c_market_config, marketplace=marketplace, sleep=simulation.sleep)
+        simulation.spawn(consumer.run, name=consumer.name)
+
+    simulation.run()
+    marketplace.fulfillment.join()
+    stop_observers(observers)
+
+
+async def run_asyncio(market_config, sink, fulfillment_workers):
+    """
+        Runs every producer and consumer as a task on the current event loop
+    """
+    marketplace = AsyncMarketplace(**market_config['marketplace'], sink=sink,
+                                   fulfillment_workers=fulfillment_workers)
+
+    producers = [asyncio.create_task(AsyncProducer(**p_market_config,
+                                                   marketplace=marketplace).run())
+                 for p_market_config in market_config['producers']]
+
+    consumers = [asyncio.create_task(AsyncConsumer(**c_market_config,
+                                                   marketplace=marketplace).run(),
+                                     name=c_market_config['name'])
+                 for c_market_config in market_config['consumers']]
+
+    await asyncio.gather(*consumers)
+    marketplace.shutdown()
+    await asyncio.gather(*producers)
+    # write the orders still queued for fulfillment
+    marketplace.fulfillment.join()
+
 
 if __name__ == '__main__':
     main()